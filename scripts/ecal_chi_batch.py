@@ -0,0 +1,61 @@
+"""
+Energy calibration of a directory of .chi files
+
+    python scripts/ecal_chi_batch.py ../../data --standard LaB6 \
+        --offsets 0 3 100 --output ecal.csv
+
+The analysis lives in startup/42-energy-calib.py, see
+batch_chi_calibration.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STARTUP = os.path.join(ROOT, 'startup')
+# the profile has this from 04-recommender.py, the fits for the process
+# pool are in xpd_workers
+sys.path.append(ROOT)
+
+# run in this namespace, as in the profile, for batch_chi_calibration and
+# D_SPACINGS
+with open(os.path.join(STARTUP, '42-energy-calib.py')) as f:
+    exec(compile(f.read(), '42-energy-calib.py', 'exec'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='+',
+                        help='.chi files, directories or glob patterns')
+    parser.add_argument('--standard', choices=sorted(D_SPACINGS), default='LaB6')
+    parser.add_argument('--d-spacings',
+                        help='file of d spacings, instead of --standard')
+    parser.add_argument('--offsets', nargs=3, type=float, default=None,
+                        metavar=('START', 'STOP', 'NUM'),
+                        help='sweep of two theta offsets to add to each file')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--engine', choices=['lmfit', 'batch'], default='lmfit')
+    parser.add_argument('--output', help='write the table to this csv file')
+    args = parser.parse_args()
+
+    if args.d_spacings:
+        d_spacings = np.loadtxt(args.d_spacings)
+    else:
+        d_spacings = D_SPACINGS[args.standard]
+    if args.offsets is None:
+        offsets = [0.]
+    else:
+        start, stop, num = args.offsets
+        offsets = np.linspace(start, stop, int(num))
+
+    df = batch_chi_calibration(args.paths, d_spacings, offsets=offsets,
+                               processes=args.processes, engine=args.engine)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    print(df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,15 @@
 """Structures and helpers to defined sample layout."""
 
+import hashlib
 import json
+import math
+from pathlib import Path
 from dataclasses import dataclass, asdict, astuple, field
 from collections import namedtuple, defaultdict
 
 import numpy as np
 
-import scipy.stats
-
-import matplotlib.cm as mcm
+import matplotlib.collections as mcollections
 import matplotlib.colors as mcolors
 import matplotlib.patches as mpatches
 
@@ -20,7 +21,15 @@ import matplotlib.patches as mpatches
 #     aka: data coordinates -> beamline coordinates
 # Inverse: real positions       -> pseudo positions
 #     aka: beamline coordinates -> data coordinates
-TransformPair = namedtuple("TransformPair", ["forward", "inverse"])
+#
+# The optional *_many variants take arrays, never raise for
+# infeasible points and instead return a boolean validity mask as the
+# last element (invalid entries are filled with NaN).
+TransformPair = namedtuple(
+    "TransformPair",
+    ["forward", "inverse", "forward_many", "inverse_many"],
+    defaults=(None, None),
+)
 
 
 def single_strip_transform_factory(
@@ -81,6 +90,8 @@ def single_strip_transform_factory(
     transform_pair
        forward (data -> bl)
        inverse (bl -> data)
+       forward_many (data -> bl, vectorized)
+       inverse_many (bl -> data, vectorized)
 
     """
     _temperature = int(temperature)
@@ -88,6 +99,7 @@ def single_strip_transform_factory(
     _thickness = int(thickness)
 
     cell_positions = np.arange(len(ti_fractions)) * cell_size
+    ti_min, ti_max = np.min(ti_fractions), np.max(ti_fractions)
 
     def to_bl_coords(Ti_frac, temperature, annealing_time, thickness):
         if (
@@ -132,7 +144,66 @@ def single_strip_transform_factory(
 
         return ti_frac, _temperature, _annealing_time, _thickness
 
-    return TransformPair(to_bl_coords, to_data_coords)
+    def to_bl_coords_many(Ti_frac, temperature, annealing_time, thickness):
+        Ti_frac, temperature, annealing_time, thickness = _as_float_arrays(
+            Ti_frac, temperature, annealing_time, thickness
+        )
+        valid = (
+            (temperature == _temperature)
+            & (annealing_time == _annealing_time)
+            & (thickness == _thickness)
+            & (Ti_frac >= ti_min)
+            & (Ti_frac <= ti_max)
+        )
+
+        d = (
+            np.interp(Ti_frac, ti_fractions, cell_positions)
+            - start_distance
+            + (cell_size / 2)
+        )
+        x = np.where(valid, reference_x - np.cos(angle) * d, np.nan)
+        y = np.where(valid, reference_y - np.sin(angle) * d, np.nan)
+
+        return x, y, valid
+
+    def to_data_coords_many(x, y):
+        x, y = _as_float_arrays(x, y)
+        x_rel = -(x - reference_x)
+        y_rel = y - reference_y
+
+        r = np.hypot(x_rel, y_rel)
+
+        d_angle = -np.arctan2(y_rel, x_rel)
+
+        from_center_angle = d_angle - angle
+        d = np.cos(from_center_angle) * (r + start_distance - (cell_size / 2))
+        h = -np.sin(from_center_angle) * r
+
+        valid = (
+            (np.min(cell_positions) < d)
+            & (d < np.max(cell_positions))
+            & ((-cell_size / 2) < h)
+            & (h < (cell_size / 2))
+        )
+
+        ti_frac = np.where(valid, np.interp(d, cell_positions, ti_fractions), np.nan)
+
+        return (
+            ti_frac,
+            np.where(valid, _temperature, np.nan),
+            np.where(valid, _annealing_time, np.nan),
+            np.where(valid, _thickness, np.nan),
+            valid,
+        )
+
+    return TransformPair(
+        to_bl_coords, to_data_coords, to_bl_coords_many, to_data_coords_many
+    )
+
+
+def _as_float_arrays(*args):
+    """Broadcast the inputs against each other as float arrays."""
+    return np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in args))
 
 
 @dataclass(frozen=True)
@@ -199,12 +270,274 @@ def load_from_json(fname):
     return [StripInfo(**d) for d in data]
 
 
-def single_strip_set_transform_factory(strips, *, cell_size=4.5):
+# where compiled layouts are cached, set to None to disable the cache
+LAYOUT_CACHE_DIR = Path("~/.cache/xpd_profile/layouts").expanduser()
+# part of every cache key, see layout_hash.  Bump it when the fields
+# written by save_compiled_layout, StripInfo or the fit of single_data
+# (calibrate_strip_layout, fit_strip_lines, edge_scans_to_centers) change.
+LAYOUT_FORMAT_VERSION = 3
+
+
+def compile_layout(strip_list, *, cell_size=4.5):
+    """
+    Pack a strip list into flat arrays.
+
+    The per-strip interpolation tables (Ti fraction and cell position
+    of every cell) are concatenated, ``ti_offsets[j]:ti_offsets[j + 1]``
+    selects the cells of strip ``j``.
+
+    Parameters
+    ----------
+    strip_list : List[StripInfo]
+
+    cell_size : float, optional
+
+       The size of each cell along the gradient where the Ti fraction
+       is measured in mm.
+
+    Returns
+    -------
+    layout : dict[str, np.ndarray]
+    """
+    n_cells = [len(strip.ti_fractions) for strip in strip_list]
+
+    def column(attr, dtype=float):
+        return np.array([getattr(strip, attr) for strip in strip_list], dtype=dtype)
+
+    return {
+        "temperature": column("temperature", int),
+        "annealing_time": column("annealing_time", int),
+        "thickness": column("thickness", int),
+        "reference_x": column("reference_x"),
+        "reference_y": column("reference_y"),
+        "start_distance": column("start_distance"),
+        "angle": column("angle"),
+        "ti_offsets": np.concatenate([[0], np.cumsum(n_cells)]).astype(int),
+        "ti_fractions": np.concatenate(
+            [np.asarray(strip.ti_fractions, dtype=float) for strip in strip_list]
+            or [np.empty(0)]
+        ),
+        # so integer Ti fractions come back as ints
+        "ti_integer": np.array(
+            [
+                all(isinstance(v, (int, np.integer)) for v in strip.ti_fractions)
+                for strip in strip_list
+            ],
+            dtype=bool,
+        ),
+        "cell_positions": np.concatenate(
+            [np.arange(n) * cell_size for n in n_cells] or [np.empty(0)]
+        ),
+        "cell_size": np.array(cell_size, dtype=float),
+    }
+
+
+def strips_from_compiled(layout):
+    """
+    Rebuild the strip list from a compiled layout.
+
+    Parameters
+    ----------
+    layout : Mapping[str, np.ndarray]
+        As returned by `compile_layout` or `load_compiled_layout`
+
+    Returns
+    -------
+    list[StripInfo]
+    """
+    offsets = layout["ti_offsets"]
+    ti_fractions = layout["ti_fractions"]
+    ti_integer = layout["ti_integer"]
+
+    def strip_ti(j):
+        ti = ti_fractions[offsets[j] : offsets[j + 1]]
+        return (ti.astype(int) if ti_integer[j] else ti).tolist()
+
+    return [
+        StripInfo(
+            temperature=int(layout["temperature"][j]),
+            annealing_time=int(layout["annealing_time"][j]),
+            ti_fractions=strip_ti(j),
+            reference_x=float(layout["reference_x"][j]),
+            reference_y=float(layout["reference_y"][j]),
+            start_distance=float(layout["start_distance"][j]),
+            angle=float(layout["angle"][j]),
+            thickness=int(layout["thickness"][j]),
+        )
+        for j in range(len(offsets) - 1)
+    ]
+
+
+def save_compiled_layout(strip_list, fname, *, cell_size=4.5, source_hash=""):
+    """
+    Write a compiled layout to a .npz file.
+
+    The file is written uncompressed so the arrays are read lazily.  The
+    cell tables are stored too, `layout_cell_geometry` takes the loaded
+    layout in place of a strip list.
+
+    Parameters
+    ----------
+    strip_list : List[StripInfo]
+
+    fname : str or Path
+        File to write
+
+    source_hash : str, optional
+        Hash of whatever the layout was built from
+    """
+    layout = compile_layout(strip_list, cell_size=cell_size)
+    np.savez(fname, source_hash=np.array(source_hash), **layout)
+
+
+def load_compiled_layout(fname):
+    """
+    Load a compiled layout written by `save_compiled_layout`.
+
+    Parameters
+    ----------
+    fname : str or Path
+        File to read
+
+    Returns
+    -------
+    layout : dict[str, np.ndarray]
+    """
+    with np.load(fname) as fin:
+        return {k: fin[k] for k in fin.files}
+
+
+def layout_hash(*parts):
+    """
+    Hash the bytes (or anything json-able) in *parts*.
+
+    LAYOUT_FORMAT_VERSION is always included.
+    """
+    h = hashlib.sha256()
+    h.update(f"layout format {LAYOUT_FORMAT_VERSION}".encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = part.tobytes()
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, default=asdict, sort_keys=True).encode()
+        h.update(part)
+    return h.hexdigest()
+
+
+def _layout_cache_file(name, source_hash, cache_dir):
+    if cache_dir is None:
+        cache_dir = LAYOUT_CACHE_DIR
+    if cache_dir is None:
+        return None
+    return Path(cache_dir) / f"{name}-{source_hash[:16]}.npz"
+
+
+def store_layout(name, source_hash, strip_list, *, cache_dir=None, cell_size=4.5):
+    """
+    Write a strip list to the layout cache, see `cached_layout`.
+
+    Parameters
+    ----------
+    name : str
+        Prefix of the cached file
+
+    source_hash : str
+        Hash of the inputs the strip list was built from
+
+    strip_list : List[StripInfo]
+
+    cache_dir : str or Path, optional
+        Defaults to LAYOUT_CACHE_DIR.  If that is None, do nothing.
+    """
+    fname = _layout_cache_file(name, source_hash, cache_dir)
+    if fname is None:
+        return
+    try:
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        save_compiled_layout(
+            strip_list, fname, cell_size=cell_size, source_hash=source_hash
+        )
+    except OSError as e:
+        print(f"could not cache layout to {fname}: {e}")
+
+
+def cached_layout(name, source_hash, build, *, cache_dir=None, cell_size=4.5):
+    """
+    Return a strip list, re-building it only if its source changed.
+
+    Parameters
+    ----------
+    name : str
+        Prefix of the cached file
+
+    source_hash : str
+        Hash of the inputs of *build*, see `layout_hash`
+
+    build : Callable[[], List[StripInfo]]
+        Called on a cache miss
+
+    cache_dir : str or Path, optional
+        Defaults to LAYOUT_CACHE_DIR.  If that is None, always build.
+
+    Returns
+    -------
+    list[StripInfo]
+    """
+    fname = _layout_cache_file(name, source_hash, cache_dir)
+    if fname is None:
+        return build()
+
+    try:
+        layout = load_compiled_layout(fname)
+        if str(layout["source_hash"]) == source_hash:
+            return strips_from_compiled(layout)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    strip_list = build()
+    store_layout(
+        name, source_hash, strip_list, cache_dir=cache_dir, cell_size=cell_size
+    )
+    return strip_list
+
+
+def load_from_json_cached(fname, *, cache_dir=None):
+    """
+    Load strip info from a json file through the compiled layout cache.
+
+    The cache is keyed on the hash of the json file so editing the file
+    invalidates it.
+
+    Parameters
+    ----------
+    fname : str or Path
+        File to read
+
+    cache_dir : str or Path, optional
+        Defaults to LAYOUT_CACHE_DIR
+
+    Returns
+    -------
+    list[StripInfo]
+    """
+    with open(fname, "rb") as fin:
+        raw = fin.read()
+
+    def build():
+        return [StripInfo(**d) for d in json.loads(raw)]
+
+    return cached_layout(
+        Path(fname).stem, layout_hash(raw), build, cache_dir=cache_dir
+    )
+
+
+def single_strip_set_transform_factory(strips, *, cell_size=4.5, debug=False):
     """
     Generate the forward and reverse transforms for set of strips.
 
     This assumes that the strips are mounted parallel to one of the
-    real motor axes.
+    real motor axes and that the strips do not cross each other on the
+    sample.
 
     This assumes that the temperature and annealing time have been
     pre-snapped.
@@ -218,47 +551,145 @@ def single_strip_set_transform_factory(strips, *, cell_size=4.5):
        The size of each cell along the gradient where the Ti fraction
        is measured in mm.
 
+    debug : bool, optional
+
+       If True, print the reason a look up failed.
+
     Returns
     -------
-    to_data_coords, to_bl_coords
+    transform_pair
+       forward (data -> bl)
+       inverse (bl -> data)
+       forward_many (data -> bl, vectorized)
+       inverse_many (bl -> data, vectorized)
     """
+    # (temperature, annealing_time, thickness) -> [(ti_min, ti_max, pair), ...]
     by_annealing = defaultdict(list)
     by_strip = {}
 
     for strip in strips:
-        pair = single_strip_transform_factory(*astuple(strip))
+        pair = single_strip_transform_factory(*astuple(strip), cell_size=cell_size)
         by_annealing[(strip.temperature, strip.annealing_time, strip.thickness)].append(
-            (strip, pair)
+            (strip.ti_min, strip.ti_max, pair)
         )
         by_strip[strip] = pair
 
+    # Index the strips by the center line of their band.  Because the
+    # strips do not cross, the order by reference_y is the order along y
+    # at any x so we can bisect on the (angle-aware) center line.
+    ordered = sorted(by_strip, key=lambda strip: strip.reference_y)
+    ordered_pairs = [by_strip[strip] for strip in ordered]
+    ref_x = np.array([strip.reference_x for strip in ordered], dtype=float)
+    ref_y = np.array([strip.reference_y for strip in ordered], dtype=float)
+    angles = np.array([strip.angle for strip in ordered], dtype=float)
+    slopes = np.tan(angles)
+    # vertical half-height of a tilted band
+    half_heights = (cell_size / 2) / np.cos(angles)
+
+    def center_y(j, x):
+        return ref_y[j] + slopes[j] * (x - ref_x[j])
+
+    def locate(x, y):
+        """Index into the ordered strips of the band holding (x, y), or -1."""
+        x, y = _as_float_arrays(x, y)
+        n = len(ordered)
+        if n == 0:
+            return np.full(x.shape, -1)
+
+        # vectorized bisection for the first center line above y
+        lo = np.zeros(x.shape, dtype=int)
+        hi = np.full(x.shape, n)
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            below = center_y(np.minimum(mid, n - 1), x) <= y
+            lo = np.where(active & below, mid + 1, lo)
+            hi = np.where(active & ~below, mid, hi)
+            active = lo < hi
+
+        # the closest center line is either just below or just above
+        j_below = np.clip(lo - 1, 0, n - 1)
+        j_above = np.clip(lo, 0, n - 1)
+        dist_below = np.abs(y - center_y(j_below, x))
+        dist_above = np.abs(y - center_y(j_above, x))
+        j = np.where(dist_below <= dist_above, j_below, j_above)
+        dist = np.minimum(dist_below, dist_above)
+
+        return np.where(dist < half_heights[j], j, -1)
+
     def forward(Ti_frac, temperature, annealing_time, thickness):
-        candidates = by_annealing[(temperature, annealing_time, thickness)]
+        candidates = by_annealing.get((temperature, annealing_time, thickness), ())
 
         # we need to find a strip that has the right Ti_frac available
-        for strip, pair in candidates:
-            if strip.ti_min <= Ti_frac <= strip.ti_max:
+        for ti_min, ti_max, pair in candidates:
+            if ti_min <= Ti_frac <= ti_max:
                 return pair.forward(Ti_frac, temperature, annealing_time, thickness)
         else:
             # get here if we don't find a valid strip!
+            if debug:
+                print(
+                    f"no strip for {(Ti_frac, temperature, annealing_time, thickness)}"
+                )
             raise ValueError
 
     def inverse(x, y):
-        # the y value fully determines what strip we are in
-        for strip, pair in by_strip.items():
-            if (
-                strip.reference_y - cell_size / 2
-                < y
-                < strip.reference_y + cell_size / 2
-            ):
-                return pair.inverse(x, y)
-            else:
-                print(f"rejected {strip}")
-
-        else:
+        # the y value (at this x) fully determines what strip we are in
+        j = int(locate(x, y))
+        if j < 0:
+            if debug:
+                print(f"no strip at {(x, y)}")
             raise ValueError
+        return ordered_pairs[j].inverse(x, y)
+
+    def forward_many(Ti_frac, temperature, annealing_time, thickness):
+        Ti_frac, temperature, annealing_time, thickness = _as_float_arrays(
+            Ti_frac, temperature, annealing_time, thickness
+        )
+        x = np.full(Ti_frac.shape, np.nan)
+        y = np.full(Ti_frac.shape, np.nan)
+        valid = np.zeros(Ti_frac.shape, dtype=bool)
+
+        for (temp, time, thick), candidates in by_annealing.items():
+            on_key = (
+                (temperature == temp)
+                & (annealing_time == time)
+                & (thickness == thick)
+            )
+            # first strip (in input order) with the Ti fraction wins
+            for ti_min, ti_max, pair in candidates:
+                todo = on_key & ~valid & (ti_min <= Ti_frac) & (Ti_frac <= ti_max)
+                if not todo.any():
+                    continue
+                x[todo], y[todo], valid[todo] = pair.forward_many(
+                    Ti_frac[todo],
+                    temperature[todo],
+                    annealing_time[todo],
+                    thickness[todo],
+                )
+
+        if debug and not valid.all():
+            print(f"no strip for {np.count_nonzero(~valid)} of {valid.size} points")
+
+        return x, y, valid
+
+    def inverse_many(x, y):
+        x, y = _as_float_arrays(x, y)
+        out = [np.full(x.shape, np.nan) for _ in range(4)]
+        valid = np.zeros(x.shape, dtype=bool)
+
+        owner = locate(x, y)
+        for j in np.unique(owner[owner >= 0]):
+            todo = owner == j
+            *coords, valid[todo] = ordered_pairs[j].inverse_many(x[todo], y[todo])
+            for target, values in zip(out, coords):
+                target[todo] = values
 
-    return TransformPair(forward, inverse)
+        if debug and not valid.all():
+            print(f"no strip at {np.count_nonzero(~valid)} of {valid.size} points")
+
+        return (*out, valid)
+
+    return TransformPair(forward, inverse, forward_many, inverse_many)
 
 
 def snap_factory(strip_list, *, temp_tol=None, time_tol=None, Ti_tol=None):
@@ -283,66 +714,519 @@ def snap_factory(strip_list, *, temp_tol=None, time_tol=None, Ti_tol=None):
 
     Returns
     -------
-    snap_function
+    snap_function : StripSnapper
 
        has signature ::
 
-          def snap(Ti, temperature, time):
-              returns snapped_Ti, snapped_temperature, snapped_time
+          def snap(Ti, temperature, time, thickness):
+              returns snapped_Ti, snapped_temperature, snapped_time, snapped_thickness
+
+       and a ``snap_many(points)`` method for arrays of points.
     """
+    return StripSnapper(strip_list, temp_tol=temp_tol, time_tol=time_tol, Ti_tol=Ti_tol)
 
-    # make local copy to be safe!
-    strips = tuple(strip_list)
 
-    def snap(Ti, temperature, annealing_time, thickness):
-        l_strips = strips
+class StripSnapper:
+    """
+    Snap requested points to the closest strip in (temperature, time).
 
-        thickness = int(np.clip(np.round(thickness), 0, 1))
+    The look up tables are built once per layout: the strips are split
+    by thickness and sorted by temperature so that the temperature
+    tolerance is a range query and only the strips inside the window
+    are compared.  For layouts of up to ``scan_max_strips`` strips (the
+    real wafers) a single point is snapped with a plain scan over
+    pre-extracted tuples, which beats the numpy overhead there.
 
-        l_strips = filter(lambda x: x.thickness == thickness, l_strips)
+    Parameters
+    ----------
+    strip_list : List[StripInfo]
 
-        # only consider strips close enough in temperature
-        if temp_tol is not None:
-            l_strips = filter(
-                lambda x: abs(x.temperature - temperature) < temp_tol, l_strips
+    temp_tol, time_tol, Ti_tol : float, optional
+       If not None, only snap to strips with in tolerance range
+    """
+
+    # bound the size of the (points x strips) scratch arrays in snap_many
+    chunk_elements = 1_000_000
+    # below this many strips __call__ scans instead of using the tables
+    scan_max_strips = 64
+
+    def __init__(self, strip_list, *, temp_tol=None, time_tol=None, Ti_tol=None):
+        # make local copy to be safe!
+        self.strips = tuple(strip_list)
+        self.temp_tol = temp_tol
+        self.time_tol = time_tol
+        self.Ti_tol = Ti_tol
+        self.tols = {
+            k: v
+            for k, v in zip(["temp", "time", "Ti"], [temp_tol, time_tol, Ti_tol])
+            if v is not None
+        }
+
+        self._tables = {}
+        for thickness in (0, 1):
+            index = np.array(
+                [j for j, strip in enumerate(self.strips) if strip.thickness == thickness],
+                dtype=int,
             )
-        # only consider strips close enough in annealing time
-        if time_tol is not None:
-            l_strips = filter(
-                lambda x: abs(x.annealing_time - annealing_time) < time_tol, l_strips
+            table = {
+                "index": index,
+                "temperature": np.array(
+                    [self.strips[j].temperature for j in index], dtype=float
+                ),
+                "annealing_time": np.array(
+                    [self.strips[j].annealing_time for j in index], dtype=float
+                ),
+                "ti_min": np.array([self.strips[j].ti_min for j in index], dtype=float),
+                "ti_max": np.array([self.strips[j].ti_max for j in index], dtype=float),
+            }
+            # stable sort so ties keep the input order
+            order = np.argsort(table["temperature"], kind="stable")
+            self._tables[thickness] = {
+                "by_index": table,
+                "by_temperature": {k: v[order] for k, v in table.items()},
+                # (temperature, annealing_time, ti_min, ti_max, index) in
+                # input order, for the plain scan
+                "rows": [
+                    (s.temperature, s.annealing_time, s.ti_min, s.ti_max, j)
+                    for j, s in zip(index, (self.strips[j] for j in index))
+                ],
+            }
+        self._strip_ti_min = np.array([s.ti_min for s in self.strips], dtype=float)
+        self._strip_ti_max = np.array([s.ti_max for s in self.strips], dtype=float)
+        self._strip_keys = np.array(
+            [(s.temperature, s.annealing_time, s.thickness) for s in self.strips],
+            dtype=float,
+        ).reshape(-1, 3)
+
+    def __call__(self, Ti, temperature, annealing_time, thickness):
+        thickness = min(max(int(round(thickness)), 0), 1)
+        if len(self.strips) <= self.scan_max_strips:
+            closest = self._closest_scan
+        else:
+            closest = self._closest
+        # try with the other thickness if nothing is in tolerance
+        for thick in (thickness, 1 - thickness):
+            best = closest(thick, Ti, temperature, annealing_time)
+            if best is not None:
+                break
+        else:
+            raise ValueError(
+                f"No strip in tolerance of {(Ti, temperature, annealing_time)}"
             )
 
+        # clip Ti fraction to be within the selected strip
+        best_Ti = min(max(Ti, best.ti_min + 1.0), best.ti_max - 1.0)
+
+        return best_Ti, best.temperature, best.annealing_time, best.thickness
+
+    def _closest_scan(self, thickness, Ti, temperature, annealing_time):
+        temp_tol, time_tol, Ti_tol = self.temp_tol, self.time_tol, self.Ti_tol
+        best, best_dist = None, None
+        for temp, time_, ti_min, ti_max, j in self._tables[thickness]["rows"]:
+            if temp_tol is not None and not abs(temp - temperature) < temp_tol:
+                continue
+            if time_tol is not None and not abs(time_ - annealing_time) < time_tol:
+                continue
+            if Ti_tol is not None and not (ti_min - Ti_tol <= Ti <= ti_max + Ti_tol):
+                continue
+            # ties go to the first strip in the input
+            dist = math.hypot(temp - temperature, time_ - annealing_time)
+            if best_dist is None or dist < best_dist:
+                best, best_dist = j, dist
+        return None if best is None else self.strips[best]
+
+    def _closest(self, thickness, Ti, temperature, annealing_time):
+        table = self._tables[thickness]["by_temperature"]
+        temps = table["temperature"]
+
+        # only consider strips close enough in temperature
+        lo, hi = 0, len(temps)
+        if self.temp_tol is not None:
+            lo = np.searchsorted(temps, temperature - self.temp_tol, side="left")
+            hi = np.searchsorted(temps, temperature + self.temp_tol, side="right")
+        if lo >= hi:
+            return None
+        window = {k: v[lo:hi] for k, v in table.items()}
+
+        ok = np.ones(hi - lo, dtype=bool)
+        # the range query is inclusive, re-apply the exact test
+        if self.temp_tol is not None:
+            ok &= np.abs(window["temperature"] - temperature) < self.temp_tol
+        # only consider strips close enough in annealing time
+        if self.time_tol is not None:
+            ok &= np.abs(window["annealing_time"] - annealing_time) < self.time_tol
         # only consider strips with Ti fractions that are with in tolerance
-        if Ti_tol is not None:
-            l_strips = filter(
-                lambda x: x.ti_min - Ti_tol <= Ti <= x.ti_max + Ti_tol, l_strips
+        if self.Ti_tol is not None:
+            ok &= (window["ti_min"] - self.Ti_tol <= Ti) & (
+                Ti <= window["ti_max"] + self.Ti_tol
             )
+        if not ok.any():
+            return None
+
+        # Use an L2 norm to sort out what strips are "closest" in
+        # (Temp, time) space, ties go to the first strip in the input
+        dist = np.hypot(
+            window["temperature"][ok] - temperature,
+            window["annealing_time"][ok] - annealing_time,
+        )
+        index = window["index"][ok]
+        return self.strips[index[dist == dist.min()].min()]
+
+    def snap_many(self, points):
+        """
+        Snap an array of points.
+
+        Parameters
+        ----------
+        points : array-like, shape (N, 4)
+           Rows of (Ti, temperature, annealing_time, thickness)
+
+        Returns
+        -------
+        snapped : ndarray, shape (N, 4)
+           The snapped points, NaN where nothing is in tolerance
+
+        valid : ndarray[bool], shape (N,)
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        Ti, temperature, annealing_time, thickness = points.T
+        thickness = np.clip(np.round(thickness), 0, 1).astype(int)
+
+        best = np.full(len(points), -1)
+        for attempt in (0, 1):
+            for thick in (0, 1):
+                todo = (best < 0) & (thickness == (thick if attempt == 0 else 1 - thick))
+                if todo.any():
+                    best[todo] = self._closest_many(
+                        thick, Ti[todo], temperature[todo], annealing_time[todo]
+                    )
+
+        valid = best >= 0
+        snapped = np.full(points.shape, np.nan)
+        if valid.any():
+            b = best[valid]
+            snapped[valid, 0] = np.clip(
+                Ti[valid], self._strip_ti_min[b] + 1.0, self._strip_ti_max[b] - 1.0
+            )
+            snapped[valid, 1:] = self._strip_keys[b]
+
+        return snapped, valid
+
+    def _closest_many(self, thickness, Ti, temperature, annealing_time):
+        table = self._tables[thickness]["by_index"]
+        out = np.full(len(Ti), -1)
+        n_strips = len(table["index"])
+        if n_strips == 0:
+            return out
+
+        chunk = max(1, self.chunk_elements // n_strips)
+        for start in range(0, len(Ti), chunk):
+            sl = slice(start, start + chunk)
+            ti = Ti[sl, np.newaxis]
+            temp = temperature[sl, np.newaxis]
+            time = annealing_time[sl, np.newaxis]
+
+            ok = np.ones((len(ti), n_strips), dtype=bool)
+            if self.temp_tol is not None:
+                ok &= np.abs(table["temperature"] - temp) < self.temp_tol
+            if self.time_tol is not None:
+                ok &= np.abs(table["annealing_time"] - time) < self.time_tol
+            if self.Ti_tol is not None:
+                ok &= (table["ti_min"] - self.Ti_tol <= ti) & (
+                    ti <= table["ti_max"] + self.Ti_tol
+                )
 
-        # Us an L2 norm to sort out what strips are "closest" it
-        # (Temp, time) space
-        def l2_norm(strip):
-
-            return np.hypot(
-                strip.temperature - temperature, strip.annealing_time - annealing_time
+            dist = np.where(
+                ok,
+                np.hypot(table["temperature"] - temp, table["annealing_time"] - time),
+                np.inf,
             )
+            # the columns are in input order so argmin breaks ties the
+            # same way as the scalar path
+            j = np.argmin(dist, axis=1)
+            found = ok[np.arange(len(j)), j]
+            out[sl] = np.where(found, table["index"][j], -1)
+
+        return out
+
+
+def _snap_brute_force(strips, Ti, temperature, annealing_time, thickness, *, tols):
+    """Reference (linear scan) implementation of StripSnapper.__call__."""
+    temp_tol, time_tol, Ti_tol = (tols.get(k) for k in ("temp", "time", "Ti"))
+    thickness = int(np.clip(np.round(thickness), 0, 1))
+    for thick in (thickness, 1 - thickness):
+        candidates = [
+            strip
+            for strip in strips
+            if strip.thickness == thick
+            and (temp_tol is None or abs(strip.temperature - temperature) < temp_tol)
+            and (time_tol is None or abs(strip.annealing_time - annealing_time) < time_tol)
+            and (Ti_tol is None or strip.ti_min - Ti_tol <= Ti <= strip.ti_max + Ti_tol)
+        ]
+        if candidates:
+            break
+    else:
+        raise ValueError
+    best = min(
+        candidates,
+        key=lambda strip: np.hypot(
+            strip.temperature - temperature, strip.annealing_time - annealing_time
+        ),
+    )
+    best_Ti = np.clip(Ti, best.ti_min + 1.0, best.ti_max - 1.0)
+    return best_Ti, best.temperature, best.annealing_time, best.thickness
 
-        try:
-            best = min(l_strips, key=l2_norm)
-        except ValueError:
-            # try with the other thickness
-            return snap(Ti, temperature, annealing_time, {0: 1, 1: 0}[thickness])
-        # clip Ti fraction to be within the selected strip
-        best_Ti = np.clip(Ti, best.ti_min + 1.0, best.ti_max - 1.0)
 
-        return best_Ti, best.temperature, best.annealing_time, best.thickness
+def _random_snap_requests(n, *, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack(
+        [
+            rng.uniform(10, 85, n),
+            rng.uniform(300, 500, n),
+            rng.uniform(0, 4000, n),
+            rng.uniform(-0.5, 1.5, n),
+        ]
+    )
 
-    snap.tols = {
-        k: v
-        for k, v in zip(["temp", "time", "Ti"], [temp_tol, time_tol, Ti_tol])
-        if v is not None
-    }
 
-    return snap
+def benchmark_snap(strip_counts=(17, 170, 1700), n_points=1000, **tols):
+    """
+    Time snapping against the number of strips in the layout.
+
+    The first row is ``single_data`` itself, the real 17 strip layout.
+    Synthetic layouts are made by jittering the temperatures and times
+    of ``single_data``.  For each layout this prints the per-point time
+    of the linear scan, of ``StripSnapper`` and of
+    ``StripSnapper.snap_many``.
+    """
+    import time
+
+    tols = tols or {"temp_tol": 30, "time_tol": 1000, "Ti_tol": 5}
+    rng = np.random.default_rng(0)
+    requests = _random_snap_requests(n_points)
+    layouts = [("real", list(single_data))] + [
+        (
+            str(n_strips),
+            [
+                StripInfo(
+                    **{
+                        **asdict(single_data[j % len(single_data)]),
+                        "temperature": int(rng.integers(300, 500)),
+                        "annealing_time": int(rng.integers(0, 4000)),
+                    }
+                )
+                for j in range(n_strips)
+            ],
+        )
+        for n_strips in strip_counts
+    ]
+    print(f"{'strips':>8} {'linear':>12} {'snapper':>12} {'snap_many':>12}")
+    for label, strips in layouts:
+        snapper = StripSnapper(strips, **tols)
+
+        timings = []
+        for func in (
+            lambda p: _snap_brute_force(strips, *p, tols=snapper.tols),
+            lambda p: snapper(*p),
+        ):
+            t0 = time.perf_counter()
+            for p in requests:
+                try:
+                    func(p)
+                except ValueError:
+                    pass
+            timings.append((time.perf_counter() - t0) / n_points)
+        t0 = time.perf_counter()
+        snapper.snap_many(requests)
+        timings.append((time.perf_counter() - t0) / n_points)
+
+        print(f"{label:>8} " + " ".join(f"{t * 1e6:>10.1f}us" for t in timings))
+
+
+StripCalibration = namedtuple(
+    "StripCalibration", ["strips", "slopes", "intercepts", "residuals", "rms"]
+)
+
+
+def fit_strip_lines(strip_index, x, y, *, n_strips=None):
+    """
+    Fit a line through the measured centers of every strip at once.
+
+    Each strip may have any number (>= 2 distinct x) of measurements.
+    The per-strip 2x2 normal equations (in x centered per strip) are
+    assembled with ``np.bincount`` and solved as one batch.
+
+    Parameters
+    ----------
+    strip_index : array[int]
+        Which strip each measurement belongs to
+
+    x, y : array[float]
+        The measured strip centers in beamline coordinates
+
+    n_strips : int, optional
+        Defaults to ``max(strip_index) + 1``
+
+    Returns
+    -------
+    slopes, intercepts : array[float]
+        y = slope * x + intercept, one per strip
+
+    residuals : array[float]
+        y - fit for every measurement
+
+    rms : array[float]
+        The root mean square residual per strip
+    """
+    strip_index = np.asarray(strip_index, dtype=int)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if n_strips is None:
+        n_strips = strip_index.max() + 1
+
+    counts = np.bincount(strip_index, minlength=n_strips)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.bincount(strip_index, x, minlength=n_strips) / counts
+        y_mean = np.bincount(strip_index, y, minlength=n_strips) / counts
+    xc = x - x_mean[strip_index]
+    yc = y - y_mean[strip_index]
+
+    normal = np.zeros((n_strips, 2, 2))
+    normal[:, 0, 0] = np.bincount(strip_index, xc * xc, minlength=n_strips)
+    normal[:, 0, 1] = normal[:, 1, 0] = np.bincount(strip_index, xc, minlength=n_strips)
+    normal[:, 1, 1] = counts
+    rhs = np.stack(
+        [
+            np.bincount(strip_index, xc * yc, minlength=n_strips),
+            np.bincount(strip_index, yc, minlength=n_strips),
+        ],
+        axis=-1,
+    )
+
+    degenerate = np.flatnonzero(normal[:, 0, 0] == 0)
+    if len(degenerate):
+        raise ValueError(
+            f"strips {degenerate.tolist()} need measurements at 2 or more x positions"
+        )
+
+    slopes, offsets = np.linalg.solve(normal, rhs[..., np.newaxis])[..., 0].T
+    intercepts = y_mean + offsets - slopes * x_mean
+
+    residuals = y - (slopes[strip_index] * x + intercepts[strip_index])
+    rms = np.sqrt(np.bincount(strip_index, residuals**2, minlength=n_strips) / counts)
+
+    return slopes, intercepts, residuals, rms
+
+
+def calibrate_strip_layout(
+    template, strip_index, x, y, *, ref_x, thicknesses=None, fname=None
+):
+    """
+    Solve for the angle and offset of every strip from measured centers.
+
+    Parameters
+    ----------
+    template : List[StripInfo]
+        The strips in the same order as *strip_index* counts them.  The
+        geometry is replaced, everything else is kept.
+
+    strip_index, x, y : array
+        Measured strip centers, see `fit_strip_lines`
+
+    ref_x : float
+        The x position of the reference point of every strip
+
+    thicknesses : List[int], optional
+        If given, replaces the thickness of the strips
+
+    fname : str or Path, optional
+        If given, write the new layout to this json file
+
+    Returns
+    -------
+    StripCalibration
+    """
+    slopes, intercepts, residuals, rms = fit_strip_lines(
+        strip_index, x, y, n_strips=len(template)
+    )
+    if thicknesses is None:
+        thicknesses = [strip.thickness for strip in template]
+
+    strips = [
+        StripInfo(
+            **{
+                **asdict(strip),
+                "angle": float(np.arctan2(slope, 1)),
+                "reference_x": ref_x,
+                "reference_y": float(ref_x * slope + intercept),
+                "thickness": thickness,
+            }
+        )
+        for strip, slope, intercept, thickness in zip(
+            template, slopes, intercepts, thicknesses
+        )
+    ]
+    if fname is not None:
+        strip_list_to_json(strips, fname)
+
+    return StripCalibration(strips, slopes, intercepts, residuals, rms)
+
+
+def strip_centers_from_edge_scan(position, signal, *, threshold=None):
+    """
+    Find the strip centers crossed by a scan perpendicular to the strips.
+
+    The signal is thresholded (half way between its extremes by default)
+    and the center of each run above the threshold is returned.
+
+    Parameters
+    ----------
+    position, signal : array
+        The scanned motor position and the detector reading
+
+    threshold : float, optional
+
+    Returns
+    -------
+    centers : array[float]
+        sorted along *position*
+    """
+    order = np.argsort(position)
+    position = np.asarray(position, dtype=float)[order]
+    signal = np.asarray(signal, dtype=float)[order]
+    if threshold is None:
+        threshold = (np.min(signal) + np.max(signal)) / 2
+
+    on = np.concatenate([[False], signal > threshold, [False]])
+    edges = np.flatnonzero(np.diff(on.astype(int)))
+    starts, stops = edges[::2], edges[1::2] - 1
+
+    return (position[starts] + position[stops]) / 2
+
+
+def edge_scans_to_centers(scans):
+    """
+    Flatten several edge scans into the input of `calibrate_strip_layout`.
+
+    Parameters
+    ----------
+    scans : Iterable[Tuple[float, array]]
+        (x position of the scan, strip centers sorted along y) pairs.  The
+        j-th center of every scan is taken to be strip j.
+
+    Returns
+    -------
+    strip_index, x, y : array
+    """
+    strip_index, x, y = [], [], []
+    for scan_x, centers in scans:
+        centers = np.asarray(centers, dtype=float)
+        keep = np.isfinite(centers)
+        strip_index.append(np.flatnonzero(keep))
+        x.append(np.full(np.count_nonzero(keep), scan_x, dtype=float))
+        y.append(centers[keep])
+
+    return np.concatenate(strip_index), np.concatenate(x), np.concatenate(y)
 
 
 # this is to do the data-entry on the temperature, annealing time,
@@ -534,73 +1418,226 @@ mpos = np.array(
 ).T
 sampled_x = [35, 60, 85]
 
-# fit the above to a line
-fits = [scipy.stats.linregress(sampled_x, m) for m in mpos]
 # get the 0 we need to make the start_distance's above make sense
 ref_x = 95 - 1.25
+_thicknesses = [0] * 9 + [1] * 8
+
 
-# generate the data by zipping the template + the fit angle and offsets
-single_data = [
-    StripInfo(**{**asdict(strip), **measured, "thickness": thickness})
-    for strip, measured, thickness in zip(
+def _fit_single_data():
+    # fit the above to a line and zip the template with the fit angle and offsets
+    return calibrate_strip_layout(
         _layout_template,
+        *edge_scans_to_centers(zip(sampled_x, mpos.T)),
+        ref_x=ref_x,
+        thicknesses=_thicknesses,
+    ).strips
+
+
+# only re-fit when the measured data or the template change, see
+# LAYOUT_FORMAT_VERSION for changes to the fit itself
+single_data = cached_layout(
+    "single_data",
+    layout_hash(_layout_template, mpos, sampled_x, ref_x, _thicknesses),
+    _fit_single_data,
+)
+
+
+def layout_cell_geometry(strip_list, *, cell_size=4.5):
+    """
+    Compute the center and corners of every cell of a layout.
+
+    Parameters
+    ----------
+    strip_list : List[StripInfo] or Mapping[str, np.ndarray]
+        Or a compiled layout, as returned by `compile_layout` or
+        `load_compiled_layout`
+
+    cell_size : float, optional
+        Ignored for a compiled layout, which has its own
+
+    Returns
+    -------
+    centers : array, shape (n_cells, 2)
+    corners : array, shape (n_cells, 4, 2)
+    ti_fractions : array, shape (n_cells,)
+    strip_index : array[int], shape (n_cells,)
+    """
+    if isinstance(strip_list, dict):
+        layout = strip_list
+        cell_size = float(layout["cell_size"])
+    else:
+        layout = compile_layout(strip_list, cell_size=cell_size)
+    offsets = layout["ti_offsets"]
+    strip_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    angle = layout["angle"][strip_index]
+    # distance along the strip, as in single_strip_transform_factory
+    d = (
+        layout["cell_positions"]
+        - layout["start_distance"][strip_index]
+        + (cell_size / 2)
+    )
+    cos, sin = np.cos(angle), np.sin(angle)
+    centers = np.stack(
         [
-            {
-                "angle": np.arctan2(f.slope, 1),
-                "reference_x": ref_x,
-                "reference_y": ref_x * f.slope + f.intercept,
-            }
-            for f in fits
+            layout["reference_x"][strip_index] - cos * d,
+            layout["reference_y"][strip_index] - sin * d,
         ],
-        [0] * 9 + [1] * 8,
+        axis=-1,
     )
-]
+    # unit vectors along and across the strip
+    along = np.stack([cos, sin], axis=-1)[:, np.newaxis, :]
+    across = np.stack([-sin, cos], axis=-1)[:, np.newaxis, :]
+    signs = np.array([(-1, -1), (1, -1), (1, 1), (-1, 1)]) * (cell_size / 2)
+    corners = (
+        centers[:, np.newaxis, :]
+        + signs[np.newaxis, :, 0, np.newaxis] * along
+        + signs[np.newaxis, :, 1, np.newaxis] * across
+    )
+
+    return centers, corners, layout["ti_fractions"], strip_index
+
+
+class LayoutView:
+    """
+    Handle on a drawn layout to recolor the cells in place.
+
+    Made by `show_layout`.
+    """
+
+    def __init__(self, ax, collection, centers, strip_index, labels, strip_labels):
+        self.ax = ax
+        self.collection = collection
+        self.centers = centers
+        self.strip_index = strip_index
+        self.labels = labels
+        self.strip_labels = strip_labels
+        self.values = np.array(collection.get_array(), dtype=float)
+
+    def set_values(self, values):
+        """Recolor every cell, NaN cells are drawn in the 'bad' color."""
+        self.values = np.array(values, dtype=float)
+        self.collection.set_array(np.ma.masked_invalid(self.values))
+        self.ax.figure.canvas.draw_idle()
+
+    def update_at(self, x, y, values):
+        """
+        Recolor the cells closest to the (x, y) beamline positions.
+
+        Intended for live progress maps, for example with measured
+        intensities as the points come in.
+        """
+        x, y, values = np.broadcast_arrays(
+            *(np.asarray(a, dtype=float) for a in (x, y, values))
+        )
+        x, y, values = x.ravel(), y.ravel(), values.ravel()
+        dist = np.hypot(
+            self.centers[:, 0] - x[:, np.newaxis],
+            self.centers[:, 1] - y[:, np.newaxis],
+        )
+        self.values[np.argmin(dist, axis=1)] = values
+        self.set_values(self.values)
+
+
+def live_layout_callback(view, *, x_key, y_key, value_key):
+    """
+    Make a document callback that recolors a LayoutView as data comes in.
+
+    Example
+    -------
+    >>> view = show_layout(single_data, label_every=0)
+    >>> RE(adaptive_plan(...), live_layout_callback(
+    ...     view, x_key="sample_x", y_key="sample_y",
+    ...     value_key="pe1c_stats1_total"))
+    """
+
+    def update(name, doc):
+        if name != "event":
+            return
+        data = doc["data"]
+        if all(k in data for k in (x_key, y_key, value_key)):
+            view.update_at(data[x_key], data[y_key], data[value_key])
 
+    return update
 
-def show_layout(strip_list, ax=None, *, cell_size=4.5):
-    """Make a nice plot of the strip layout."""
+
+def show_layout(
+    strip_list,
+    ax=None,
+    *,
+    cell_size=4.5,
+    label_every=1,
+    annotate_strips=True,
+    values=None,
+    norm=None,
+):
+    """
+    Make a nice plot of the strip layout.
+
+    All of the cells are drawn as a single PolyCollection.
+
+    Parameters
+    ----------
+    strip_list : List[StripInfo]
+
+    ax : Axes, optional
+
+    cell_size : float, optional
+
+    label_every : int, optional
+        Label every n-th cell of each strip with its Ti fraction, 0 for
+        no cell labels.
+
+    annotate_strips : bool, optional
+        Label each strip with its temperature and annealing time.  Text
+        dominates the draw time, so turn the labels off for large
+        libraries that are redrawn live.
+
+    values : array, optional
+        Color the cells by these (one per cell in strip order) rather
+        than by the Ti fraction.
+
+    norm : Normalize, optional
+        Defaults to 0-100 for the Ti fraction, autoscaled for *values*.
+
+    Returns
+    -------
+    LayoutView
+    """
     if ax is None:
         import matplotlib.pyplot as plt
 
         fig, ax = plt.subplots()
 
-    cmap = mcm.get_cmap("magma")
-    norm = mcolors.Normalize(0, 100)
-    state_map = {0: "thick", 1: "thin"}
-    cells = {}
-    labels = {}
-    for strip in strip_list:
-        cells[strip] = []
-        pair = single_strip_transform_factory(*astuple(strip))
-        for j, ti_frac in enumerate(strip.ti_fractions):
-            color = cmap(norm(ti_frac))
-            x, y = pair.forward(
-                ti_frac, strip.temperature, strip.annealing_time, strip.thickness
-            )
-            d = strip.start_distance - j * cell_size
-            rect = mpatches.Rectangle(
-                (
-                    x - cell_size / 2,
-                    y - cell_size / 2,
-                ),
-                cell_size,
-                cell_size,
-                color=color,
-            )
-            ax.add_patch(rect)
-            cells[strip].append(
-                ax.text(
-                    x,
-                    y,
-                    f"{ti_frac}",
-                    ha="center",
-                    va="center",
-                    color="w",
-                )
+    centers, corners, ti_fractions, strip_index = layout_cell_geometry(
+        strip_list, cell_size=cell_size
+    )
+    if values is None:
+        values = ti_fractions
+        if norm is None:
+            norm = mcolors.Normalize(0, 100)
+
+    cells = mcollections.PolyCollection(
+        corners, cmap="magma", norm=norm, edgecolors="face"
+    )
+    cells.set_array(np.ma.masked_invalid(np.asarray(values, dtype=float)))
+    ax.add_collection(cells)
+
+    labels = []
+    if label_every:
+        # position of each cell with in its strip
+        cell_number = np.arange(len(centers)) - np.searchsorted(
+            strip_index, strip_index
+        )
+        labeled = cell_number % label_every == 0
+        for (x, y), ti_frac in zip(centers[labeled], ti_fractions[labeled]):
+            labels.append(
+                ax.text(x, y, f"{ti_frac:g}", ha="center", va="center", color="w")
             )
-            cells[strip].append(rect)
+
+    strip_labels = {}
+    for strip in strip_list if annotate_strips else ():
         d = cell_size * (len(strip.ti_fractions) - 0.5) - strip.start_distance
-        labels[strip] = ax.annotate(
+        strip_labels[strip] = ax.annotate(
             f"{strip.temperature}°C\n{strip.annealing_time}s",
             xy=(
                 strip.reference_x - d - cell_size / 2,
@@ -623,6 +1660,8 @@ def show_layout(strip_list, ax=None, *, cell_size=4.5):
     ax.invert_xaxis()
     ax.set_aspect("equal")
 
+    return LayoutView(ax, cells, centers, strip_index, labels, strip_labels)
+
 
 if False:
     import matplotlib.pyplot as plt
@@ -648,3 +1687,41 @@ def test_stip():
             )
             ret = pair.inverse(np.round(x, 2), y)
             assert np.allclose(start, ret, atol=0.01)
+
+
+def test_strip_many():
+    pair = single_strip_set_transform_factory(single_data)
+    for strip in single_data:
+        ti = np.asarray(strip.ti_fractions[1:-1], dtype=float)
+        keys = (strip.temperature, strip.annealing_time, strip.thickness)
+        x, y, valid = pair.forward_many(ti, *keys)
+        assert valid.all()
+        *ret, valid = pair.inverse_many(np.round(x, 2), y)
+        for j, ti_frac in enumerate(ti):
+            assert np.allclose(pair.forward(ti_frac, *keys), (x[j], y[j]))
+            try:
+                expected = pair.inverse(np.round(x[j], 2), y[j])
+            except ValueError:
+                assert not valid[j]
+            else:
+                assert valid[j]
+                assert np.allclose([r[j] for r in ret], expected)
+
+    # infeasible requests are masked rather than raising
+    x, y, valid = pair.forward_many([-1, 200], 340, 450, 0)
+    assert not valid.any() and np.isnan(x).all() and np.isnan(y).all()
+
+
+def test_snap():
+    snap = snap_factory(single_data, temp_tol=30, time_tol=1000, Ti_tol=5)
+    requests = _random_snap_requests(500)
+    snapped, valid = snap.snap_many(requests)
+    for p, row, ok in zip(requests, snapped, valid):
+        try:
+            expected = _snap_brute_force(single_data, *p, tols=snap.tols)
+        except ValueError:
+            assert not ok
+            continue
+        assert ok
+        assert np.allclose(snap(*p), expected)
+        assert np.allclose(row, expected)
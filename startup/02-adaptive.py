@@ -1,11 +1,19 @@
 """Plan for running pgcam AE with a gradient TiCu sample."""
 import uuid
 import itertools
+import threading
 import time
+from contextlib import contextmanager
 
 import numpy as np
 
 from ophyd import Device, Signal, Component as Cpt
+from ophyd.pseudopos import (
+    PseudoPositioner,
+    PseudoSingle,
+    pseudo_position_argument,
+    real_position_argument,
+)
 
 import bluesky.preprocessors as bpp
 import bluesky.plan_stubs as bps
@@ -125,7 +133,9 @@ def _xpd_pre_plan(dets, exposure):
         )
         return num_frame, acq_time, computed_exposure
 
-    # setting up area_detector
+    # setting up area_detector, skipped if nothing changed since the last
+    # time, see AreaDetectorConfigCache
+    configure_area_det = ad_config_cache.wrap(configure_area_det)
     for ad in (d for d in dets if hasattr(d, "cam")):
         (num_frame, acq_time, computed_exposure) = yield from configure_area_det(
             ad, exposure
@@ -170,6 +180,74 @@ def rocking_ct(dets, exposure, motor, start, stop, *, num=1, md=None):
     return (yield from future_count(dets, md=_md, per_shot=per_shot, num=num))
 
 
+def continuous_rocking_ct(dets, exposure, motor, start, stop, *, num=1, md=None):
+    """
+    Take a count while continuously "rocking" the y-position.
+
+    Unlike `rocking_ct` the velocity is set once for the whole run (one
+    sweep per exposure) and each shot only turns the motor around, so
+    there is no velocity change or reset per shot.  Each
+    event records the extent of the motion, the phase at the start of
+    the shot and the number of turn-arounds from the timestamped motor
+    readback, over the time span of the detector reading.
+    """
+    _md = md or {}
+    sp_md = yield from _xpd_pre_plan(dets, exposure)
+    _md.update(sp_md)
+    _md["rocking"] = {"mode": "continuous", "start": start, "stop": stop}
+    shot_time = sp_md["sp"]["computed_exposure"]
+
+    rocking = _RockingRecorder(motor, start, stop, name=f"{motor.name}_rocking")
+    target = stop
+    sweep = None
+
+    def per_shot(dets):
+        nonlocal target, sweep
+        # turn around: a sweep takes one exposure so by now it is (about)
+        # over.  The RunEngine stops the motor on a pause, the replayed
+        # shot then starts a new sweep from wherever it stopped.
+        if sweep is not None:
+            yield from bps.wait(group=sweep)
+        sweep = short_uid("rock")
+        yield from bps.abs_set(motor, target, group=sweep)
+        target = start if target == stop else stop
+        grp = short_uid("trigger")
+        for det in dets:
+            yield from bps.trigger(det, group=grp)
+        yield from bps.wait(group=grp)
+        yield from bps.create("primary")
+        t_end = None
+        for obj in dets:
+            reading = yield from bps.read(obj)
+            for v in (reading or {}).values():
+                t_end = v["timestamp"] if t_end is None else max(t_end, v["timestamp"])
+        # the detector and motor timestamps both come from the IOCs
+        rocking.window = None if t_end is None else (t_end - shot_time, t_end)
+        yield from bps.read(rocking)
+        yield from bps.save()
+
+    def start_rocking():
+        yield from bps.mv(motor, start)
+        yield from bps.mv(motor.velocity, abs(stop - start) / exposure)
+        rocking.start()
+
+    def stop_rocking():
+        rocking.halt()
+        yield from bps.stop(motor)
+
+    @bpp.reset_positions_decorator([motor.velocity])
+    def inner():
+        yield from start_rocking()
+        return (
+            yield from bpp.finalize_wrapper(
+                future_count(dets, md=_md, per_shot=per_shot, num=num),
+                stop_rocking(),
+            )
+        )
+
+    return (yield from inner())
+
+
 def stepping_ct(dets, exposure, motor, start, stop, *, md=None, num=3):
     """Take data at several points along the y-direction"""
     _md = md or {}
@@ -186,8 +264,9 @@ def adaptive_plan(
     to_recommender,
     from_recommender,
     md=None,
-    transform_pair,
-    real_motors,
+    transform_pair=None,
+    real_motors=None,
+    wafer=None,
     snap_function=None,
     reccomender_timeout=1,
     exposure=30,
@@ -195,6 +274,13 @@ def adaptive_plan(
     take_data=rocking_ct,
     num=None,
     rocking_range=2,
+    pipeline=False,
+    batch=False,
+    timing_stream=False,
+    fidelities=None,
+    default_fidelity=None,
+    time_budget=12 * 60 * 60,
+    cost_model=None,
 ):
     """
     Execute an adaptive scan using an inter-run recommendation engine.
@@ -258,6 +344,14 @@ def adaptive_plan(
           def inverse(x, y):
                return Ti_frac, temperature, annealing_time
 
+    real_motors : (x_motor, y_motor)
+
+    wafer : PseudoPositioner, optional
+        Made by `wafer_positioner_factory`, replaces *real_motors* and
+        *transform_pair* (and the soft pseudo axes).  Each step is then
+        one move in data coordinates and the pseudo positions are read
+        from the wafer itself.
+
     snap_function : Callable, optional
         "snaps" the requested measurement to the nearest available point ::
 
@@ -269,16 +363,79 @@ def adaptive_plan(
         How long to wait for the reccomender to respond before giving
         it up for dead.
 
+    pipeline : bool, optional
+
+        If True, overlap the recommender with the acquisition.  A
+        background thread watches the queue while *take_data* runs
+        (including while it blocks on a trigger or wait) so a
+        recommendation made from the partial (per-event) results is
+        picked up as soon as it is posted, snapped and transformed during
+        the exposure, and the motors move as soon as the exposure ends.
+        The latest recommendation wins.  The time spent waiting for the
+        recommender after the exposure, and how long before the end of
+        the exposure the first recommendation arrived, are recorded in
+        the ``adaptive_step`` metadata of the following run.
+
+    batch : bool, optional
+
+        If True, the recommender may post a list of points (and
+        *first_point* may be a list of points).  Every recommendation is
+        snapped and transformed in bulk and added to a queue of pending
+        points, which is re-ordered to minimize the x/y travel time from
+        the current position each time it is amended.  The plan only
+        blocks on the recommender when the queue runs dry.
+
+    timing_stream : bool, optional
+
+        If True, emit one more run at the end with a ``timing`` stream
+        holding the time spent in each phase of every step, see
+        `PhaseTimer`.  The pre-acquisition phases of each step are always
+        recorded in the ``timing`` metadata of its run and the totals are
+        printed at the end.
+
+    fidelities : dict[str, dict], optional
+
+        Named acquisition levels, for example a short screen and a long
+        confirmation ::
+
+           {"screen": {"exposure": 3}, "confirm": {"exposure": 30}}
+
+        Each level has an "exposure" and optionally a "num" (defaults to
+        *exposure* and *num*).  A recommendation may pick a level with a
+        "fidelity" key, otherwise *default_fidelity* (defaults to the
+        first level) is used.  The level is recorded in the
+        ``adaptive_step`` metadata.  The detector configuration of each
+        level is remembered by `AreaDetectorConfigCache` so switching
+        levels only puts the signals that differ.
+
+    default_fidelity : str, optional
+
+        The level used when the recommendation does not name one.
+
+    time_budget : float, optional
+
+        Seconds the plan may run for, 12 hours by default.  Before each
+        step its cost is predicted with *cost_model*.  If it does not fit
+        in what is left of the budget the most expensive fidelity level
+        that does fit is used instead, and if none does the plan stops.
+        The remaining budget and the predicted cost go in the
+        ``adaptive_step`` metadata (so the recommender can see them) and
+        the predicted and actual cost of every step is printed at the
+        end.
+
+    cost_model : CostModel, optional
+
+        The running estimates of the cost of a step, a fresh one is made
+        (from the motor velocities) by default.  Pass one in to carry the
+        estimates over between plans.
+
     """
 
+    ctrl, pseudo_axes, real_motors, transform_pair, readables = _pseudo_axes(
+        dets, wafer, real_motors, transform_pair
+    )
     # unpack the real motors
     x_motor, y_motor = real_motors
-    # make the soft pseudo axis
-    ctrl = Control(name="ctrl")
-    pseudo_axes = tuple(getattr(ctrl, k) for k in ctrl.component_names)
-    # convert the first_point variable to from we will be getting from
-    # queue
-    first_point = {m.name: v for m, v in zip(pseudo_axes, first_point)}
 
     _md = {
         "batch_id": str(uuid.uuid4()),
@@ -295,12 +452,71 @@ def adaptive_plan(
 
     _md.update(md or {})
 
-    take_data_kwargs = {}
-    if num is not None:
-        take_data_kwargs["num"] = num
+    if fidelities is None:
+        fidelities = {"default": {"exposure": exposure}}
+    if default_fidelity is None:
+        default_fidelity = next(iter(fidelities))
+    if default_fidelity not in fidelities:
+        raise ValueError(
+            f"default_fidelity {default_fidelity!r} is not one of {list(fidelities)}"
+        )
+    _md["ticu_adaptive"]["fidelities"] = fidelities
+
+    def fidelity_of(next_point):
+        """recommendation -> fidelity name"""
+        fidelity = next_point.get("fidelity", default_fidelity)
+        if fidelity not in fidelities:
+            print(f"unknown fidelity {fidelity!r}, using {default_fidelity!r}")
+            fidelity = default_fidelity
+        return fidelity
+
+    def level_of(fidelity):
+        """fidelity name -> (exposure, take_data kwargs)"""
+        level = fidelities[fidelity]
+        take_data_kwargs = {}
+        if level.get("num", num) is not None:
+            take_data_kwargs["num"] = level.get("num", num)
+        return level.get("exposure", exposure), take_data_kwargs
 
     plan_start_time = time.time()
-    plan_stop_time = plan_start_time + (12 * 60 * 60)
+    plan_stop_time = plan_start_time + time_budget
+
+    def resolve(next_point):
+        """recommendation -> (snapped data target, real target)"""
+        # extract the target position as a tuple
+        target = tuple(next_point[k.name] for k in pseudo_axes)
+        print(f"next point: {pprint.pformat(next_point)}")
+        # if we have a snapping function use it
+        if snap_function is not None:
+            target = snap_function(*target)
+        print(f"snapped target: {target}")
+        # compute the real target
+        real_target = transform_pair.forward(*target)
+        print(f"real target: {real_target}")
+        return target, real_target
+
+    def resolve_many(next_points):
+        """recommendations -> [(requested, snapped target, real target), ...]"""
+        if not next_points:
+            return []
+        requested = np.array(
+            [[p[k.name] for k in pseudo_axes] for p in next_points], dtype=float
+        )
+        targets, real_targets = _resolve_targets(
+            requested, snap_function, transform_pair
+        )
+        n_ok = sum(t is not None for t in targets)
+        print(f"{n_ok} of {len(next_points)} recommended points are reachable")
+        return [
+            (requested, target, real_target)
+            for requested, target, real_target in zip(
+                next_points, targets, real_targets
+            )
+            if target is not None
+        ]
+
+    velocities = np.ones(2)
+    timer = PhaseTimer()
 
     @bpp.subs_decorator(to_recommender)
     def gp_inner_plan():
@@ -312,40 +528,78 @@ def adaptive_plan(
             except Empty:
                 break
         uids = []
-        next_point = first_point
+        velocities[:] = yield from _read_velocities(real_motors)
+        costs = cost_model if cost_model is not None else CostModel(velocities)
+        position = (
+            (yield from _read_the_first_key(x_motor)),
+            (yield from _read_the_first_key(y_motor)),
+        )
+        if batch:
+            first_points = (
+                first_point if isinstance(first_point, list) else [first_point]
+            )
+        else:
+            first_points = [first_point]
+        # convert the first_point variable to from we will be getting from
+        # queue
+        first_points = [
+            {m.name: v for m, v in zip(pseudo_axes, p)} for p in first_points
+        ]
+        if batch:
+            pending = resolve_many(first_points)
+            if not pending:
+                raise ValueError("None of the first points can be reached")
+        else:
+            pending = [(first_points[0], *resolve(first_points[0]))]
+        pipeline_md = {}
         for j in itertools.count():
-            # extract the target position as a tuple
-            target = tuple(next_point[k.name] for k in pseudo_axes)
-            print(f"next point: {pprint.pformat(next_point)}")
-            # if we have a snapping function use it
-            if snap_function is not None:
-                target = snap_function(*target)
-            print(f"snapped target: {target}")
-            # compute the real target
-            real_target = transform_pair.forward(*target)
-            print(f"real target: {real_target}")
+            next_point, target, real_target = pending.pop(0)
+
+            # make sure the step fits in what is left of the beamtime
+            remaining = plan_stop_time - time.time()
+            fidelity = fidelity_of(next_point)
+            predicted = costs.predict(
+                position, real_target, level_of(fidelity)[0], fidelity
+            )
+            if predicted["total"] > remaining:
+                affordable = []
+                for name in fidelities:
+                    cost = costs.predict(
+                        position, real_target, level_of(name)[0], name
+                    )
+                    if cost["total"] <= remaining:
+                        affordable.append((cost["total"], name))
+                if not affordable:
+                    print(
+                        f"stopping, the next point would take {predicted['total']:.1f}s"
+                        f" and {remaining:.1f}s are left"
+                    )
+                    break
+                _, cheaper = max(affordable)
+                print(f"only {remaining:.1f}s left, using {cheaper!r} not {fidelity!r}")
+                fidelity = cheaper
+                predicted = costs.predict(
+                    position, real_target, level_of(fidelity)[0], fidelity
+                )
+            step_exposure, take_data_kwargs = level_of(fidelity)
+            step_start = time.time()
+            timer.step()
 
             # move to the new position
-            t0 = time.time()
-            yield from bps.mov(*itertools.chain(*zip(real_motors, real_target)))
-            t1 = time.time()
-            print(f"move to target took {t1-t0:0.2f}s")
-
-            # read back where the motors really are
-            real_x = yield from _read_the_first_key(x_motor)
-            real_y = yield from _read_the_first_key(y_motor)
-            print(f"real x and y: {real_x}, {real_y}")
-
-            # compute the new (actual) pseudo positions
-            pseudo_target = transform_pair.inverse(real_x, real_y)
-            print(f"pseudo target: {pseudo_target}")
-            # and set our local synthetic object to them
-            yield from bps.mv(*itertools.chain(*zip(pseudo_axes, pseudo_target)))
+            real_x, real_y = yield from _move_to_target(
+                target,
+                real_target,
+                wafer=wafer,
+                real_motors=real_motors,
+                pseudo_axes=pseudo_axes,
+                transform_pair=transform_pair,
+                timer=timer,
+            )
 
             # kick off the next actually measurement!
-            uid = yield from take_data(
-                dets + list(real_motors) + [ctrl],
-                exposure,
+            acquisition = take_data(
+                readables,
+                step_exposure,
                 y_motor,
                 real_y - rocking_range,
                 real_y + rocking_range,
@@ -355,33 +609,134 @@ def adaptive_plan(
                     "adaptive_step": {
                         "requested": next_point,
                         "snapped": {k.name: v for k, v in zip(pseudo_axes, target)},
+                        "pending": len(pending),
+                        "fidelity": fidelity,
+                        "exposure": step_exposure,
+                        "budget_remaining": remaining,
+                        "predicted_cost": predicted,
+                        **pipeline_md,
                     },
+                    "timing": timer.pre_acquisition(),
                 },
                 **take_data_kwargs,
             )
+            if pipeline:
+                poller = _RecommendationPoller(
+                    from_recommender, None if batch else resolve
+                )
+                poller.start()
+            with timer.phase("acquire"):
+                try:
+                    uid = yield from acquisition
+                finally:
+                    if pipeline:
+                        poller.stop()
+            t_acquired = time.time()
             uids.append(uid)
 
             # ask the reccomender what to do next
-            t0 = time.time()
-            next_point = from_recommender.get(timeout=reccomender_timeout)
-            t1 = time.time()
-            print(f"waited {t1-t0:.2f}s for recommendation")
+            resolved = None
+            with timer.phase("recommender_wait"):
+                if batch:
+                    if not pipeline:
+                        poller = _RecommendationPoller(from_recommender, None)
+                    # take everything that is already there, only block if
+                    # there is nothing left to do
+                    poller.poll()
+                    received = poller.received
+                    if not (received or pending or poller.stop_requested):
+                        received = [from_recommender.get(timeout=reccomender_timeout)]
+                    stop = poller.stop_requested or None in received
+                    next_point = None if stop else received
+                elif pipeline and poller.arrived is not None:
+                    # anything posted since the last poll is newer
+                    poller.poll()
+                    next_point, resolved = poller.latest, poller.resolved
+                else:
+                    next_point = from_recommender.get(timeout=reccomender_timeout)
+            wait = timer.steps[-1]["recommender_wait"]
+            print(f"waited {wait:.2f}s for recommendation")
+            if pipeline:
+                lead = t_acquired - poller.arrived if poller.arrived is not None else 0
+                pipeline_md = {
+                    "pipeline": {
+                        "previous_recommender_wait": wait,
+                        "previous_recommendation_lead": lead,
+                    }
+                }
+                print(f"recommendation arrived {lead:.2f}s before the exposure ended")
+
+            actual = time.time() - step_start
+            costs.observe(
+                timer.steps[-1],
+                actual,
+                position,
+                real_target,
+                step_exposure,
+                fidelity,
+            )
+            cost_log.append(
+                {
+                    "fidelity": fidelity,
+                    "predicted": predicted["total"],
+                    "actual": actual,
+                }
+            )
+            print(
+                f"step predicted to take {predicted['total']:.1f}s, took {actual:.1f}s"
+            )
+            position = (real_x, real_y)
 
             print(f"batch count: {j}")
             if next_point is None:
                 print("no recommendation - stopping")
-                return
+                break
             elif j >= (max_runs - 1):
                 print(f"stopping after batch_count reached {j}")
-                return
+                break
             elif time.time() > plan_stop_time:
                 print(f"stopping after {time.time() - plan_start_time:.2f}s")
+                break
             else:
                 print(f"keep going!")
 
+            if batch:
+                # amend the queue and re-plan the route from here
+                pending += resolve_many(
+                    [p for r in received for p in (r if isinstance(r, list) else [r])]
+                )
+                if not pending:
+                    print("no reachable points left - stopping")
+                    break
+                order = order_by_travel(
+                    (real_x, real_y),
+                    [real_target for *_, real_target in pending],
+                    velocities,
+                )
+                pending = [pending[k] for k in order]
+            else:
+                if resolved is None:
+                    resolved = resolve(next_point)
+                pending = [(next_point, *resolved)]
+
         return uids
 
-    return (yield from gp_inner_plan())
+    cost_log = []
+    try:
+        uids = yield from gp_inner_plan()
+    finally:
+        timer.print_summary()
+        _print_cost_log(cost_log)
+    if timing_stream:
+        yield from timing_run(
+            timer,
+            md={
+                "batch_id": _md["batch_id"],
+                "timed_plan": "adaptive_plan",
+                "cost_log": cost_log,
+            },
+        )
+    return uids
 
 
 class SignalWithUnits(Signal):
@@ -407,6 +762,667 @@ class Control(Device):
     thickness = Cpt(SignalWithUnits, value=0, units="enum", kind="hinted")
 
 
+class RockingState(Device):
+    """Soft device to record what the rocking motor did during a shot."""
+
+    low = Cpt(SignalWithUnits, value=0, units="motor units", kind="hinted")
+    high = Cpt(SignalWithUnits, value=0, units="motor units", kind="hinted")
+    phase = Cpt(SignalWithUnits, value=0, units="cycles", kind="hinted")
+    passes = Cpt(SignalWithUnits, value=0, units="count", kind="hinted")
+
+
+class _RockingRecorder(RockingState):
+    """
+    RockingState filled in from the timestamped motor readback.
+
+    Between `start` and `halt` the readback of *motor* is recorded.  Set
+    ``window`` to the (IOC) time span of a shot before reading it, `read`
+    reports what the motor did then, see `shot`.  Nothing is moved.
+    """
+
+    def __init__(self, motor, start, stop, *, name, **kwargs):
+        if start == stop:
+            raise ValueError("can not rock between identical start and stop")
+        super().__init__(name=name, **kwargs)
+        self.motor = motor
+        self.start_pos = start
+        self.stop_pos = stop
+        self.window = None
+        self._lock = threading.Lock()
+        self._times = []
+        self._positions = []
+        self._cid = None
+
+    def start(self):
+        self._cid = self.motor.subscribe(
+            self._record, event_type=self.motor.SUB_READBACK
+        )
+
+    def halt(self):
+        if self._cid is not None:
+            self.motor.unsubscribe(self._cid)
+            self._cid = None
+
+    def _record(self, *, value, timestamp=None, **kwargs):
+        with self._lock:
+            self._times.append(time.time() if timestamp is None else timestamp)
+            self._positions.append(value)
+
+    def shot(self, t0, t1):
+        """
+        What the motor did between t0 and t1.
+
+        Returns
+        -------
+        low, high : float
+            The extent of the motion
+
+        phase : float
+            Where in the cycle the motor was at t0, 0 at start, 0.5 at
+            stop
+
+        passes : int
+            The number of times the motor turned around
+        """
+        with self._lock:
+            times = np.asarray(self._times)
+            positions = np.asarray(self._positions, dtype=float)
+        if not len(times):
+            return np.nan, np.nan, np.nan, 0
+        # include the last reading before the shot
+        first = max(np.searchsorted(times, t0, side="right") - 1, 0)
+        last = np.searchsorted(times, t1, side="right")
+        pos = positions[first : max(last, first + 1)]
+        frac = np.clip(
+            (pos[0] - self.start_pos) / (self.stop_pos - self.start_pos), 0, 1
+        )
+        step = np.diff(pos) * np.sign(self.stop_pos - self.start_pos)
+        step = step[step != 0]
+        outbound = step[0] > 0 if len(step) else True
+        phase = frac / 2 if outbound else 1 - frac / 2
+        passes = int(np.count_nonzero(np.diff(np.sign(step)) != 0))
+        return float(pos.min()), float(pos.max()), float(phase), passes
+
+    def read(self):
+        if self.window is not None:
+            signals = (self.low, self.high, self.phase, self.passes)
+            for sig, value in zip(signals, self.shot(*self.window)):
+                sig.put(value)
+        return super().read()
+
+
+PHASES = ("move", "readback", "pseudo_set", "acquire", "recommender_wait")
+# the phases that are over before the run of a step starts
+PRE_ACQUISITION_PHASES = ("move", "readback", "pseudo_set")
+
+
+class PhaseTimer:
+    """
+    Wall-clock time spent in each phase of each step of a plan.
+
+    Call `step` at the top of every step and wrap the parts of the plan
+    in `phase` ::
+
+        timer.step()
+        with timer.phase("move"):
+            yield from bps.mov(...)
+
+    Time not spent in any phase (planning, snapping, printing, ...) is
+    reported as "other" by `summary`.
+    """
+
+    def __init__(self, phases=PHASES):
+        self.phases = tuple(phases)
+        self.steps = []
+        self.start_time = time.time()
+
+    def step(self):
+        """Start timing a new step."""
+        self.steps.append(dict.fromkeys(self.phases, 0.0))
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.steps[-1][name] += time.time() - t0
+
+    def pre_acquisition(self):
+        """The phases of the current step before its run started."""
+        return {k: self.steps[-1][k] for k in PRE_ACQUISITION_PHASES}
+
+    def summary(self):
+        """
+        Totals over all steps.
+
+        Returns
+        -------
+        summary : dict
+            The number of steps, the wall time since the timer was made
+            and the total / mean / max of every phase in seconds.
+        """
+        table = np.array(
+            [[step[k] for k in self.phases] for step in self.steps]
+        ).reshape(-1, len(self.phases))
+        wall = time.time() - self.start_time
+        total = table.sum(axis=0)
+        n = max(len(table), 1)
+        return {
+            "steps": len(self.steps),
+            "wall": wall,
+            "other": wall - float(total.sum()),
+            "total": dict(zip(self.phases, total.tolist())),
+            "mean": dict(zip(self.phases, (total / n).tolist())),
+            "max": dict(
+                zip(
+                    self.phases,
+                    (table.max(axis=0) if len(table) else total).tolist(),
+                )
+            ),
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        wall = summary["wall"] or 1
+        print(f"{summary['steps']} steps in {summary['wall']:.1f}s")
+        print(f"{'phase':>18} {'total':>10} {'mean':>9} {'max':>9} {'share':>6}")
+        for k in self.phases:
+            total = summary["total"][k]
+            print(
+                f"{k:>18} {total:>9.1f}s {summary['mean'][k]:>8.2f}s"
+                f" {summary['max'][k]:>8.2f}s {100 * total / wall:>5.1f}%"
+            )
+        other = summary["other"]
+        print(f"{'other':>18} {other:>9.1f}s {'':>19} {100 * other / wall:>5.1f}%")
+
+
+class PhaseTiming(Device):
+    """Soft device to emit the `PhaseTimer` of a plan as events."""
+
+    step = Cpt(Signal, value=0, kind="hinted")
+    move = Cpt(SignalWithUnits, value=0, units="s", kind="hinted")
+    readback = Cpt(SignalWithUnits, value=0, units="s", kind="hinted")
+    pseudo_set = Cpt(SignalWithUnits, value=0, units="s", kind="hinted")
+    acquire = Cpt(SignalWithUnits, value=0, units="s", kind="hinted")
+    recommender_wait = Cpt(SignalWithUnits, value=0, units="s", kind="hinted")
+
+
+def timing_run(timer, *, md=None):
+    """
+    One run with an event per step of *timer* in the ``timing`` stream.
+
+    The `PhaseTimer.summary` goes in the start document.
+    """
+    timing = PhaseTiming(name="timing")
+    _md = {"plan_name": "timing_run", "timing": timer.summary()}
+    _md.update(md or {})
+
+    @bpp.run_decorator(md=_md)
+    def inner():
+        for j, step in enumerate(timer.steps):
+            yield from bps.mv(
+                timing.step,
+                j,
+                *itertools.chain(
+                    *((getattr(timing, k), v) for k, v in step.items())
+                ),
+            )
+            yield from bps.trigger_and_read([timing], name="timing")
+
+    return (yield from inner())
+
+
+class CostModel:
+    """
+    Running estimates of how long one step of `adaptive_plan` takes.
+
+    The cost of a step is the travel time (the distance over the motor
+    velocity plus the estimated overhead of a move), the exposure plus
+    the estimated readout overhead of its fidelity level, the estimated
+    recommender latency and the estimated remaining bookkeeping.  The
+    estimates are exponentially weighted moving averages of what the
+    previous steps took.
+
+    Parameters
+    ----------
+    velocities : (vx, vy)
+        The motor speeds
+
+    alpha : float, optional
+        Weight of the newest observation
+    """
+
+    def __init__(self, velocities, *, alpha=0.3):
+        self.velocities = np.asarray(velocities, dtype=float)
+        self.alpha = alpha
+        self.estimates = {}
+
+    def _update(self, key, value):
+        old = self.estimates.get(key)
+        self.estimates[key] = (
+            value if old is None else old + self.alpha * (value - old)
+        )
+
+    def predict(self, start, target, exposure, fidelity):
+        """
+        Predicted cost of a step, in seconds.
+
+        Returns
+        -------
+        cost : dict
+            The travel, acquire, recommender and other parts and their
+            total
+        """
+        travel = 0.0
+        if None not in start:
+            travel = float(travel_times(start, target, self.velocities))
+        cost = {
+            "travel": max(travel + self.estimates.get("move_overhead", 0.0), 0.0),
+            "acquire": max(
+                exposure + self.estimates.get(("readout", fidelity), 0.0), 0.0
+            ),
+            "recommender": max(self.estimates.get("recommender", 0.0), 0.0),
+            "other": max(self.estimates.get("other", 0.0), 0.0),
+        }
+        cost["total"] = sum(cost.values())
+        return cost
+
+    def observe(self, step, elapsed, start, target, exposure, fidelity):
+        """
+        Update the estimates from a `PhaseTimer` step.
+
+        Parameters
+        ----------
+        step : dict
+            The time spent in each phase of the step
+
+        elapsed : float
+            The wall time of the whole step
+        """
+        if None not in start:
+            travel = float(travel_times(start, target, self.velocities))
+            self._update("move_overhead", step["move"] - travel)
+        self._update(("readout", fidelity), step["acquire"] - exposure)
+        self._update("recommender", step["recommender_wait"])
+        self._update(
+            "other",
+            elapsed - step["move"] - step["acquire"] - step["recommender_wait"],
+        )
+
+
+def _print_cost_log(cost_log):
+    if not cost_log:
+        return
+    predicted = np.array([c["predicted"] for c in cost_log])
+    actual = np.array([c["actual"] for c in cost_log])
+    print(
+        f"predicted {predicted.sum():.0f}s for {len(cost_log)} steps, took"
+        f" {actual.sum():.0f}s (mean abs error {np.mean(abs(actual - predicted)):.1f}s)"
+    )
+
+
+class _ExistingCpt(Cpt):
+    """A Component that is an already made ophyd object, not a new one."""
+
+    def __init__(self, obj, **kwargs):
+        super().__init__(type(obj), **kwargs)
+        self.obj = obj
+
+    def create_component(self, instance):
+        return self.obj
+
+
+def wafer_positioner_factory(transform_pair, x_motor, y_motor, *, name="ctrl"):
+    """
+    Make a PseudoPositioner moving the wafer in data coordinates.
+
+    The pseudo axes are Ti, temp, annealing_time and thickness, the real
+    axes (x, y) are *x_motor* and *y_motor* themselves, so there is one
+    ophyd object (and one set of CA subscriptions) per motor.  An (x, y)
+    that is not on a strip reads back as NaN.  The default name keeps
+    the ``ctrl_*`` keys of the soft `Control` device so recommenders do
+    not need to change.
+
+    Parameters
+    ----------
+    transform_pair : TransformPair
+
+    x_motor, y_motor : EpicsMotor
+        The sample stage motors
+
+    Returns
+    -------
+    wafer : PseudoPositioner
+        Also has ``transform_pair``, ``forward_many(Ti, temp,
+        annealing_time, thickness) -> x, y, valid`` and
+        ``inverse_many(x, y) -> Ti, temp, annealing_time, thickness,
+        valid``
+    """
+
+    class WaferPositioner(PseudoPositioner):
+        Ti = Cpt(PseudoSingle, egu="percent TI", kind="hinted")
+        temp = Cpt(PseudoSingle, egu="degrees C", kind="hinted")
+        annealing_time = Cpt(PseudoSingle, egu="s", kind="hinted")
+        thickness = Cpt(PseudoSingle, egu="enum", kind="hinted")
+
+        x = _ExistingCpt(x_motor)
+        y = _ExistingCpt(y_motor)
+
+        @pseudo_position_argument
+        def forward(self, pseudo_pos):
+            return self.RealPosition(*transform_pair.forward(*pseudo_pos))
+
+        @real_position_argument
+        def inverse(self, real_pos):
+            try:
+                return self.PseudoPosition(*transform_pair.inverse(*real_pos))
+            except ValueError:
+                return self.PseudoPosition(*[np.nan] * len(self.PseudoPosition._fields))
+
+        def forward_many(self, Ti, temp, annealing_time, thickness):
+            data = np.column_stack(
+                _as_float_arrays(Ti, temp, annealing_time, thickness)
+            )
+            _, real = _resolve_targets(data, None, transform_pair)
+            valid = np.array([r is not None for r in real], dtype=bool)
+            xy = np.array([r if r is not None else (np.nan, np.nan) for r in real])
+            return xy[:, 0], xy[:, 1], valid
+
+        def inverse_many(self, x, y):
+            if transform_pair.inverse_many is not None:
+                return transform_pair.inverse_many(x, y)
+            x, y = _as_float_arrays(x, y)
+            out = np.full((len(x), 4), np.nan)
+            valid = np.zeros(len(x), dtype=bool)
+            for j, (xj, yj) in enumerate(zip(x, y)):
+                try:
+                    out[j] = transform_pair.inverse(xj, yj)
+                    valid[j] = True
+                except ValueError:
+                    pass
+            return (*out.T, valid)
+
+    wafer = WaferPositioner(name=name)
+    wafer.transform_pair = transform_pair
+    return wafer
+
+
+def _pseudo_axes(dets, wafer, real_motors, transform_pair):
+    """
+    Pick the pseudo axes of a plan.
+
+    Returns
+    -------
+    ctrl, pseudo_axes, real_motors, transform_pair, readables
+    """
+    if wafer is not None:
+        return (
+            wafer,
+            wafer.pseudo_positioners,
+            wafer.real_positioners,
+            transform_pair or wafer.transform_pair,
+            dets + [wafer],
+        )
+    if real_motors is None or transform_pair is None:
+        raise ValueError("pass either wafer or real_motors and transform_pair")
+    # make the soft pseudo axis
+    ctrl = Control(name="ctrl")
+    pseudo_axes = tuple(getattr(ctrl, k) for k in ctrl.component_names)
+    readables = dets + list(real_motors) + [ctrl]
+    return ctrl, pseudo_axes, real_motors, transform_pair, readables
+
+
+def _move_to_target(
+    target, real_target, *, wafer, real_motors, pseudo_axes, transform_pair, timer
+):
+    """
+    Move to a target and set the pseudo axes.
+
+    With a wafer positioner that is one move, otherwise move the real
+    motors, read them back and set the soft pseudo axes from the inverse.
+
+    Returns
+    -------
+    real_x, real_y : float
+        The target if the motors can not be read
+    """
+    if wafer is not None:
+        with timer.phase("move"):
+            yield from bps.mov(wafer, target)
+        print(f"move to target took {timer.steps[-1]['move']:0.2f}s")
+        with timer.phase("readback"):
+            real_x = yield from _read_the_first_key(wafer.x)
+            real_y = yield from _read_the_first_key(wafer.y)
+        if real_x is None:
+            real_x, real_y = real_target
+        return real_x, real_y
+
+    x_motor, y_motor = real_motors
+    with timer.phase("move"):
+        yield from bps.mov(*itertools.chain(*zip(real_motors, real_target)))
+    print(f"move to target took {timer.steps[-1]['move']:0.2f}s")
+
+    # read back where the motors really are
+    with timer.phase("readback"):
+        real_x = yield from _read_the_first_key(x_motor)
+        real_y = yield from _read_the_first_key(y_motor)
+    print(f"real x and y: {real_x}, {real_y}")
+    if real_x is None:
+        real_x, real_y = real_target
+
+    # compute the new (actual) pseudo positions
+    with timer.phase("pseudo_set"):
+        pseudo_target = transform_pair.inverse(real_x, real_y)
+        print(f"pseudo target: {pseudo_target}")
+        # and set our local synthetic object to them
+        yield from bps.mv(*itertools.chain(*zip(pseudo_axes, pseudo_target)))
+    return real_x, real_y
+
+
+def _resolve_targets(requested, snap_function, transform_pair):
+    """
+    Snap and transform an (N, 4) array of requested data coordinates.
+
+    Uses the vectorized ``snap_many`` / ``forward_many`` if available.
+
+    Returns
+    -------
+    targets, real_targets : list
+        snapped data / real coordinate tuples, None if not reachable
+    """
+    n = len(requested)
+    snapped = requested
+    valid = np.ones(n, dtype=bool)
+    if snap_function is not None:
+        if hasattr(snap_function, "snap_many"):
+            snapped, valid = snap_function.snap_many(requested)
+        else:
+            snapped = np.full(requested.shape, np.nan)
+            for j, p in enumerate(requested):
+                try:
+                    snapped[j] = snap_function(*p)
+                except ValueError:
+                    valid[j] = False
+
+    real = np.full((n, 2), np.nan)
+    if getattr(transform_pair, "forward_many", None) is not None:
+        x, y, ok = transform_pair.forward_many(*np.asarray(snapped).T)
+        real[:, 0], real[:, 1] = x, y
+        valid &= ok
+    else:
+        for j in np.flatnonzero(valid):
+            try:
+                real[j] = transform_pair.forward(*snapped[j])
+            except ValueError:
+                valid[j] = False
+
+    targets = [tuple(snapped[j].tolist()) if valid[j] else None for j in range(n)]
+    real_targets = [tuple(real[j].tolist()) if valid[j] else None for j in range(n)]
+    return targets, real_targets
+
+
+def travel_times(a, b, velocities):
+    """
+    Time to move between positions a and b.
+
+    The axes move at the same time so the slowest axis sets the time.
+    """
+    return np.max(np.abs(np.asarray(a) - np.asarray(b)) / velocities, axis=-1)
+
+
+def route_time(start, points, velocities):
+    """Total travel time visiting *points* in order from *start*."""
+    path = np.vstack([np.atleast_2d(start), np.reshape(points, (-1, 2))])
+    return float(np.sum(travel_times(path[:-1], path[1:], velocities)))
+
+
+def order_by_travel(start, points, velocities, *, two_opt=True, max_passes=20):
+    """
+    Order points to (approximately) minimize the travel time from start.
+
+    A nearest-neighbour tour polished by 2-opt moves on the open path.
+
+    Parameters
+    ----------
+    start : (x, y)
+        Where the motors are now
+
+    points : array, shape (N, 2)
+        The real positions to visit
+
+    velocities : (vx, vy)
+        The motor speeds
+
+    Returns
+    -------
+    order : array[int]
+        Indices into *points*
+    """
+    points = np.reshape(np.asarray(points, dtype=float), (-1, 2))
+    n = len(points)
+    if n < 2:
+        return np.arange(n)
+    nodes = np.vstack([np.atleast_2d(start), points])
+    cost = travel_times(nodes[:, np.newaxis, :], nodes[np.newaxis, :, :], velocities)
+
+    # nearest neighbour from the start (node 0)
+    path = [0]
+    unvisited = np.ones(n + 1, dtype=bool)
+    unvisited[0] = False
+    for _ in range(n):
+        here = path[-1]
+        nxt = np.flatnonzero(unvisited)[np.argmin(cost[here, unvisited])]
+        path.append(nxt)
+        unvisited[nxt] = False
+    path = np.array(path)
+
+    # 2-opt on the open path, the start stays fixed
+    for _ in range(max_passes if two_opt else 0):
+        improved = False
+        for i in range(1, n):
+            k = np.arange(i + 1, n + 1)
+            after = np.append(path[k[:-1] + 1], -1)
+            delta = (
+                cost[path[i - 1], path[k]]
+                - cost[path[i - 1], path[i]]
+                + np.where(after >= 0, cost[path[i], after] - cost[path[k], after], 0)
+            )
+            best = np.argmin(delta)
+            if delta[best] < -1e-9:
+                path[i : k[best] + 1] = path[i : k[best] + 1][::-1]
+                improved = True
+        if not improved:
+            break
+
+    return path[1:] - 1
+
+
+class _RecommendationPoller:
+    """
+    Drain the recommendation queue while a plan is running.
+
+    Between `start` and `stop` a background thread blocks on the queue,
+    so a recommendation is taken as soon as it is posted even while the
+    RunEngine is waiting on the detector.  The latest recommendation is
+    kept and resolved (snapped + transformed) right away so it is ready
+    when the plan needs it.  If *resolve* is None everything received is
+    kept (in order) in ``received``.  `poll` takes whatever is already
+    there without blocking.  Only read the results when the thread is
+    not running.
+    """
+
+    def __init__(self, queue, resolve, *, interval=0.05):
+        self._queue = queue
+        self._resolve = resolve
+        self._interval = interval
+        self._done = threading.Event()
+        self._thread = None
+        self.latest = None
+        self.resolved = None
+        self.received = []
+        self.stop_requested = False
+        # when the first recommendation was seen
+        self.arrived = None
+
+    def _take(self, latest):
+        if self.arrived is None:
+            self.arrived = time.time()
+        if latest is None:
+            # a request to stop always wins
+            self.stop_requested = True
+            self.latest = self.resolved = None
+            return
+        self.latest = latest
+        if self._resolve is None:
+            self.received.append(latest)
+            return
+        try:
+            self.resolved = self._resolve(latest)
+        except ValueError:
+            # resolve again (and raise) outside of the acquisition
+            self.resolved = None
+
+    def poll(self):
+        while not self.stop_requested:
+            try:
+                latest = self._queue.get(block=False)
+            except Empty:
+                return
+            self._take(latest)
+
+    def _run(self):
+        while not (self._done.is_set() or self.stop_requested):
+            try:
+                latest = self._queue.get(timeout=self._interval)
+            except Empty:
+                continue
+            self._take(latest)
+
+    def start(self):
+        self._done.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._done.set()
+        self._thread.join()
+        self._thread = None
+
+
+def _read_velocities(motors):
+    """The speed of each motor, 1 if it can not be read."""
+    velocities = np.ones(len(motors))
+    for j, motor in enumerate(motors):
+        if hasattr(motor, "velocity"):
+            v = yield from _read_the_first_key(motor.velocity)
+            if v:
+                velocities[j] = abs(v)
+    return velocities
+
+
 def _read_the_first_key(obj):
     """Helper to get 'the right' reading."""
     reading = yield from bps.read(obj)
@@ -1,4 +1,6 @@
 import itertools
+from collections import namedtuple
+
 import bluesky.plan_stubs as bps
 
 
@@ -62,6 +64,142 @@ p2 = [
 ]
 
 
+BatchTarget = namedtuple(
+    "BatchTarget", ["center_point", "inner_count", "data", "real"]
+)
+
+
+def _ti_windows(sample_points, ti_range, points, merge):
+    """
+    The Ti values to measure around each sample point.
+
+    Returns
+    -------
+    windows : List[Tuple[List[sample_point], array]]
+        The sample points a window covers and its Ti values.  If *merge*
+        the overlapping windows on the same strip are merged into one,
+        sampled at the same spacing, so no Ti is measured twice.
+    """
+    if not merge:
+        return [
+            ([p], np.linspace(p[0] - ti_range / 2, p[0] + ti_range / 2, points))
+            for p in sample_points
+        ]
+    step = ti_range / (points - 1) if points > 1 else np.inf
+    by_strip = {}
+    for p in sample_points:
+        ti, *strip = p
+        by_strip.setdefault(tuple(strip), []).append(p)
+
+    windows = []
+    for strip_points in by_strip.values():
+        strip_points = sorted(strip_points, key=lambda p: p[0])
+        merged = [[strip_points[0]]]
+        for p in strip_points[1:]:
+            if p[0] - merged[-1][-1][0] <= ti_range:
+                merged[-1].append(p)
+            else:
+                merged.append([p])
+        for group in merged:
+            lo = group[0][0] - ti_range / 2
+            hi = group[-1][0] + ti_range / 2
+            n = int(np.ceil((hi - lo) / step - 1e-9)) + 1 if points > 1 else points
+            windows.append((group, np.linspace(lo, hi, n)))
+    return windows
+
+
+def plan_batch_targets(sample_points, transform_pair, *, ti_range=5.0, points=10, merge=True):
+    """
+    Compute every target of a batch_scan up front.
+
+    Parameters
+    ----------
+    sample_points : List[Tuple[float, ...]]
+        (Ti, temperature, annealing_time, thickness) to scan around
+
+    transform_pair : TransformPair
+        ``forward_many`` is used if available
+
+    ti_range, points : float, int
+        The Ti window around each sample point and the number of points
+        in it
+
+    merge : bool, optional
+        Merge the overlapping Ti windows on the same strip
+
+    Returns
+    -------
+    targets : List[BatchTarget]
+        The reachable targets, in sample_points order.  ``center_point``
+        is the (nearest) sample point the target was planned for.
+    """
+    rows = []
+    data = []
+    for centers, tis in _ti_windows(sample_points, ti_range, points, merge):
+        for j, ti in enumerate(tis):
+            center = min(centers, key=lambda p: abs(p[0] - ti))
+            rows.append((center, j))
+            data.append((ti, *center[1:]))
+    if not data:
+        return []
+    data, real = _resolve_targets(
+        np.array(data, dtype=float).reshape(len(data), -1), None, transform_pair
+    )
+    targets = [
+        BatchTarget(center, j, d, r)
+        for (center, j), d, r in zip(rows, data, real)
+        if d is not None
+    ]
+    if len(targets) < len(rows):
+        print(f"dropping {len(rows) - len(targets)} of {len(rows)} unreachable targets")
+    return targets
+
+
+def batch_scan_report(sample_points, transform_pair, *, start, velocities=(1, 1), ti_range=5.0, points=10):
+    """
+    Dry run of batch_scan: compare the planned route with the list order.
+
+    Parameters
+    ----------
+    start : (x, y)
+        Where the motors are
+
+    velocities : (vx, vy), optional
+        Motor speeds
+
+    Returns
+    -------
+    report : dict
+        The number of targets and the predicted move time (in the units
+        of position / velocity) of both
+    """
+    velocities = np.asarray(velocities, dtype=float)
+    listed = plan_batch_targets(
+        sample_points, transform_pair, ti_range=ti_range, points=points, merge=False
+    )
+    planned = plan_batch_targets(
+        sample_points, transform_pair, ti_range=ti_range, points=points
+    )
+    order = order_by_travel(start, [t.real for t in planned], velocities)
+    report = {
+        "listed_targets": len(listed),
+        "listed_move_time": route_time(start, [t.real for t in listed], velocities),
+        "planned_targets": len(planned),
+        "planned_move_time": route_time(
+            start, [planned[k].real for k in order], velocities
+        ),
+    }
+    print(
+        f"list order: {report['listed_targets']} targets, "
+        f"{report['listed_move_time']:.1f}s of moves"
+    )
+    print(
+        f"planned:    {report['planned_targets']} targets, "
+        f"{report['planned_move_time']:.1f}s of moves"
+    )
+    return report
+
+
 def batch_scan(
     dets,
     sample_points,
@@ -70,16 +208,35 @@ def batch_scan(
     points=10,
     rocking_range=0.5,
     rocking_num=3,
-    real_motors,
+    real_motors=None,
     exposure=20,
     take_data=stepping_ct,
-    transform_pair
+    transform_pair=None,
+    timing_stream=False,
+    optimize=False,
+    wafer=None
 ):
+    """
+    Scan a Ti window around each of a list of sample points.
+
+    By default the points are visited in list order and each gets its
+    own window of *points* targets, ``inner_count`` being the index in
+    that window.
+
+    With *optimize* overlapping Ti windows on the same strip are merged,
+    so ``inner_count`` indexes the merged window and a Ti is only
+    measured once, and the targets are visited in the order that
+    minimizes x/y travel from the current position, see
+    `plan_batch_targets` and `batch_scan_report`.
+
+    A *wafer* from `wafer_positioner_factory` replaces *real_motors* and
+    *transform_pair*, see `adaptive_plan`.
+    """
+    ctrl, pseudo_axes, real_motors, transform_pair, readables = _pseudo_axes(
+        dets, wafer, real_motors, transform_pair
+    )
     # unpack the real motors
     x_motor, y_motor = real_motors
-    # make the soft pseudo axis
-    ctrl = Control(name="ctrl")
-    pseudo_axes = tuple(getattr(ctrl, k) for k in ctrl.component_names)
     _md = {
         "batch_id": str(uuid.uuid4()),
         "batch_scan": {
@@ -88,48 +245,68 @@ def batch_scan(
             "rocking_num": rocking_num,
             "points": points,
             "ti_range": ti_range,
+            "optimize": optimize,
         },
         'sample_points': sample_points
     }
 
-    for p in sample_points:
-        ti, *strip = p
-        for j, ti_m in enumerate(np.linspace(ti-(ti_range/2), ti+(ti_range/2), points)):
-            try:
-                real_target = transform_pair.forward(ti_m, *strip)
-                print(f"real target: {real_target}")
-            except ValueError as ve:
-                print("ValueError!")
-                continue
+    targets = plan_batch_targets(
+        sample_points, transform_pair, ti_range=ti_range, points=points, merge=optimize
+    )
+    if not targets:
+        print("no reachable targets")
+        return
+    velocities = yield from _read_velocities(real_motors)
+    start = (
+        (yield from _read_the_first_key(x_motor)),
+        (yield from _read_the_first_key(y_motor)),
+    )
+    if None in start:
+        start = targets[0].real
+    if optimize:
+        order = order_by_travel(start, [t.real for t in targets], velocities)
+        targets = [targets[k] for k in order]
+    print(
+        f"{len(targets)} targets, predicted move time "
+        f"{route_time(start, [t.real for t in targets], velocities):.1f}s"
+    )
+
+    timer = PhaseTimer()
+    try:
+        for target in targets:
+            real_target = target.real
+            print(f"real target: {real_target}")
 
+            timer.step()
             # move to the new position
-            t0 = time.time()
-            yield from bps.mov(*itertools.chain(*zip(real_motors, real_target)))
-            t1 = time.time()
-            print(f"move to target took {t1-t0:0.2f}s")
-
-            # read back where the motors really are
-            real_x = yield from _read_the_first_key(x_motor)
-            real_y = yield from _read_the_first_key(y_motor)
-            print(f"real x and y: {real_x}, {real_y}")
-            if real_x is None:
-                real_x, real_y = real_target
-            # compute the new (actual) pseudo positions
-            pseudo_target = transform_pair.inverse(real_x, real_y)
-            print(f"pseudo target: {pseudo_target}")
-            # and set our local synthetic object to them
-            yield from bps.mv(*itertools.chain(*zip(pseudo_axes, pseudo_target)))
-
-            uid = yield from take_data(
-                dets + list(real_motors) + [ctrl],
-                exposure,
-                y_motor,
-                real_y - rocking_range,
-                real_y + rocking_range,
-                md={
-                    **_md,
-                    "center_point": p,
-                    "inner_count": j,
-                },
-                num=rocking_num
+            real_x, real_y = yield from _move_to_target(
+                target.data,
+                real_target,
+                wafer=wafer,
+                real_motors=real_motors,
+                pseudo_axes=pseudo_axes,
+                transform_pair=transform_pair,
+                timer=timer
             )
+
+            with timer.phase("acquire"):
+                uid = yield from take_data(
+                    readables,
+                    exposure,
+                    y_motor,
+                    real_y - rocking_range,
+                    real_y + rocking_range,
+                    md={
+                        **_md,
+                        "center_point": target.center_point,
+                        "inner_count": target.inner_count,
+                        "timing": timer.pre_acquisition(),
+                    },
+                    num=rocking_num
+                )
+    finally:
+        timer.print_summary()
+    if timing_stream:
+        yield from timing_run(
+            timer, md={"batch_id": _md["batch_id"], "timed_plan": "batch_scan"}
+        )
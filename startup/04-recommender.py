@@ -0,0 +1,411 @@
+"""Local recommender for adaptive_plan with a reference GP engine."""
+import collections
+import inspect
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from queue import Empty, Queue
+
+import numpy as np
+import scipy.linalg
+
+# code for worker processes lives in the importable xpd_workers package next
+# to the startup directory, a spawned process can not see the profile
+_PROFILE_ROOT = os.path.dirname(
+    os.path.dirname(os.path.abspath(inspect.currentframe().f_code.co_filename))
+)
+if _PROFILE_ROOT not in sys.path:
+    sys.path.append(_PROFILE_ROOT)
+
+from xpd_workers.recommender import GPRecommender, IncrementalGP, run_recommender
+
+
+def layout_candidates(strip_list, *, per_strip=25):
+    """
+    Candidate (Ti, temperature, annealing_time, thickness) points.
+
+    Parameters
+    ----------
+    strip_list : List[StripInfo]
+
+    per_strip : int, optional
+        Number of Ti fractions to sample along each strip
+
+    Returns
+    -------
+    candidates : array, shape (N, 4)
+    """
+    return np.concatenate(
+        [
+            np.column_stack(
+                [
+                    np.linspace(strip.ti_min + 1, strip.ti_max - 1, per_strip),
+                    np.full(per_strip, strip.temperature),
+                    np.full(per_strip, strip.annealing_time),
+                    np.full(per_strip, strip.thickness),
+                ]
+            )
+            for strip in strip_list
+        ]
+    ).astype(float)
+
+
+class _TimedQueue:
+    """
+    One end of a request / reply pair of queues that times the round trip.
+
+    Every `put` on the *requests* side is answered by exactly one item on
+    the *replies* side, the time from the put to the `get` that returns
+    the answer is appended to *latencies*.
+    """
+
+    def __init__(self, queue, sent, latencies=None):
+        self._queue = queue
+        self._sent = sent
+        self._latencies = latencies
+
+    def put(self, item, *args, **kwargs):
+        self._sent.append(time.time())
+        self._queue.put(item, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        item = self._queue.get(*args, **kwargs)
+        if self._sent:
+            self._latencies.append(time.time() - self._sent.popleft())
+        return item
+
+
+class RecommenderProcess:
+    """
+    Run a recommendation engine in a separate process.
+
+    The instance is the ``to_recommender`` document callback of
+    `adaptive_plan`: for every event it ships the independent and
+    dependent values (not the documents) to the worker, which replies
+    with one recommendation on ``from_recommender``.
+
+    Parameters
+    ----------
+    make_engine : Callable[[], engine]
+        Called in the worker process, which is spawned (not forked from
+        the session), so it must be picklable: a class or function from
+        an importable module or a ``functools.partial`` of one.  The
+        engine must have ``tell(x, y)`` and ``ask() -> dict``, see
+        `GPRecommender` in xpd_workers.recommender.
+
+    independent_keys : List[str]
+        Event keys of the independent variables, in the order the
+        engine expects them
+
+    dependent_key : str
+        Event key of the measured value
+
+    max_points : int, optional
+        Post None (stop) after this many observations
+
+    If the engine raises, the worker prints the traceback, posts None
+    (so `adaptive_plan` stops instead of waiting for its timeout) and
+    exits.
+
+    Example
+    -------
+    >>> keys = ["ctrl_Ti", "ctrl_temp", "ctrl_annealing_time", "ctrl_thickness"]
+    >>> rec = RecommenderProcess(
+    ...     functools.partial(GPRecommender, layout_candidates(single_data), keys),
+    ...     independent_keys=keys, dependent_key="pe1c_stats1_total")
+    >>> rec.start()
+    >>> RE(adaptive_plan(..., to_recommender=rec,
+    ...                  from_recommender=rec.from_recommender))
+    >>> rec.stop(); rec.latencies(), rec.compute_times()
+    """
+
+    def __init__(self, make_engine, *, independent_keys, dependent_key, max_points=None):
+        # never fork the session: the RunEngine and the Channel Access
+        # threads and locks would be copied into the worker
+        self._ctx = multiprocessing.get_context("spawn")
+        self.make_engine = make_engine
+        self.independent_keys = list(independent_keys)
+        self.dependent_key = dependent_key
+        self.max_points = max_points
+        self._inbox = self._ctx.Queue()
+        self._outbox = self._ctx.Queue()
+        self._stats = self._ctx.Queue()
+        self._compute_times = []
+        self._latencies = []
+        # time the round trip on this side, as adaptive_plan sees it
+        sent = collections.deque()
+        self.to_recommender = _TimedQueue(self._inbox, sent)
+        self.from_recommender = _TimedQueue(self._outbox, sent, self._latencies)
+        self._process = None
+
+    def start(self):
+        self._process = self._ctx.Process(
+            target=run_recommender,
+            args=(
+                self.make_engine,
+                self._inbox,
+                self._outbox,
+                self._stats,
+                self.max_points,
+                (self.independent_keys, self.dependent_key),
+            ),
+            daemon=True,
+        )
+        self._process.start()
+
+    def stop(self, timeout=5):
+        if self._process is None:
+            return
+        self._inbox.put(None)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+
+    def __call__(self, name, doc):
+        if name != "event":
+            return
+        data = doc["data"]
+        keys = self.independent_keys + [self.dependent_key]
+        if not all(k in data for k in keys):
+            return
+        x = tuple(float(data[k]) for k in self.independent_keys)
+        self.to_recommender.put((x, float(data[self.dependent_key])))
+
+    def reduced_bridge(self, **kwargs):
+        """
+        A `ReducedDataBridge` feeding this recommender.
+
+        Use it as the ``to_recommender`` callback instead of the instance
+        itself, the keyword arguments are passed through.
+        """
+        return ReducedDataBridge(
+            self.to_recommender,
+            self.independent_keys + [self.dependent_key],
+            **kwargs,
+        )
+
+    def latencies(self):
+        """
+        Seconds from observation sent to recommendation received.
+
+        Measured in this process, so it includes both queue trips and
+        any time the reply waited to be picked up.
+        """
+        return np.array(self._latencies)
+
+    def compute_times(self):
+        """Seconds the worker spent on each observation, see `latencies`."""
+        while True:
+            try:
+                self._compute_times.append(self._stats.get(block=False))
+            except Empty:
+                break
+        return np.array(self._compute_times)
+
+
+class RadialIntegrator:
+    """
+    Azimuthal average of an image about a fixed center.
+
+    The bin of every pixel is computed once, each image is then reduced
+    with one `numpy.bincount`.
+
+    Parameters
+    ----------
+    shape : (rows, cols)
+        The image shape
+
+    center : (row, col)
+        The beam center, in pixels
+
+    n_bins : int, optional
+        Number of radial bins, from the center to the farthest corner
+    """
+
+    def __init__(self, shape, center, *, n_bins=500):
+        rows, cols = np.indices(shape)
+        r = np.hypot(rows - center[0], cols - center[1]).ravel()
+        self.n_bins = n_bins
+        self.edges = np.linspace(0, r.max() * (1 + 1e-9), n_bins + 1)
+        self._index = np.digitize(r, self.edges) - 1
+        self._counts = np.bincount(self._index, minlength=n_bins)
+
+    @property
+    def radii(self):
+        return (self.edges[1:] + self.edges[:-1]) / 2
+
+    def __call__(self, image):
+        sums = np.bincount(
+            self._index, np.asarray(image, dtype=float).ravel(), minlength=self.n_bins
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / self._counts
+
+
+class ReducedDataBridge:
+    """
+    Ship only the values a recommender needs, as numpy records.
+
+    A document callback to use as the ``to_recommender`` of
+    `adaptive_plan` in front of a recommender that runs elsewhere.  For
+    every event (or event page) it puts one structured array on *queue*
+    with the requested *keys* (stats totals, ROI sums, ``ctrl`` pseudo
+    positions, ...) plus ``seq_num`` and ``time``, instead of the whole
+    document.
+
+    Parameters
+    ----------
+    queue : Queue
+        Where the records go
+
+    keys : List[str]
+        Event keys to extract.  The dtype comes from the descriptor,
+        keys missing from a stream are left out of its records.
+
+    image_key : str, optional
+        Event key of an image to integrate
+
+    load_image : Callable[[Any], array], optional
+        Turns the (unfilled) value of *image_key* into an image, for
+        example a datum id into the frame
+
+    integrate : Callable[[array], array], optional
+        Reduces the image, with an ``n_bins`` attribute, see
+        `RadialIntegrator`.  The result goes in the ``integrated`` field.
+        Loading and integrating happens on a worker thread so it is off
+        the critical path of the plan.  The stop document only tells the
+        thread to exit when it is done, the next start document (or
+        `close`) waits for that.
+
+    Example
+    -------
+    >>> bridge = ReducedDataBridge(
+    ...     q, ["pe1c_stats1_total", "ctrl_Ti", "ctrl_temp"],
+    ...     image_key="pe1c_image", load_image=db.reg.retrieve,
+    ...     integrate=RadialIntegrator((2048, 2048), (1024, 1024)))
+    >>> RE(adaptive_plan(..., to_recommender=bridge, ...))
+    """
+
+    def __init__(self, queue, keys, *, image_key=None, load_image=None, integrate=None):
+        self.queue = queue
+        self.keys = list(keys)
+        self.image_key = image_key
+        self.load_image = load_image
+        self.integrate = integrate
+        self._dtypes = {}
+        self._work = Queue()
+        self._worker = None
+        self._ending = False
+        if integrate is not None and image_key is None:
+            raise ValueError("integrate needs an image_key")
+
+    def _dtype(self, data_keys):
+        fields = [("seq_num", "i8"), ("time", "f8")]
+        for k in self.keys:
+            if k in data_keys:
+                fields.append((k, "f8", tuple(data_keys[k].get("shape") or ())))
+        if self.integrate is not None and self.image_key in data_keys:
+            fields.append(("integrated", "f8", (self.integrate.n_bins,)))
+        return np.dtype(fields)
+
+    def __call__(self, name, doc):
+        if name == "descriptor":
+            self._dtypes[doc["uid"]] = self._dtype(doc["data_keys"])
+        elif name == "event":
+            self._ship(
+                doc["descriptor"],
+                [doc["seq_num"]],
+                [doc["time"]],
+                {k: [v] for k, v in doc["data"].items()},
+            )
+        elif name == "event_page":
+            self._ship(doc["descriptor"], doc["seq_num"], doc["time"], doc["data"])
+        elif name == "start":
+            # the images of the last run, normally done by now
+            self.close()
+        elif name == "stop":
+            self._end_run()
+
+    def _end_run(self):
+        if self._worker is not None and not self._ending:
+            self._work.put(None)
+            self._ending = True
+
+    def close(self):
+        """Wait for the pending integrations and stop the worker thread."""
+        self._end_run()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+            self._ending = False
+
+    def _ship(self, descriptor, seq_num, times, data):
+        dtype = self._dtypes.get(descriptor)
+        if dtype is None:
+            return
+        records = np.zeros(len(seq_num), dtype=dtype)
+        records["seq_num"] = seq_num
+        records["time"] = times
+        for k in dtype.names[2:]:
+            if k in data:
+                records[k] = data[k]
+        if "integrated" in dtype.names:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._integrate_worker, daemon=True
+                )
+                self._worker.start()
+            self._work.put((records, data[self.image_key]))
+        else:
+            self.queue.put(records)
+
+    def _integrate_worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            records, images = item
+            for record, image in zip(records, images):
+                if self.load_image is not None:
+                    image = self.load_image(image)
+                record["integrated"] = self.integrate(image)
+            self.queue.put(records)
+
+
+def benchmark_gp(n_observations=(10, 100, 300, 1000), *, n_candidates=2000, budget=1):
+    """
+    Time GP updates + recommendations against the recommender timeout.
+
+    For each number of observations, prints the time to add one more
+    observation and recommend, both incrementally and by re-factoring
+    the kernel matrix from scratch.
+    """
+    rng = np.random.default_rng(0)
+    candidates = rng.uniform(0, 1, (n_candidates, 4))
+    print(f"{'n':>6} {'incremental':>12} {'refit':>12}  budget {budget}s")
+    for n in n_observations:
+        engine = GPRecommender(candidates, "abcd")
+        X = rng.uniform(0, 1, (n + 1, 4))
+        y = np.sin(X.sum(axis=1) * 3)
+        for x, v in zip(X[:-1], y[:-1]):
+            engine.tell(x, v)
+
+        t0 = time.perf_counter()
+        engine.tell(X[-1], y[-1])
+        engine.ask()
+        incremental = time.perf_counter() - t0
+
+        gp = engine.gp
+        t0 = time.perf_counter()
+        K = gp.kernel(X, X) + gp.noise**2 * np.eye(len(X))
+        L = np.linalg.cholesky(K)
+        K_s = gp.kernel(X, candidates)
+        alpha = scipy.linalg.cho_solve((L, True), (y - y.mean()) / (y.std() or 1))
+        v = scipy.linalg.solve_triangular(L, K_s, lower=True)
+        np.argmax(K_s.T @ alpha + engine.kappa * np.sqrt(1 - np.sum(v**2, axis=0)))
+        refit = time.perf_counter() - t0
+
+        print(f"{n:>6} {incremental:>11.4f}s {refit:>11.4f}s")
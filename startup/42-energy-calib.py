@@ -1,39 +1,460 @@
 from __future__ import division, print_function
+import glob
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
-from lmfit.models import VoigtModel, LinearModel
-from scipy.signal import argrelmax
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import gaussian_filter1d, maximum_filter1d
 import matplotlib.pyplot as plt
 
+# the lmfit fit runs in the spawned pool too, xpd_workers is on sys.path,
+# see 04-recommender.py
+from xpd_workers.ecal import lmfit_peak as _lmfit_peak, run_chi_offset_sweep
+
 
 def lamda_from_bragg(th, d, n):
     return 2 * d * np.sin(th / 2.) / n
 
 
+# dictionary of references, also used by the Ecal plans in 91-plans-ecal.py
+D_SPACINGS = {'LaB6': np.array([4.15772, 2.94676, 2.40116]),
+              'Si': 5.43095 / np.array([np.sqrt(3), np.sqrt(8), np.sqrt(11), np.sqrt(27)]),
+             }
+
+
+Peaks = namedtuple(
+    "Peaks", ["index", "left", "right", "height", "prominence", "width"]
+)
+
+
+def noise_level(patterns):
+    """
+    Robust estimate of the point to point noise of each pattern
+
+    The median absolute deviation of the first difference, so smooth
+    features (peaks, background) do not count.
+    """
+    patterns = np.atleast_2d(np.asarray(patterns, dtype=float))
+    d = np.diff(patterns, axis=-1)
+    mad = np.median(np.abs(d - np.median(d, axis=-1, keepdims=True)), axis=-1)
+    return mad / 0.6745 / np.sqrt(2)
+
+
+def detect_peaks(patterns, distance=20, min_height=None, min_prominence=None,
+                 snr=5., rel_prominence=0.01, wlen=None, sides=None,
+                 noise=None, smooth=2.):
+    """
+    Find the peaks of one or many 1D patterns
+
+    A peak is the maximum within +-distance points whose prominence
+    (height above the higher of the lowest points within wlen on either
+    side) clears a noise adaptive threshold. The maxima, prominences and
+    widths are taken from the pattern smoothed over a few points, so the
+    noise does not make peaks of its own, the threshold is set from the
+    noise of the raw pattern.
+
+    Parameters
+    ----------
+    patterns: ndarray
+        A pattern or a stack of patterns of the same length, (M, N)
+    distance: int
+        The minimum separation of peaks, in points
+    min_height: float, optional
+        The minimum peak height
+    min_prominence: float, optional
+        The minimum prominence, on top of the noise threshold
+    snr: float
+        The prominence must be at least snr times the noise level
+    rel_prominence: float
+        The prominence must be at least this fraction of the range of
+        the pattern
+    wlen: int, optional
+        The window for the prominence and width, defaults to 4 *
+        distance
+    sides: int, optional
+        Use fixed +-sides fit windows, by default the windows are 1.5
+        times the full width at half prominence on each side
+    noise: float or ndarray, optional
+        The noise level of each pattern, see noise_level
+    smooth: float
+        The sigma of the gaussian smoothing, in points, 0 for none
+
+    Returns
+    -------
+    Peaks or list of Peaks:
+        index, fit window [left, right), height, prominence and full
+        width at half prominence (in points) of each peak, a list when
+        given a stack of patterns
+    """
+    patterns = np.asarray(patterns, dtype=float)
+    single = patterns.ndim == 1
+    y = np.atleast_2d(patterns)
+    n_pat, n = y.shape
+    distance = max(int(distance), 1)
+    if wlen is None:
+        wlen = 4 * distance
+    wlen = max(int(wlen), 1)
+    if noise is None:
+        noise = noise_level(y)
+    noise = np.broadcast_to(np.asarray(noise, dtype=float), (n_pat,))
+    raw = y
+    if smooth:
+        y = gaussian_filter1d(y, smooth, axis=-1, mode='nearest')
+
+    # local maxima, the first point of a flat top
+    is_max = y == maximum_filter1d(y, 2 * distance + 1, axis=-1, mode='nearest')
+    is_max[:, 1:] &= y[:, 1:] > y[:, :-1]
+    is_max[:, :-1] &= y[:, :-1] >= y[:, 1:]
+    is_max[:, [0, -1]] = False
+
+    # prominence from the minima within wlen either side
+    padded = np.pad(y, ((0, 0), (wlen, wlen)), mode='edge')
+    windows = sliding_window_view(padded, wlen + 1, axis=-1)
+    left_min = windows[:, :n].min(axis=-1)
+    right_min = windows[:, wlen:wlen + n].min(axis=-1)
+    prominence = y - np.maximum(left_min, right_min)
+
+    threshold = np.maximum(snr * noise, rel_prominence * np.ptp(raw, axis=-1))
+    if min_prominence is not None:
+        threshold = np.maximum(threshold, min_prominence)
+    keep = is_max & (prominence >= threshold[:, None])
+    if min_height is not None:
+        keep &= raw >= min_height
+    pat, idx = np.nonzero(keep)
+
+    # width at half prominence, from the +-wlen neighbourhood of each peak
+    offsets = np.arange(-wlen, wlen + 1)
+    hood = padded[pat[:, None], idx[:, None] + wlen + offsets]
+    level = y[pat, idx] - prominence[pat, idx] / 2
+    below = hood < level[:, None]
+    left_below = below[:, :wlen][:, ::-1]
+    right_below = below[:, wlen + 1:]
+    # the first point below the level on each side, wlen if there is none
+    left_k = np.where(left_below.any(axis=1), left_below.argmax(axis=1) + 1, wlen)
+    right_k = np.where(right_below.any(axis=1), right_below.argmax(axis=1) + 1, wlen)
+
+    def crossing(k, sign):
+        # interpolate between the last point above and the first below
+        rows = np.arange(len(k))
+        inner = hood[rows, wlen + sign * (k - 1)]
+        outer = hood[rows, wlen + sign * k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.where(inner != outer, (inner - level) / (inner - outer), 1.)
+        return k - 1 + np.clip(frac, 0, 1)
+
+    width = crossing(left_k, -1) + crossing(right_k, 1)
+    if sides is None:
+        half = np.maximum(np.ceil(1.5 * width), 3).astype(int)
+    else:
+        half = np.full(idx.shape, int(sides))
+    left = np.maximum(idx - half, 0)
+    right = np.minimum(idx + half + 1, n)
+
+    result = []
+    for j in range(n_pat):
+        sel = pat == j
+        result.append(Peaks(idx[sel], left[sel], right[sel], raw[j, idx[sel]],
+                            prominence[j, idx[sel]], width[sel]))
+    if single:
+        return result[0]
+    return result
+
+
 def find_peaks(chi, sides=6, intensity_threshold=0):
-    # Find all potential peaks
-    preliminary_peaks = argrelmax(chi, order=20)[0]
+    """
+    Return the fit windows and indices of the peaks in chi
 
-    # peaks must have at least sides pixels of data to work with
-    preliminary_peaks2 = preliminary_peaks[
-        np.where(preliminary_peaks < len(chi) - sides)]
+    The maxima of the raw pattern at least 20 points apart (detect_peaks
+    without the smoothing or the noise threshold) which have sides
+    points of data on their right and are at least twice as high as
+    the pattern sides points away on either side.
+
+    Parameters
+    ----------
+    chi: ndarray
+        The pattern
+    sides: int
+        The fit windows are +-sides points
+    intensity_threshold: float
+        The minimum peak height
 
+    Returns
+    -------
+    left_idxs, right_idxs, peak_centers: ndarray
+    """
+    chi = np.asarray(chi)
+    peaks = detect_peaks(chi, distance=20, min_height=intensity_threshold,
+                         snr=0, rel_prominence=0, smooth=0, sides=sides).index
+    # peaks must have at least sides pixels of data to work with
+    peaks = peaks[peaks < len(chi) - sides]
     # make certain that a peak has a drop off which causes the peak height to
     # be more than twice the height at sides pixels away
-    criteria = chi[preliminary_peaks2] >= 2 * chi[preliminary_peaks2 + sides]
-    criteria *= chi[preliminary_peaks2] >= 2 * chi[preliminary_peaks2 - sides]
-    criteria *= chi[preliminary_peaks2] >= intensity_threshold
+    criteria = chi[peaks] >= 2 * chi[peaks + sides]
+    criteria &= chi[peaks] >= 2 * chi[peaks - sides]
+    peaks = peaks[criteria]
+
+    left_idxs = np.maximum(peaks - sides, 0)
+    right_idxs = np.minimum(peaks + sides, len(chi))
+    return left_idxs, right_idxs, peaks
+
 
-    peaks = preliminary_peaks[np.where(criteria)]
+PeakFits = namedtuple(
+    "PeakFits",
+    ["center", "amplitude", "width", "eta", "slope", "intercept", "success"],
+)
 
-    left_idxs = peaks - sides
-    right_idxs = peaks + sides
-    peak_centers = peaks
-    left_idxs[left_idxs < 0] = 0
-    right_idxs[right_idxs > len(chi)] = len(chi)
-    return left_idxs, right_idxs, peak_centers
 
+def pseudo_voigt(x, amplitude, center, width, eta, slope=0, intercept=0):
+    """
+    Pseudo-Voigt peak on a linear background.
 
-def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False):
+    Parameters
+    ----------
+    amplitude : float
+        The peak height (above the background)
+    width : float
+        The half width at half maximum
+    eta : float
+        The Lorentzian fraction, 0 to 1
+    """
+    u = (x - center) / width
+    return (amplitude * (eta / (1 + u**2) + (1 - eta) * np.exp(-np.log(2) * u**2))
+            + slope * x + intercept)
+
+
+def _pseudo_voigt_jacobian(t, p):
+    """
+    Model and derivatives of the windowed pseudo-Voigt.
+
+    p is (K, 6): amplitude, center, width, eta, slope, intercept, t is
+    (K, L).  Returns f (K, L) and J (K, L, 6).
+    """
+    amplitude, center, width, eta, slope, intercept = (p[:, k, None] for k in range(6))
+    u = (t - center) / width
+    g = np.exp(-np.log(2) * u**2)
+    lor = 1 / (1 + u**2)
+    shape = eta * lor + (1 - eta) * g
+    # d shape / du
+    dshape = eta * (-2 * u * lor**2) + (1 - eta) * (-2 * np.log(2) * u * g)
+    f = amplitude * shape + slope * t + intercept
+    J = np.stack(
+        [
+            shape,
+            -amplitude * dshape / width,
+            -amplitude * dshape * u / width,
+            amplitude * (lor - g),
+            t,
+            np.ones_like(t),
+        ],
+        axis=-1,
+    )
+    return f, J
+
+
+def fit_peak_windows(x, y, left, right, centers=None, max_iter=100, tol=1e-10):
+    """
+    Fit a pseudo-Voigt plus a line to every window at once.
+
+    All the windows are fit together by Levenberg-Marquardt: the
+    Jacobian is block diagonal (6 parameters per window) so each
+    iteration is one batched 6x6 solve.
+
+    Parameters
+    ----------
+    x, y: ndarray
+        The full pattern
+    left, right: ndarray
+        The window of each peak, y[left:right]
+    centers: ndarray, optional
+        The index of each peak, defaults to the max of each window
+    max_iter: int
+        The maximum number of iterations
+
+    Returns
+    -------
+    PeakFits:
+        One entry per window, ``success`` is False if the fit did not
+        converge or the center left the window
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    left = np.asarray(left, dtype=int)
+    right = np.asarray(right, dtype=int)
+    n_win = len(left)
+    if n_win == 0:
+        empty = np.zeros(0)
+        return PeakFits(*[empty] * 6, np.zeros(0, dtype=bool))
+    length = int(np.max(right - left))
+    idx = left[:, None] + np.arange(length)
+    weight = (idx < right[:, None]).astype(float)
+    idx = np.clip(idx, 0, len(x) - 1)
+    X = x[idx]
+    Y = y[idx]
+    if centers is None:
+        centers = idx[np.arange(n_win), np.argmax(np.where(weight > 0, Y, -np.inf), axis=1)]
+    # fit in coordinates local to each window so the background is
+    # well conditioned
+    x_ref = x[np.asarray(centers, dtype=int)]
+    T = X - x_ref[:, None]
+
+    # initial guess: a line through the window ends, a peak on top of it
+    last = right - left - 1
+    t0, t1 = T[:, 0], T[np.arange(n_win), last]
+    y0, y1 = Y[:, 0], Y[np.arange(n_win), last]
+    slope = np.where(t1 != t0, (y1 - y0) / np.where(t1 != t0, t1 - t0, 1), 0)
+    intercept = y0 - slope * t0
+    height = np.max(np.where(weight > 0, Y - (slope[:, None] * T + intercept[:, None]), -np.inf), axis=1)
+    above = (Y - (slope[:, None] * T + intercept[:, None])) > height[:, None] / 2
+    step = np.median(np.abs(np.diff(x))) if len(x) > 1 else 1.0
+    width = np.maximum(np.sum(above * weight, axis=1) * step / 2, step)
+    p = np.column_stack(
+        [height, np.zeros(n_win), width, np.full(n_win, 0.5), slope, intercept]
+    )
+
+    def cost(p):
+        f, _ = _pseudo_voigt_jacobian(T, p)
+        return np.sum(weight * (Y - f) ** 2, axis=1)
+
+    lam = np.full(n_win, 1e-3)
+    current = cost(p)
+    converged = np.zeros(n_win, dtype=bool)
+    for _ in range(max_iter):
+        f, J = _pseudo_voigt_jacobian(T, p)
+        Jw = J * weight[..., None]
+        JTJ = np.einsum("kli,klj->kij", Jw, J)
+        g = np.einsum("kli,kl->ki", Jw, Y - f)
+        diag = np.einsum("kii->ki", JTJ)
+        A = JTJ + (lam[:, None] * np.maximum(diag, 1e-12))[:, :, None] * np.eye(6)
+        try:
+            dp = np.linalg.solve(A, g[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            dp = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(A, g)])
+        dp[converged] = 0
+        trial = p + dp
+        trial[:, 2] = np.maximum(np.abs(trial[:, 2]), step / 100)
+        trial[:, 3] = np.clip(trial[:, 3], 0, 1)
+        new = cost(trial)
+        better = new <= current
+        p = np.where(better[:, None], trial, p)
+        converged |= better & (current - new <= tol * np.maximum(current, 1e-300))
+        current = np.where(better, new, current)
+        lam = np.where(better, lam / 3, lam * 3)
+        if np.all(converged):
+            break
+
+    center = p[:, 1] + x_ref
+    success = (
+        converged
+        & np.all(np.isfinite(p), axis=1)
+        & (center >= np.minimum(X[:, 0], X[np.arange(n_win), last]))
+        & (center <= np.maximum(X[:, 0], X[np.arange(n_win), last]))
+    )
+    return PeakFits(
+        center,
+        p[:, 0],
+        p[:, 2],
+        p[:, 3],
+        p[:, 4],
+        p[:, 5] - p[:, 4] * x_ref,
+        success,
+    )
+
+
+def fit_peak_centers(x, y, l, r, c, engine='lmfit', plot=False, processes=None):
+    """
+    Fit the center of every peak window.
+
+    Parameters
+    ----------
+    x, y: ndarray
+        The pattern
+    l, r, c: ndarray
+        The windows and peak indices, see find_peaks
+    engine: {'lmfit', 'batch', 'pool'}
+        'lmfit' fits a Voigt on a line to one window at a time, 'pool'
+        does that in a process pool and 'batch' fits a pseudo-Voigt to
+        all the windows at once (see fit_peak_windows), falling back to
+        lmfit for the windows that fail. 'batch' is much faster but is
+        not the same peak shape, see benchmark_peak_fits
+    plot: bool
+        If true plot the fits
+    processes: int, optional
+        The size of the pool
+
+    Returns
+    -------
+    ndarray:
+        The peak centers
+    """
+    windows = [(x[lidx:ridx], y[lidx:ridx]) for lidx, ridx in zip(l, r)]
+    if engine == 'batch':
+        fits = fit_peak_windows(x, y, l, r, c)
+        centers = fits.center.copy()
+        best_fits = [
+            pseudo_voigt(subx, *params)
+            for (subx, _), params in zip(windows, zip(*fits[:-1]))
+        ]
+        for j in np.flatnonzero(~fits.success):
+            centers[j], best_fits[j] = _lmfit_peak(*windows[j])
+    elif engine == 'lmfit':
+        centers, best_fits = zip(*[_lmfit_peak(subx, suby) for subx, suby in windows]) if windows else ((), ())
+    elif engine == 'pool':
+        # spawn, forking the live session takes its threads and locks along
+        with ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn')
+        ) as pool:
+            results = list(pool.map(_lmfit_peak, *zip(*windows))) if windows else []
+        centers, best_fits = zip(*results) if results else ((), ())
+    else:
+        raise ValueError("unknown engine {!r}".format(engine))
+    if plot:
+        for (subx, suby), best_fit in zip(windows, best_fits):
+            plt.plot(subx, best_fit, '--')
+            plt.plot(subx, suby - best_fit, '.')
+    return np.asarray(centers, dtype=float)
+
+
+def wavelength_from_centers(lmfit_centers, d_spacings, ns, verbose=True):
+    """
+    Return the wavelength from the fitted symmetric peak centers
+
+    Returns
+    -------
+    float:
+        The average wavelength
+    float:
+        The standard deviation of the wavelength
+    float:
+        The two theta offset
+    """
+    lmfit_centers = np.array(lmfit_centers, dtype=float)
+    n_sym_peaks = len(lmfit_centers)//2
+    offset = []
+    for i in range(0, n_sym_peaks):
+        o = (np.abs(lmfit_centers[i]) -  np.abs(lmfit_centers[2*n_sym_peaks-i-1]))/2.
+        # print(o)
+        offset.append(o)
+    lmfit_centers += np.median(offset)
+    if verbose:
+        print('predicted offset {}'.format(np.median(offset)))
+        print(lmfit_centers)
+    wavelengths = []
+    l_peaks = lmfit_centers[lmfit_centers < 0.]
+    r_peaks = lmfit_centers[lmfit_centers > 0.]
+    for peak_set in [r_peaks, l_peaks[::-1]]:
+        for peak_center, d, n in zip(peak_set, d_spacings, ns):
+            tth = np.deg2rad(np.abs(peak_center))
+            wavelengths.append(lamda_from_bragg(tth, d, n))
+    return np.average(wavelengths), np.std(wavelengths), np.median(offset)
+
+
+def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False, engine='lmfit'):
     """
     Return the wavelength from a two theta scan of a standard
 
@@ -49,56 +470,82 @@ def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False):
         the multiplicity of the reflection
     plot: bool
         If true plot some of the intermediate data
+    engine: {'lmfit', 'batch', 'pool'}
+        How to fit the peaks, see fit_peak_centers
     Returns
     -------
     float:
         The average wavelength
     float:
         The standard deviation of the wavelength
+    float:
+        The two theta offset
     """
     l, r, c = find_peaks(y, sides=12)
-    n_sym_peaks = len(c)//2
-    lmfit_centers = []
-    for lidx, ridx, peak_center in zip(l, r, c):
-        suby = y[lidx:ridx]
-        subx = x[lidx:ridx]
-        mod1 = VoigtModel()
-        mod2 = LinearModel()
-        pars1 = mod1.guess(suby, x=subx)
-        pars2 = mod2.make_params(slope=0, intercept=0)
-        mod = mod1+mod2
-        pars = pars1+pars2
-        out = mod.fit(suby, pars, x=subx)
-        lmfit_centers.append(out.values['center'])
-        if plot:
-            plt.plot(subx, out.best_fit, '--')
-            plt.plot(subx, suby - out.best_fit, '.')
-    lmfit_centers = np.asarray(lmfit_centers)
+    lmfit_centers = fit_peak_centers(x, y, l, r, c, engine=engine, plot=plot)
     if plot:
         plt.plot(x, y, 'b')
         plt.plot(x[c], y[c], 'ro')
         plt.plot(x, np.zeros(x.shape), 'k.')
         plt.show()
+    return wavelength_from_centers(lmfit_centers, d_spacings, ns)
 
-    offset = []
-    for i in range(0, n_sym_peaks):
-        o = (np.abs(lmfit_centers[i]) -  np.abs(lmfit_centers[2*n_sym_peaks-i-1]))/2.
-        # print(o)
-        offset.append(o)
-    print('predicted offset {}'.format(np.median(offset)))
-    lmfit_centers += np.median(offset)
-    print(lmfit_centers)
-    wavelengths = []
-    l_peaks = lmfit_centers[lmfit_centers < 0.]
-    r_peaks = lmfit_centers[lmfit_centers > 0.]
-    for peak_set in [r_peaks, l_peaks[::-1]]:
-        for peak_center, d, n in zip(peak_set, d_spacings, ns):
-            tth = np.deg2rad(np.abs(peak_center))
-            wavelengths.append(lamda_from_bragg(tth, d, n))
-    return np.average(wavelengths), np.std(wavelengths), np.median(offset)
 
+def synthetic_std_tth(d_spacings, wavelength, n_points=3000, tth_max=None,
+                      offset=0, hwhm=0.02, eta=0.3, noise=0.01, seed=0):
+    """
+    Symmetric two theta scan of a standard, like a mirrored .chi file.
 
-from bluesky.callbacks import CollectThenCompute
+    Returns
+    -------
+    x, y: ndarray
+    """
+    rng = np.random.default_rng(seed)
+    tths = np.degrees(2 * np.arcsin(wavelength / (2 * np.asarray(d_spacings))))
+    if tth_max is None:
+        tth_max = 1.1 * np.max(tths)
+    half = np.linspace(tth_max / n_points, tth_max, n_points // 2)
+    x = np.hstack((-half[::-1], half)) + offset
+    y = np.full(x.shape, 0.05)
+    for j, tth in enumerate(tths):
+        for sign in (-1, 1):
+            y += pseudo_voigt(x, 1 / (1 + j), sign * tth + offset, hwhm, eta)
+    y += noise * rng.standard_normal(x.shape)
+    return x, y
+
+
+def benchmark_peak_fits(n_points=(3000, 12000), d_spacings=None, wavelength=0.1828,
+                        engines=('lmfit', 'pool', 'batch')):
+    """
+    Time fit_peak_centers on synthetic .chi sized standard scans.
+
+    Prints the time per engine and the largest center difference to the
+    lmfit loop.
+    """
+    if d_spacings is None:
+        # LaB6, a = 4.15692
+        hkl = np.array([[1, 0, 0], [1, 1, 0], [1, 1, 1], [2, 0, 0], [2, 1, 0],
+                        [2, 1, 1], [2, 2, 0], [3, 0, 0], [3, 1, 0], [3, 1, 1]])
+        d_spacings = 4.15692 / np.sqrt(np.sum(hkl**2, axis=1))
+    for n in n_points:
+        x, y = synthetic_std_tth(d_spacings, wavelength, n_points=n,
+                                 hwhm=0.01 * 3000 / n)
+        l, r, c = find_peaks(y, sides=12)
+        print('{} points, {} peaks'.format(len(x), len(c)))
+        reference = None
+        for engine in engines:
+            t0 = time.perf_counter()
+            centers = fit_peak_centers(x, y, l, r, c, engine=engine)
+            elapsed = time.perf_counter() - t0
+            if reference is None:
+                reference = centers
+            print('  {:>6}: {:8.4f}s  max |center - {}| {:.2e}'.format(
+                engine, elapsed, engines[0], np.max(np.abs(centers - reference))))
+
+
+import bluesky.plan_stubs as bps
+import bluesky.preprocessors as bpp
+from bluesky.callbacks import CallbackBase, CollectThenCompute
 
 
 class ComputeWavelength(CollectThenCompute):
@@ -143,35 +590,302 @@ class ComputeWavelength(CollectThenCompute):
         print('wavelength', self.wavelength, '+-', self.wavelength_std)
         print('energy', self.energy)
 
-"""
-if __name__ == '__main__':
-    import os
-
-    # step 0 load data
-    calibration_file = os.path.join('../../data/LaB6_d.txt')
-    d_spacings = np.loadtxt(calibration_file)
-
-    for data_file in ['../../data/Lab6_67p8.chi', '../../data/Lab6_67p6.chi']:
-        a = np.loadtxt(data_file)
-        wavechange = []
-        x = a[:, 0]
-        #x = np.hstack((np.zeros(1), x))
-        x = np.hstack((-x[::-1], x))
-        y = a[:, 1]
-        #y = np.hstack((np.zeros(1), y))
-        y = np.hstack((y[::-1], y))
-        b = np.linspace(0, 3, 100)
-        for dx in b:
-            print('added offset {}'.format(dx))
-            off_x = x[:] + dx
-            rv1, rv2, rv3 = get_wavelength_from_std_tth(off_x, y, d_spacings,
-                    np.ones(d_spacings.shape),
-#plot=True
-                    )
-            print(rv1, rv2, rv3)
-            print()
-            wavechange.append(rv1)
-            #input()
-        plt.plot(b, wavechange/np.mean(wavechange))
-    plt.show()
-"""
+
+class StreamingComputeWavelength(CallbackBase):
+    """
+    ComputeWavelength which works on the data as it arrives
+
+    The scan is kept in growable numpy buffers instead of the event
+    documents. Peaks are picked with detect_peaks as soon as there is
+    enough data on their right, fit when found, and the
+    wavelength and offset are re-estimated from the symmetric peak pairs
+    seen so far. At stop the whole scan is refit with
+    get_wavelength_from_std_tth.
+
+    Example
+    -------
+    >>> cw = StreamingComputeWavelength('tth_cal', 'some_detector', d_spacings)
+    >>> RE(ecal_tth_scan([some_detector], tth_cal, -10, 10, 2000, cw))
+    """
+    CONVERSION_FACTOR = ComputeWavelength.CONVERSION_FACTOR
+
+    def __init__(self, x_name, y_name, d_spacings, ns=None, sides=12,
+                 intensity_threshold=0, order=20, n_pairs=None,
+                 capacity=1024, verbose=True):
+        self.x_name = x_name
+        self.y_name = y_name
+        self.d_spacings = np.asarray(d_spacings)
+        if ns is None:
+            self.ns = np.ones(self.d_spacings.shape)
+        else:
+            self.ns = ns
+        self.sides = sides
+        self.intensity_threshold = intensity_threshold
+        self.order = order
+        if n_pairs is None:
+            n_pairs = len(self.d_spacings)
+        self.n_pairs = n_pairs
+        self.capacity = capacity
+        self.verbose = verbose
+        self._reset()
+
+    def _reset(self):
+        self._x = np.empty(self.capacity)
+        self._y = np.empty(self.capacity)
+        self._n = 0
+        # every index below this has been checked for a peak
+        self._checked = 0
+        self.peaks = np.zeros(0, dtype=int)
+        self.centers = np.zeros(0)
+        # (number of points, wavelength, std, offset, pairs)
+        self.estimates = []
+        self.wavelength = None
+        self.wavelength_std = None
+        self.offset = None
+
+    @property
+    def x(self):
+        return self._x[:self._n]
+
+    @property
+    def y(self):
+        return self._y[:self._n]
+
+    @property
+    def energy(self):
+        if self.wavelength is None:
+            return None
+        else:
+            return self.CONVERSION_FACTOR / self.wavelength
+
+    @property
+    def pairs(self):
+        """The number of symmetric peak pairs fit so far"""
+        return min(np.sum(self.centers < 0), np.sum(self.centers > 0))
+
+    @property
+    def resolved(self):
+        return self.pairs >= self.n_pairs
+
+    def start(self, doc):
+        self._reset()
+
+    def event(self, doc):
+        if self._n == len(self._x):
+            self._x = np.resize(self._x, 2 * len(self._x))
+            self._y = np.resize(self._y, 2 * len(self._y))
+        self._x[self._n] = doc['data'][self.x_name]
+        self._y[self._n] = doc['data'][self.y_name]
+        self._n += 1
+        peaks = self._new_peaks()
+        if len(peaks):
+            x, y = self.x, self.y
+            left = np.maximum(peaks - self.sides, 0)
+            right = np.minimum(peaks + self.sides, self._n)
+            centers = fit_peak_centers(x, y, left, right, peaks)
+            self.peaks = np.append(self.peaks, peaks)
+            self.centers = np.append(self.centers, centers)
+            self._estimate()
+
+    def stop(self, doc):
+        if not self.resolved:
+            print('only {} of {} peak pairs were resolved'.format(
+                self.pairs, self.n_pairs))
+        if self.pairs == 0:
+            return
+        self.wavelength, self.wavelength_std, self.offset = get_wavelength_from_std_tth(
+            self.x, self.y, self.d_spacings, self.ns)
+        print('wavelength', self.wavelength, '+-', self.wavelength_std)
+        print('energy', self.energy)
+
+    def _new_peaks(self):
+        """detect_peaks on the points which now have enough data to their
+        right"""
+        n = self._n
+        # detect_peaks looks 4 * order points either side
+        margin = 4 * self.order
+        hi = n - max(margin, self.sides)
+        lo = self._checked
+        if hi <= lo:
+            return np.zeros(0, dtype=int)
+        self._checked = hi
+        start = max(lo - margin, 0)
+        peaks = detect_peaks(self.y[start:], distance=self.order,
+                             min_height=self.intensity_threshold)
+        idx = peaks.index + start
+        return idx[(idx >= lo) & (idx < hi)]
+
+    def _estimate(self):
+        # pair the peaks from the middle out, the scan has crossed zero
+        # by the time there is anything to pair
+        left = np.sort(self.centers[self.centers < 0])[::-1]
+        right = np.sort(self.centers[self.centers > 0])
+        k = min(len(left), len(right))
+        if k == 0:
+            return
+        offset = np.median((np.abs(left[:k]) - right[:k]) / 2.)
+        wavelengths = []
+        for peak_set in [right[:k], left[:k]]:
+            for peak_center, d, n in zip(peak_set + offset, self.d_spacings, self.ns):
+                tth = np.deg2rad(np.abs(peak_center))
+                wavelengths.append(lamda_from_bragg(tth, d, n))
+        self.wavelength = np.average(wavelengths)
+        self.wavelength_std = np.std(wavelengths)
+        self.offset = offset
+        self.estimates.append(
+            (self._n, self.wavelength, self.wavelength_std, self.offset, k))
+        if self.verbose:
+            print('{} pairs after {} points: wavelength {:.6f} +- {:.6f}, '
+                  'offset {:.4f}'.format(k, self._n, self.wavelength,
+                                         self.wavelength_std, self.offset))
+
+
+def ecal_tth_scan(detectors, motor, start, stop, num, cw, *, md=None):
+    """
+    Step scan a standard which stops once the peaks are resolved
+
+    Parameters
+    ----------
+    detectors : list
+    motor : Positioner
+        The two theta motor, tth_cal
+    start, stop : float
+        The scan range, through zero
+    num : int
+        The maximum number of points
+    cw : StreamingComputeWavelength
+        Subscribed for the scan, the scan stops when ``cw.resolved``
+    md : dict, optional
+    """
+    detectors = list(detectors)
+    positions = np.linspace(start, stop, num)
+    _md = {'detectors': [det.name for det in detectors],
+           'motors': [motor.name],
+           'plan_args': {'detectors': list(map(repr, detectors)),
+                         'motor': repr(motor), 'start': start,
+                         'stop': stop, 'num': num},
+           'plan_name': 'ecal_tth_scan',
+           'num_points': num,
+           'hints': {'dimensions': [([motor.name], 'primary')]}}
+    _md.update(md or {})
+
+    @bpp.subs_decorator(cw)
+    @bpp.stage_decorator(detectors + [motor])
+    @bpp.run_decorator(md=_md)
+    def inner():
+        for i, pos in enumerate(positions):
+            yield from bps.mv(motor, pos)
+            yield from bps.trigger_and_read(detectors + [motor])
+            # the event has been through cw by now
+            if cw.resolved:
+                print('{} peak pairs resolved after {} of {} points'.format(
+                    cw.pairs, i + 1, num))
+                break
+
+    return (yield from inner())
+
+def load_chi(path):
+    """
+    Load a .chi file as a symmetric two theta scan
+
+    The pattern is mirrored about zero so it looks like a tth_cal scan
+    through the beam.
+
+    Returns
+    -------
+    x, y: ndarray
+    """
+    a = np.loadtxt(path)
+    x = a[:, 0]
+    x = np.hstack((-x[::-1], x))
+    y = a[:, 1]
+    y = np.hstack((y[::-1], y))
+    return x, y
+
+
+def chi_offset_sweep(path, d_spacings, offsets=(0,), ns=None, engine='lmfit'):
+    """
+    Wavelength of one .chi file for each added two theta offset
+
+    The peaks are found and fit once, adding an offset to x moves every
+    fitted center by the same amount so the sweep only redoes
+    wavelength_from_centers.
+
+    Returns
+    -------
+    list of dict:
+        One row per offset, see batch_chi_calibration
+    """
+    d_spacings = np.asarray(d_spacings)
+    if ns is None:
+        ns = np.ones(d_spacings.shape)
+    x, y = load_chi(path)
+    l, r, c = find_peaks(y, sides=12)
+    centers = fit_peak_centers(x, y, l, r, c, engine=engine)
+    rows = []
+    for dx in offsets:
+        wavelength, wavelength_std, offset = wavelength_from_centers(
+            centers + dx, d_spacings, ns, verbose=False)
+        rows.append({'file': os.path.basename(path),
+                     'added_offset': dx,
+                     'n_peaks': len(centers),
+                     'wavelength': wavelength,
+                     'wavelength_std': wavelength_std,
+                     'offset': offset,
+                     'energy': ComputeWavelength.CONVERSION_FACTOR / wavelength})
+    return rows
+
+
+def batch_chi_calibration(paths, d_spacings, offsets=(0,), ns=None,
+                          processes=None, engine='lmfit'):
+    """
+    Energy calibration of many .chi files
+
+    Parameters
+    ----------
+    paths: str or list of str
+        .chi files, directories or glob patterns
+    d_spacings: ndarray
+        the dspacings of the standard
+    offsets: sequence of float
+        Two theta offsets to add to each file, eg np.linspace(0, 3, 100)
+    ns: ndarray, optional
+        the multiplicity of the reflections
+    processes: int, optional
+        The size of the process pool, 1 to run in this process
+    engine: {'lmfit', 'batch'}
+        How to fit the peaks, see fit_peak_centers
+
+    Returns
+    -------
+    DataFrame:
+        One row per file and offset, with the wavelength, its standard
+        deviation, the fitted offset and the energy
+
+    Example
+    -------
+    >>> df = batch_chi_calibration('../../data/*.chi', D_SPACINGS['LaB6'],
+    ...                            offsets=np.linspace(0, 3, 100))
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, '*.chi')
+        files.extend(sorted(glob.glob(path)))
+    kwargs = dict(d_spacings=d_spacings, offsets=list(offsets), ns=ns,
+                  engine=engine)
+    if processes == 1 or len(files) < 2:
+        results = [chi_offset_sweep(path, **kwargs) for path in files]
+    else:
+        # spawn, forking the live session takes its threads and locks
+        # along, the workers load this file themselves
+        with ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn')
+        ) as pool:
+            results = list(pool.map(partial(run_chi_offset_sweep, **kwargs), files))
+    return pd.DataFrame(
+        [row for rows in results for row in rows],
+        columns=['file', 'added_offset', 'n_peaks', 'wavelength',
+                 'wavelength_std', 'offset', 'energy'])
@@ -1,4 +1,9 @@
+import functools
+import itertools
+import threading
 import time as ttime
+
+import bluesky.plan_stubs as bps
 from copy import deepcopy
 from ophyd.areadetector import (PerkinElmerDetector, ImagePlugin,
                                 TIFFPlugin, StatsPlugin, HDF5Plugin,
@@ -301,6 +306,163 @@ class PerkinElmerContinuousStage(PerkinElmerContinuous):
 
 
 
+class AreaDetectorConfigCache:
+    """
+    Remember the exposure configurations applied to each area detector.
+
+    Wrap a plan ``configure(det, *args) -> (num_frame, acq_time,
+    computed_exposure)`` with `wrap`.  If the same configuration was the
+    last one applied to *det* the plan returns the remembered result
+    without reading or putting anything.  If it was applied before (for
+    example switching between a short and a long exposure) only the
+    signals that differ from the current configuration are put.
+
+    The signals the configurations leave behind (``cam.acquire_time``,
+    ``images_per_set``) are monitored and everything known about a
+    detector is dropped as soon as one of them changes to anything other
+    than the currently applied value (someone changed it in CSS or from
+    another plan).
+    """
+
+    def __init__(self):
+        # det -> {request: (applied, result)}
+        self._known = {}
+        # det -> the request currently applied
+        self._current = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.switches = 0
+        self.misses = 0
+
+    def lookup(self, det, request):
+        """
+        Returns
+        -------
+        result : tuple or None
+            The remembered result, None if *request* must be configured
+
+        changes : Dict[Signal, Any]
+            What to put to switch to *request*, empty if it is current
+        """
+        with self._lock:
+            known = self._known.get(det, {})
+            current = self._current.get(det)
+            if request not in known or current not in known:
+                self.misses += 1
+                # about to be configured, the puts are expected
+                self._current.pop(det, None)
+                return None, {}
+            applied, result = known[request]
+            if current == request:
+                self.hits += 1
+                return result, {}
+            self.switches += 1
+            now = known[current][0]
+            changes = {
+                sig: v
+                for sig, v in applied.items()
+                if sig not in now or not self._same(now[sig], v)
+            }
+            # the puts are expected, do not let the monitors invalidate
+            self._current[det] = request
+            return result, changes
+
+    def record(self, det, request, applied, result):
+        """
+        Remember *result* for *request*, now applied to *det*.
+
+        Parameters
+        ----------
+        applied : Dict[Signal, Any]
+            The value each signal was left at
+        """
+        for sig in applied:
+            self._watch(det, sig)
+        with self._lock:
+            self._known.setdefault(det, {})[request] = (dict(applied), result)
+            self._current[det] = request
+
+    def invalidate(self, det=None):
+        """Forget *det*, or every detector."""
+        with self._lock:
+            if det is None:
+                self._known.clear()
+                self._current.clear()
+            else:
+                self._known.pop(det, None)
+                self._current.pop(det, None)
+
+    def _watch(self, det, sig):
+        if (det, sig) in self._watched:
+            return
+        self._watched.add((det, sig))
+        sig.subscribe(functools.partial(self._changed, det, sig), run=False)
+
+    @staticmethod
+    def _same(a, b):
+        try:
+            return bool(np.isclose(a, b))
+        except TypeError:
+            return a == b
+
+    def _changed(self, det, sig, *, value, **kwargs):
+        with self._lock:
+            known = self._known.get(det, {})
+            current = self._current.get(det)
+            if current not in known or sig not in known[current][0]:
+                return
+            if not self._same(value, known[current][0][sig]):
+                self._known.pop(det, None)
+                self._current.pop(det, None)
+
+    def wrap(self, configure, *, det=None, key=None):
+        """
+        Cache the detector configuration plan *configure*.
+
+        By default *configure* takes the detector first.  For a plan that
+        finds the detector itself, like xpdacq's
+        ``_configure_area_det(exposure)``, pass *det*, called to get the
+        detector, and *key*, called to get anything else (not in the
+        arguments) the result depends on.
+        """
+
+        @functools.wraps(configure)
+        def cached_configure(*args):
+            if det is None:
+                ad, args = args[0], args[1:]
+                configure_ad = functools.partial(configure, ad)
+            else:
+                ad = det()
+                configure_ad = configure
+            request = (configure.__qualname__,) + args
+            if key is not None:
+                request += tuple(key())
+            result, changes = self.lookup(ad, request)
+            if result is not None:
+                if changes:
+                    yield from bps.mov(*itertools.chain(*changes.items()))
+                num_frame, acq_time, computed_exposure = result
+                print(
+                    "INFO: {} already configured for computed exposure time"
+                    "= {}".format(ad.name, computed_exposure)
+                )
+                return result
+            result = yield from configure_ad(*args)
+            num_frame, acq_time, computed_exposure = result
+            if acq_time is not None and hasattr(ad, "cam"):
+                applied = {ad.cam.acquire_time: acq_time}
+                if hasattr(ad, "images_per_set"):
+                    applied[ad.images_per_set] = num_frame
+                self.record(ad, request, applied, result)
+            return result
+
+        return cached_configure
+
+
+ad_config_cache = AreaDetectorConfigCache()
+
+
 # PE1/2/3 PV prefixes in one place:
 pe1_pv_prefix = 'XF:28IDC-ES:1{Det:PE1}'
 #pe2_pv_prefix = 'XF:28IDC-ES:1{Det:PE1}'
@@ -1,5 +1,12 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 from lmfit import Model, Parameter, Parameters
 from lmfit.lineshapes import voigt
+from ophyd.status import Status
 
 def initialize_ecal():
     '''
@@ -33,10 +40,7 @@ def finalize_ecal():
     yield from bps.mov(fb.flt4, 0)
 
 
-# dictionary of references
-D_SPACINGS = {'LaB6': np.array([4.15772, 2.94676, 2.40116]),
-              'Si': 5.43095 / np.array([np.sqrt(3), np.sqrt(8), np.sqrt(11), np.sqrt(27)]),
-             }
+# the dictionary of references, D_SPACINGS, is in 42-energy-calib.py
 
 # Helper functions
 def peakfunc(x, amplitude, sigma, x0, slope, intercept):
@@ -46,7 +50,7 @@ def peakfunc(x, amplitude, sigma, x0, slope, intercept):
     result += slope*x + intercept
     return result
 
-def guess(xdata, ydata, sigma=None):
+def guess(xdata, ydata, sigma=None, verbose=True):
     '''
         sigma is often hard to guess, allow it to be externally guessed
     '''
@@ -56,10 +60,12 @@ def guess(xdata, ydata, sigma=None):
     dip_amp = np.min(ydata) - g_average
     peak_amp = np.max(ydata) - g_average
     if np.abs(dip_amp) > peak_amp:
-        print("found a dip")
+        if verbose:
+            print("found a dip")
         g_amp = dip_amp
     else:
-        print("found a peak")
+        if verbose:
+            print("found a peak")
         g_amp = peak_amp
 
     if sigma is None:
@@ -81,7 +87,9 @@ def guess(xdata, ydata, sigma=None):
                   'intercept': Parameter('intercept', value=g_average,vary=True),
                   'slope': Parameter('slope', value=0, vary=True),
                  }
-    params = Parameters(init_guess)
+    # Parameters(dict) is not a set of parameters in newer lmfit
+    params = Parameters()
+    params.add_many(*init_guess.values())
     return params
 
 
@@ -97,12 +105,12 @@ def ispeak(x, y, sdev=2):
     return peak > sdev*noise
 
 
-def guess_and_fit(xdata, ydata, sigma=None):
+def guess_and_fit(xdata, ydata, sigma=None, verbose=True):
     '''
         Guess fit and return results.
     '''
     peakmodel = Model(peakfunc, independent_vars=['x'])
-    init_guess = guess(xdata, ydata, sigma=sigma)
+    init_guess = guess(xdata, ydata, sigma=sigma, verbose=verbose)
     return peakmodel.fit(data=ydata, x=xdata, params=init_guess)
 
 def guess_theta_from_reference(wguess, D="Si"):
@@ -132,10 +140,138 @@ def wavelength_from_theta(theta, d):
     '''
     return 2*d*np.sin(np.radians(theta))
 
+DEFAULT_THETA_OFFSET = -35.26
+ECAL_HISTORY_PATH = Path("~/.cache/xpd_profile/ecal_history.sqlite").expanduser()
+
+
+class EcalHistory:
+    '''
+        Append only record of the Ecal results, per reference
+
+        Parameters
+        ----------
+        path : str or Path, optional
+            the sqlite file, defaults to ECAL_HISTORY_PATH
+    '''
+    COLUMNS = ('time', 'reference', 'wavelength', 'theta_offset', 'sigma',
+               'motor', 'motor_type', 'plan_name')
+
+    def __init__(self, path=None):
+        if path is None:
+            path = ECAL_HISTORY_PATH
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ecal ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, "
+                "reference TEXT NOT NULL, wavelength REAL NOT NULL, "
+                "theta_offset REAL NOT NULL, sigma REAL, motor TEXT, "
+                "motor_type TEXT, plan_name TEXT)")
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path))
+
+    def append(self, reference, wavelength, theta_offset, sigma=None, *,
+               motor=None, motor_type='th', plan_name='Ecal', timestamp=None):
+        if reference not in D_SPACINGS:
+            raise ValueError("unknown reference {!r}, expected one of {}".format(
+                reference, sorted(D_SPACINGS)))
+        if timestamp is None:
+            timestamp = time.time()
+        row = (timestamp, reference, float(wavelength), float(theta_offset),
+               None if sigma is None else float(sigma), motor, motor_type,
+               plan_name)
+        with self._connect() as conn:
+            conn.execute("INSERT INTO ecal ({}) VALUES ({})".format(
+                ", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS))), row)
+
+    def entries(self, reference=None, *, motor=None, motor_type=None,
+                max_age=None):
+        '''
+            The matching entries, newest first, as dicts
+
+            max_age : float, optional
+                only entries newer than this, in s
+        '''
+        query, args = [], []
+        for column, value in (('reference', reference), ('motor', motor),
+                              ('motor_type', motor_type)):
+            if value is not None:
+                query.append("{} = ?".format(column))
+                args.append(value)
+        if max_age is not None:
+            query.append("time >= ?")
+            args.append(time.time() - max_age)
+        sql = "SELECT {} FROM ecal".format(", ".join(self.COLUMNS))
+        if query:
+            sql += " WHERE " + " AND ".join(query)
+        sql += " ORDER BY time DESC, id DESC"
+        with self._connect() as conn:
+            rows = conn.execute(sql, args).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def latest(self, reference, **kwargs):
+        '''
+            The most recent matching entry, or None, see entries
+        '''
+        entries = self.entries(reference, **kwargs)
+        return entries[0] if entries else None
+
+
+# opened the first time it is needed, not when the profile loads
+_ecal_history = None
+
+
+def get_ecal_history():
+    '''
+        The history at ECAL_HISTORY_PATH
+    '''
+    global _ecal_history
+    if _ecal_history is None:
+        _ecal_history = EcalHistory()
+    return _ecal_history
+
+
+def _resolve_history(history):
+    '''
+        True is the default history, None or False is none
+    '''
+    if history is True:
+        return get_ecal_history()
+    return history or None
+
+
+def _record_ecal(history, D, wavelength, theta_offset, results_list, motor,
+                 motor_type, plan_name):
+    if history is None:
+        return
+    sigma = np.mean([res.best_values['sigma'] for res in results_list])
+    history.append(D, wavelength, theta_offset, sigma, motor=motor.name,
+                   motor_type=motor_type, plan_name=plan_name)
+
+
+def _matches_prediction(xdata, res, theta_guess, half_width, sigma):
+    '''
+        True if the narrow scan found a dip near the predicted position
+        with about the predicted width
+    '''
+    amplitude = res.params['amplitude']
+    if not res.success or amplitude.stderr is None:
+        return False
+    x0 = res.best_values['x0']
+    fitted_sigma = res.best_values['sigma']
+    return (np.abs(amplitude.value) > 3 * amplitude.stderr and
+            np.abs(x0 - theta_guess) < half_width and
+            np.min(xdata) < x0 < np.max(xdata) and
+            sigma / 3 < fitted_sigma < 3 * sigma)
+
+
 # New calibration scan plan
-def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=120, D='Si', detector_name='sc_chan1',
-              theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5,
-              output_file="result.csv", motor_type='th'):
+def Ecal(wguess=None, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=120, D='Si', detector_name='sc_chan1',
+              theta_offset=None, nsigma_fine=.1, nsigma_range=5,
+              output_file="result.csv", motor_type='th', history=True,
+              warm_nsigma=5, max_age=None):
     '''
         This is the new Ecal scan for dips.
             We should treat peaks separately to simplify matters (leaves for
@@ -145,9 +281,15 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
         This algorithm will search for a peak within a certain theta range
             The theta range is determined from the wavelength guess
 
+        With a history the last compatible result (same reference, motor
+        and motor type) fills in wguess and theta_offset and each dip is
+        first scanned over +/- warm_nsigma of its last fitted sigma. The
+        wide coarse scan is only run if that does not find the dip.
+
         Parameters
         ----------
         wguess : the guessed wavelength
+            Defaults to the last result in the history
         detectors : list, optional
             list of detectors. Defaults to [sc] detector
         motor : motor, optional
@@ -165,6 +307,7 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
         
         theta_offset : float, optional
             the offset of theta zero estimated from the sample
+            Defaults to the last result in the history, or -35.26
         nsigma_fine : float, optional
             the fraction of sigma per point for the fine scan
             (the sigma used is the fitted sigma)
@@ -175,6 +318,14 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
             the coarse scan
         motor_type : str, optional
             the type of motor used, ether "th" (theta) or "tth"(two-theta)
+        history : EcalHistory, optional
+            where to warm start from and record an accepted result, None
+            for neither. Defaults to True, the history at
+            ECAL_HISTORY_PATH
+        warm_nsigma : float, optional
+            the half width of the warm start scan, in fitted sigmas
+        max_age : float, optional
+            ignore history older than this, in s
 
         Example
         -------
@@ -185,6 +336,27 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
     factors = dict(th=1, tth=2)
     factor = factors[motor_type]
 
+    history = _resolve_history(history)
+    last = None
+    if history is not None:
+        last = history.latest(D, motor=motor.name, motor_type=motor_type,
+                              max_age=max_age)
+    if last is not None:
+        print("Last {} Ecal on {}: wavelength {} theta offset {}".format(
+            D, time.ctime(last['time']), last['wavelength'], last['theta_offset']))
+        if wguess is None:
+            wguess = last['wavelength']
+        if theta_offset is None:
+            theta_offset = last['theta_offset']
+    if wguess is None:
+        raise ValueError("no {} Ecal in the history, give wguess".format(D))
+    if theta_offset is None:
+        theta_offset = DEFAULT_THETA_OFFSET
+    # narrow the coarse scans to the last fitted width
+    warm_half_width = None
+    if last is not None and last['sigma']:
+        warm_half_width = warm_nsigma * last['sigma']
+
     # first guess the theta positions
     # TODO : do for two theta
     cen_guesses = guess_theta_from_reference(wguess, D=D)
@@ -213,63 +385,90 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
     xdata_total = list()
     ydata_total = list()
     results_list = list()
+    # the fine fits run on a worker while the motor goes to the next dip,
+    # the figures are drawn at the end
+    fine_fits = list()
+    figures = list()
     cnt = 0
-    # TODO : this should be a plan on its own
-    for theta_guess in peak_guesses:
-        cnt += 1
-        # scan the first peak
-        # the number of points for each side
-        npoints = coarse_nsteps
-        start, stop = theta_guess - coarse_step*npoints, theta_guess + coarse_step*npoints
-        # reverse to go negative
-        start, stop = stop, start
-        print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
-        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
-        # TODO : check if a peak was found here
-        # (can use ispeak(... , sdev=2)
-        # find the position c1 in terms of theta
-
-        xdata = lp.x_data
-        ydata = lp.y_data
-
-        peakmodel = Model(peakfunc, independent_vars=['x'])
-        init_guess = guess(xdata, ydata, sigma=coarse_step/10.)
-        res = peakmodel.fit(data=ydata, x=xdata, params=init_guess)
-        fitted_sigma = res.best_values['sigma']
-
-        print("guess: {}".format(init_guess))
-
-        plt.figure('fitting coarse {}'.format(cnt));plt.clf()
-        plt.plot(lp.x_data, lp.y_data, linewidth=0, marker='o', color='b', label="data")
-        plt.plot(lp.x_data, res.best_fit, color='r', label="fit")
-        plt.plot(init_guess['x0'].value, init_guess['amplitude'].value +
-                 init_guess['intercept'].value, 'ro')
+    fit_pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        # TODO : this should be a plan on its own
+        for theta_guess in peak_guesses:
+            cnt += 1
+            found = False
+            if warm_half_width is not None:
+                npoints = max(int(np.ceil(2 * warm_half_width / coarse_step)), 11)
+                start, stop = theta_guess + warm_half_width, theta_guess - warm_half_width
+                print("Warm start. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
+                yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
+                xdata = np.array(lp.x_data)
+                ydata = np.array(lp.y_data)
+                res, init_guess, _ = _timed_fit(xdata, ydata, coarse_step/10.)
+                found = _matches_prediction(xdata, res, theta_guess, warm_half_width, last['sigma'])
+                if not found:
+                    print("The dip is not where the history puts it, running the wide scan")
+            if not found:
+                # scan the first peak
+                # the number of points for each side
+                npoints = coarse_nsteps
+                start, stop = theta_guess - coarse_step*npoints, theta_guess + coarse_step*npoints
+                # reverse to go negative
+                start, stop = stop, start
+                print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
+                yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
+                # TODO : check if a peak was found here
+                # (can use ispeak(... , sdev=2)
+                # find the position c1 in terms of theta
+
+                xdata = np.array(lp.x_data)
+                ydata = np.array(lp.y_data)
+
+                # the fine scan needs this one
+                res, init_guess, _ = _timed_fit(xdata, ydata, coarse_step/10.)
+            fitted_sigma = res.best_values['sigma']
+
+            print("guess: {}".format(init_guess))
+            figures.append(('fitting coarse {}'.format(cnt), xdata, ydata, res, init_guess))
+
+            # best guess of center position
+            new_theta_guess = res.best_values['x0']
+            print("Found center at {}, running finer scan".format(new_theta_guess))
+            start, stop = new_theta_guess - fitted_sigma*nsigma_range, new_theta_guess + fitted_sigma*nsigma_range
+            # force number of steps to yield a step size of approx sigma_fine
+            npoints = int(np.abs(stop-start)/fitted_sigma)
+            # reverse to go negative
+            start, stop = stop, start
+            print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
+            yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
+
+            xdata = np.array(lp.x_data)
+            ydata = np.array(lp.y_data)
+            fine_fits.append((cnt, xdata, ydata,
+                              fit_pool.submit(_timed_fit, xdata, ydata, coarse_step/10., False)))
 
-        # best guess of center position
-        new_theta_guess = res.best_values['x0']
-        print("Found center at {}, running finer scan".format(new_theta_guess))
-        start, stop = new_theta_guess - fitted_sigma*nsigma_range, new_theta_guess + fitted_sigma*nsigma_range
-        # force number of steps to yield a step size of approx sigma_fine
-        npoints = int(np.abs(stop-start)/fitted_sigma)
-        # reverse to go negative
-        start, stop = stop, start
-        print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
-        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
-
-        xdata = lp.x_data
-        ydata = lp.y_data
-
-        peakmodel = Model(peakfunc, independent_vars=['x'])
-        init_guess = guess(xdata, ydata, sigma=coarse_step/10.)
-        res = peakmodel.fit(data=ydata, x=xdata, params=init_guess)
-
-        plt.figure('fitting fine {}'.format(cnt));plt.clf()
-        plt.plot(lp.x_data, lp.y_data, linewidth=0, marker='o', color='b', label="data")
-        plt.plot(lp.x_data, res.best_fit, color='r', label="fit")
+        print("{:>4} {:>8} {:>8} {:>8}".format('dip', 'fit', 'hidden', 'waited'))
+        for cnt, xdata, ydata, future in fine_fits:
+            t_join = time.monotonic()
+            res, init_guess, fit_time = future.result()
+            waited = time.monotonic() - t_join
+            # the part of the fit done while the plan went on
+            print("{:>4} {:>7.2f}s {:>7.2f}s {:>7.2f}s".format(
+                cnt, fit_time, max(fit_time - waited, 0), waited))
+            figures.append(('fitting fine {}'.format(cnt), xdata, ydata, res, init_guess))
+            results_list.append(res)
+    finally:
+        # on an abort or a failed fit drop the queued fits, the worker
+        # exits once the one it is on returns
+        fit_pool.shutdown(wait=False, cancel_futures=True)
+
+    t_plot = time.monotonic()
+    for name, xdata, ydata, res, init_guess in figures:
+        plt.figure(name);plt.clf()
+        plt.plot(xdata, ydata, linewidth=0, marker='o', color='b', label="data")
+        plt.plot(xdata, res.best_fit, color='r', label="fit")
         plt.plot(init_guess['x0'].value, init_guess['amplitude'].value +
                  init_guess['intercept'].value, 'ro')
-
-        results_list.append(res)
+    print("plotting took {:.2f}s".format(time.monotonic() - t_plot))
 
     # now convert peak to cen 
     # just use first peak for now
@@ -277,6 +476,43 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
     peak_left_cen = results_list[0].best_values['x0']
     peak_right_cen = results_list[1].best_values['x0']
 
+    fitted_wavelength, new_theta_offset = wavelength_from_dips(
+        peak_left_cen, peak_right_cen, D=D, factor=factor)
+    print("Are you happy with results? (y/n)")
+    prompt_result = yield from bps.input_plan(">")
+    if prompt_result.strip().lower() == "y":
+        print("Great. Finalizing the Ecal...")
+        # only what is kept goes in the history to warm start from
+        _record_ecal(history, D, fitted_wavelength, new_theta_offset,
+                     results_list, motor, motor_type, 'Ecal')
+        #yield from finalize_ecal()
+    else:
+        print("ok, not finalizing. Please run this again")
+
+    # in case we want access to the results list
+    myresult.results_list = results_list
+    myresult.wavelength = fitted_wavelength
+
+
+def _timed_fit(xdata, ydata, sigma, verbose=True):
+    '''
+        Fit a dip as Ecal does, returns the fit, the guess and the time
+        it took
+    '''
+    t0 = time.monotonic()
+    peakmodel = Model(peakfunc, independent_vars=['x'])
+    init_guess = guess(xdata, ydata, sigma=sigma, verbose=verbose)
+    res = peakmodel.fit(data=ydata, x=xdata, params=init_guess)
+    return res, init_guess, time.monotonic() - t0
+
+
+def wavelength_from_dips(peak_left_cen, peak_right_cen, D='Si', factor=1):
+    '''
+        Get the wavelength and theta offset from a symmetric pair of dips
+        of the first reflection of D
+
+        factor : 1 for a theta motor, 2 for a two theta motor
+    '''
     new_theta_offset = (peak_left_cen+peak_right_cen)*.5
     average_peak_theta = (np.abs(peak_left_cen-new_theta_offset) +
                           np.abs(peak_right_cen-new_theta_offset))*.5
@@ -288,20 +524,514 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
     fitted_wavelength = wavelength_from_theta(average_peak_theta/factor,
                                               D_SPACINGS[D][0])
     print("Fitted wavelength is {} angs".format(fitted_wavelength))
-    print("Are you happy with results? (y/n)")
-    prompt_result = yield from bps.input_plan(">")
-    if prompt_result.lower() == "y":
-        print("ok, not finalizing. Please run this again")
-    else:
-        print("Great. Finalizing the Ecal...")
-        #yield from finalize_ecal()
-
-    # in case we want access to the results list
-    myresult.results_list = results_list
-    myresult.wavelength = fitted_wavelength
+    return fitted_wavelength, new_theta_offset
 
 
 class MyResult:
     pass
 
 myresult = MyResult()
+
+
+def _ecal_point(detectors, motor, position, detector_name):
+    '''
+        Move, count and return the (motor, detector) values
+    '''
+    yield from bps.mv(motor, position)
+    reading = yield from bps.trigger_and_read(list(detectors) + [motor])
+    return reading[motor.name]['value'], reading[detector_name]['value']
+
+
+def _dip_localized(res, xdata, center_tol, nsigma):
+    '''
+        True if the fit has the center to within center_tol and the data
+        goes nsigma fitted sigmas past it on both sides
+    '''
+    x0 = res.params['x0']
+    sigma = res.params['sigma']
+    if not res.success or x0.stderr is None or sigma.stderr is None:
+        return False
+    return (x0.stderr < center_tol and
+            sigma.stderr < .5 * sigma.value and
+            np.min(xdata) < x0.value - nsigma * sigma.value and
+            np.max(xdata) > x0.value + nsigma * sigma.value)
+
+
+# the fine points go around x0 +- sigma, where the dip is steepest and a
+# point says the most about the center
+FINE_OFFSETS = (1, -1, .7, -.7, 1.3, -1.3)
+
+
+def Ecal_adaptive(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012,
+                  coarse_nsteps=120, D='Si', detector_name='sc_chan1',
+                  theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5,
+                  motor_type='th', min_coarse=10, nsigma_bracket=3,
+                  max_fine=30, confirm=True, history=True):
+    '''
+        Ecal which stops scanning once each dip is located.
+
+        The coarse scan is the same grid as Ecal but the dip is fit after
+        every point once it is seen, and the scan stops when the center
+        is known to within a coarse step and the data covers
+        nsigma_bracket fitted sigmas either side. Fine points are then
+        taken one at a time at x0 +- sigma, refitting all the data,
+        until the center is known to nsigma_fine * sigma.
+
+        At the end the number of points and time are compared with the
+        fixed grid of Ecal (coarse_nsteps and 2 * nsigma_range points
+        per dip) at the same time per point.
+
+        Parameters
+        ----------
+        wguess, detectors, motor, coarse_step, coarse_nsteps, D,
+        detector_name, theta_offset, nsigma_range, motor_type :
+            see Ecal
+        nsigma_fine : float, optional
+            the target uncertainty of each center, in fitted sigmas
+        min_coarse : int, optional
+            the coarse points before the first fit
+        nsigma_bracket : float, optional
+            how far past the dip the coarse scan must go
+        max_fine : int, optional
+            the most fine points per dip
+        confirm : bool, optional
+            ask if the result is ok, as Ecal does, only "y" keeps it
+        history : EcalHistory, optional
+            where to record an accepted result, None to not. Defaults
+            to True, the history at ECAL_HISTORY_PATH
+    '''
+    global myresult
+    factors = dict(th=1, tth=2)
+    factor = factors[motor_type]
+
+    cen_guesses = guess_theta_from_reference(wguess, D=D)
+    left_guesses, right_guesses = (theta_offset-cen_guesses,
+                                   theta_offset+cen_guesses)
+    peak_guesses = right_guesses[0], left_guesses[0]
+    print("Trying {} +/- {} = {} and {}".format(theta_offset, cen_guesses[0],
+                                                peak_guesses[0],
+                                                peak_guesses[1]))
+
+    fig = plt.figure(detector_name)
+    fig.clf()
+    ax = plt.gca()
+    lp = LivePlot(detector_name, x=motor.name, marker='o', ax=ax)
+
+    _md = {'plan_name': 'Ecal_adaptive',
+           'detectors': [det.name for det in detectors],
+           'motors': [motor.name],
+           'hints': {'dimensions': [([motor.name], 'primary')]}}
+
+    results_list = list()
+    report = list()
+    t_start = time.monotonic()
+    for cnt, theta_guess in enumerate(peak_guesses, 1):
+        t_dip = time.monotonic()
+        xdata, ydata = list(), list()
+        start, stop = theta_guess + coarse_step*coarse_nsteps, theta_guess - coarse_step*coarse_nsteps
+        print("Coarse scan of {} from {} to {}, stopping once the dip is found".format(
+            motor.name, start, stop))
+
+        # the run wrappers return the run uid, so the fit goes out in res
+        res = None
+
+        @bpp.subs_decorator(lp)
+        @bpp.run_decorator(md=dict(_md, ecal_stage='coarse', dip=cnt))
+        def coarse():
+            nonlocal res
+            for pos in np.linspace(start, stop, coarse_nsteps):
+                x, y = yield from _ecal_point(detectors, motor, pos, detector_name)
+                xdata.append(x)
+                ydata.append(y)
+                if len(xdata) < min_coarse or not ispeak(np.asarray(xdata), np.asarray(ydata), sdev=3):
+                    continue
+                res = guess_and_fit(np.asarray(xdata), np.asarray(ydata),
+                                    sigma=coarse_step/10., verbose=False)
+                if _dip_localized(res, xdata, coarse_step, nsigma_bracket):
+                    break
+
+        yield from bpp.stage_wrapper(coarse(), list(detectors))
+        n_coarse = len(xdata)
+        if res is None or not _dip_localized(res, xdata, coarse_step, nsigma_bracket):
+            print("Dip {} was not located in the coarse scan, fitting what there is".format(cnt))
+            res = guess_and_fit(np.asarray(xdata), np.asarray(ydata),
+                                sigma=coarse_step/10., verbose=False)
+        print("Found center at {} after {} of {} coarse points".format(
+            res.best_values['x0'], n_coarse, coarse_nsteps))
+
+        @bpp.subs_decorator(lp)
+        @bpp.run_decorator(md=dict(_md, ecal_stage='fine', dip=cnt))
+        def fine():
+            nonlocal res
+            for k in range(max_fine):
+                x0, sigma = res.best_values['x0'], res.best_values['sigma']
+                stderr = res.params['x0'].stderr
+                if stderr is not None and stderr < nsigma_fine * sigma:
+                    break
+                pos = x0 + FINE_OFFSETS[k % len(FINE_OFFSETS)] * sigma
+                x, y = yield from _ecal_point(detectors, motor, pos, detector_name)
+                xdata.append(x)
+                ydata.append(y)
+                res = guess_and_fit(np.asarray(xdata), np.asarray(ydata),
+                                    sigma=sigma, verbose=False)
+
+        stderr = res.params['x0'].stderr
+        if stderr is None or stderr >= nsigma_fine * res.best_values['sigma']:
+            yield from bpp.stage_wrapper(fine(), list(detectors))
+        n_fine = len(xdata) - n_coarse
+        print("Center {} +/- {} after {} fine points".format(
+            res.best_values['x0'], res.params['x0'].stderr, n_fine))
+
+        plt.figure('fitting adaptive {}'.format(cnt)); plt.clf()
+        plt.plot(xdata, ydata, linewidth=0, marker='o', color='b', label="data")
+        order = np.argsort(xdata)
+        plt.plot(np.asarray(xdata)[order], res.best_fit[order], color='r', label="fit")
+
+        results_list.append(res)
+        report.append(dict(dip=cnt, coarse=n_coarse, fine=n_fine,
+                           time=time.monotonic() - t_dip))
+
+    elapsed = time.monotonic() - t_start
+    points = sum(r['coarse'] + r['fine'] for r in report)
+    fixed_points = len(report) * (coarse_nsteps + int(2 * nsigma_range))
+    fixed_time = fixed_points * elapsed / points
+    print("{:>4} {:>7} {:>5} {:>8}".format('dip', 'coarse', 'fine', 'time'))
+    for r in report:
+        print("{dip:>4} {coarse:>7} {fine:>5} {time:>7.1f}s".format(**r))
+    print("{} points in {:.1f}s, the fixed grid is {} points, about {:.1f}s "
+          "({} points and {:.1f}s saved)".format(
+              points, elapsed, fixed_points, fixed_time,
+              fixed_points - points, fixed_time - elapsed))
+
+    peak_left_cen = results_list[0].best_values['x0']
+    peak_right_cen = results_list[1].best_values['x0']
+    fitted_wavelength, new_theta_offset = wavelength_from_dips(
+        peak_left_cen, peak_right_cen, D=D, factor=factor)
+
+    myresult.results_list = results_list
+    myresult.wavelength = fitted_wavelength
+    myresult.theta_offset = new_theta_offset
+    myresult.report = dict(dips=report, points=points, time=elapsed,
+                           fixed_points=fixed_points, fixed_time=fixed_time)
+
+    accepted = True
+    if confirm:
+        print("Are you happy with results? (y/n)")
+        prompt_result = yield from bps.input_plan(">")
+        accepted = prompt_result.strip().lower() == "y"
+        if accepted:
+            print("Great. Finalizing the Ecal...")
+        else:
+            print("ok, not finalizing. Please run this again")
+    if accepted:
+        _record_ecal(_resolve_history(history), D, fitted_wavelength,
+                     new_theta_offset, results_list, motor, motor_type,
+                     'Ecal_adaptive')
+    return fitted_wavelength
+
+
+class EcalFlyer:
+    """
+    Count a scaler in fixed time bins while a motor moves continuously.
+
+    The counting runs in a background thread, triggering the scaler back
+    to back until the motor arrives.  The motor readback is recorded with
+    its timestamps and the position of each bin is interpolated at the
+    middle of the bin, the bin edges are kept too.  A bin ends at the
+    timestamp of the scaler reading and starts preset_time before that,
+    so the bins and the readback are on the same (IOC) clock and the
+    Channel Access round trips do not shift them.
+
+    Parameters
+    ----------
+    scaler : Device
+        The counter, triggered once per bin (its preset time sets the bin)
+    motor : Positioner
+        The motor to fly, th_cal
+    motor_start, motor_stop : float
+    channel : str
+        The data key of the scaler channel to keep
+    """
+
+    def __init__(self, scaler, motor, motor_start, motor_stop,
+                 channel='sc_chan1', name="EcalFlyer"):
+        self.name = name
+        self.scaler = scaler
+        self.motor = motor
+        self.motor_start = motor_start
+        self.motor_stop = motor_stop
+        self.channel = channel
+        self.error = None
+        self._lock = threading.Lock()
+        self._times = []
+        self._positions = []
+        self._bins = []
+        self._cid = None
+        self._thread = None
+        self.motor_status = None
+        self._complete_status = None
+
+    def kickoff(self):
+        with self._lock:
+            self._times.clear()
+            self._positions.clear()
+        self._bins = []
+        self.error = None
+        self._complete_status = Status()
+        # to the start at whatever the velocity is, the flight starts
+        # when that move is done
+        st = self.motor.set(self.motor_start)
+        st.add_callback(self._fly)
+        return st
+
+    def _fly(self, status):
+        if not status.success:
+            self._complete_status.set_exception(
+                RuntimeError("{} did not reach the start".format(self.motor.name)))
+            return
+        self._record_position()
+        self._cid = self.motor.subscribe(
+            self._record, event_type=self.motor.SUB_READBACK, run=False
+        )
+        self.motor_status = self.motor.set(self.motor_stop)
+        self._thread = threading.Thread(target=self._count, daemon=True)
+        self._thread.start()
+
+    def _record_position(self):
+        reading = self.motor.read()[self.motor.name]
+        self._record(value=reading['value'], timestamp=reading['timestamp'])
+
+    def _count(self):
+        preset_time = getattr(self.scaler, 'preset_time', None)
+        if preset_time is not None:
+            preset_time = preset_time.get()
+        try:
+            while not self.motor_status.done:
+                t_trigger = time.time()
+                self.scaler.trigger().wait()
+                elapsed = time.time() - t_trigger
+                reading = self.scaler.read()[self.channel]
+                t1 = reading['timestamp']
+                # without a preset time the best there is is the host
+                # side duration
+                t0 = t1 - (elapsed if preset_time is None else preset_time)
+                self._bins.append((t0, t1, reading['value']))
+            # a stopped or failed move is only a partial pass
+            if not self.motor_status.success:
+                self.error = RuntimeError(
+                    "{} did not reach {}".format(self.motor.name, self.motor_stop))
+        except Exception as ex:
+            self.error = ex
+        finally:
+            if self._cid is not None:
+                self.motor.unsubscribe(self._cid)
+                self._cid = None
+            try:
+                self._record_position()
+            except Exception as ex:
+                self.error = self.error or ex
+            if self.error is None:
+                self._complete_status.set_finished()
+            else:
+                self._complete_status.set_exception(self.error)
+
+    def _record(self, *, value, timestamp=None, **kwargs):
+        with self._lock:
+            self._times.append(time.time() if timestamp is None else timestamp)
+            self._positions.append(value)
+
+    def complete(self):
+        return self._complete_status
+
+    def binned(self):
+        """
+        The bins so far
+
+        Returns
+        -------
+        x, x_start, x_stop, y, t : ndarray
+            The motor position at the middle, start and end of each bin,
+            the counts and the time of the middle of each bin
+        """
+        with self._lock:
+            times = np.asarray(self._times)
+            positions = np.asarray(self._positions, dtype=float)
+        if not self._bins:
+            empty = np.zeros(0)
+            return empty, empty, empty, empty, empty
+        t0, t1, counts = (np.asarray(v, dtype=float) for v in zip(*self._bins))
+        order = np.argsort(times, kind='stable')
+        times, positions = times[order], positions[order]
+        t = (t0 + t1) / 2
+
+        def at(when):
+            return np.interp(when, times, positions)
+
+        return at(t), at(t0), at(t1), counts, t
+
+    def describe_collect(self):
+        def key(source):
+            return {"dtype": "number", "shape": [], "source": source}
+
+        motor = self.motor.name
+        return {"primary": {
+            motor: key("interpolated from {} readback".format(motor)),
+            motor + "_start": key("interpolated from {} readback".format(motor)),
+            motor + "_stop": key("interpolated from {} readback".format(motor)),
+            self.channel: key(self.scaler.name),
+        }}
+
+    def collect(self):
+        motor = self.motor.name
+        for x, x0, x1, y, t in zip(*self.binned()):
+            data = {motor: x, motor + "_start": x0, motor + "_stop": x1,
+                    self.channel: y}
+            yield {
+                "data": data,
+                "timestamps": {key: t for key in data},
+                "time": t,
+                "filled": {key: True for key in data},
+            }
+
+    def collect_asset_docs(self):
+        yield from ()
+
+
+def _ecal_fly(scaler, motor, start, stop, count_time, step, channel, md, ax):
+    """
+    Fly motor from start to stop so each count_time bin covers step
+    """
+    speed = abs(step) / count_time
+    flyer = EcalFlyer(scaler, motor, start, stop, channel=channel)
+    print("Flying {} from {} to {} at {} / s".format(motor.name, start, stop, speed))
+    yield from bps.mv(motor, start)
+
+    @bpp.reset_positions_decorator([motor.velocity])
+    def inner():
+        yield from bps.mv(motor.velocity, speed)
+        # fly_stream is in 81_xpd_map_flyscan.py, the bins go out as one
+        # event page
+        yield from fly_stream([flyer], md=md, stream=False)
+
+    yield from inner()
+    x, _, _, y, _ = flyer.binned()
+    # one plot per pass, a LivePlot would redraw for every bin
+    ax.plot(x, y, marker='o', label=md.get('ecal_stage'))
+    ax.figure.canvas.draw_idle()
+    return x, y
+
+
+def Ecal_fly(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012,
+             coarse_nsteps=120, D='Si', detector_name='sc_chan1',
+             theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5,
+             motor_type='th', count_time=.05, confirm=True,
+             history=True):
+    """
+    Ecal with th_cal moving continuously and the scaler counting in bins.
+
+    Each dip is flown over the coarse range of Ecal at coarse_step per
+    bin, fit, then flown over +- nsigma_range fitted sigmas at
+    nsigma_fine sigmas per bin and fit again.  See EcalFlyer.
+
+    Parameters
+    ----------
+    wguess, motor, coarse_step, coarse_nsteps, D, detector_name,
+    theta_offset, nsigma_range, motor_type :
+        see Ecal
+    detectors : list, optional
+        the scaler, only one detector can be flown
+    nsigma_fine : float, optional
+        the fine bin width, in fitted sigmas
+    count_time : float, optional
+        the scaler time per bin, s
+    confirm : bool, optional
+        ask if the result is ok, as Ecal does, only "y" keeps it
+    history : EcalHistory, optional
+        where to record an accepted result, None to not. Defaults to
+        True, the history at ECAL_HISTORY_PATH
+    """
+    global myresult
+    scaler, = detectors
+    factors = dict(th=1, tth=2)
+    factor = factors[motor_type]
+
+    cen_guesses = guess_theta_from_reference(wguess, D=D)
+    left_guesses, right_guesses = (theta_offset-cen_guesses,
+                                   theta_offset+cen_guesses)
+    peak_guesses = right_guesses[0], left_guesses[0]
+    print("Trying {} +/- {} = {} and {}".format(theta_offset, cen_guesses[0],
+                                                peak_guesses[0],
+                                                peak_guesses[1]))
+
+    fig = plt.figure(detector_name)
+    fig.clf()
+    ax = plt.gca()
+    ax.set_xlabel(motor.name)
+    ax.set_ylabel(detector_name)
+
+    _md = {'plan_name': 'Ecal_fly',
+           'detectors': [scaler.name],
+           'motors': [motor.name],
+           'count_time': count_time,
+           'hints': {'dimensions': [([motor.name], 'primary')]}}
+
+    # the shared scaler gets its preset time back when the plan ends
+    presets = [scaler.preset_time] if hasattr(scaler, 'preset_time') else []
+
+    @bpp.reset_positions_decorator(presets)
+    def fly_dips():
+        if presets:
+            yield from bps.mv(scaler.preset_time, count_time)
+
+        results_list = list()
+        for cnt, theta_guess in enumerate(peak_guesses, 1):
+            start, stop = theta_guess + coarse_step*coarse_nsteps, theta_guess - coarse_step*coarse_nsteps
+            xdata, ydata = yield from _ecal_fly(
+                scaler, motor, start, stop, count_time, coarse_step, detector_name,
+                dict(_md, ecal_stage='coarse', dip=cnt), ax)
+            res = guess_and_fit(xdata, ydata, sigma=coarse_step/10.)
+            x0, fitted_sigma = res.best_values['x0'], res.best_values['sigma']
+            print("Found center at {}, flying a finer scan".format(x0))
+
+            start, stop = x0 + fitted_sigma*nsigma_range, x0 - fitted_sigma*nsigma_range
+            xdata, ydata = yield from _ecal_fly(
+                scaler, motor, start, stop, count_time, nsigma_fine*fitted_sigma,
+                detector_name, dict(_md, ecal_stage='fine', dip=cnt), ax)
+            res = guess_and_fit(xdata, ydata, sigma=fitted_sigma)
+
+            plt.figure('fitting fly {}'.format(cnt)); plt.clf()
+            plt.plot(xdata, ydata, linewidth=0, marker='o', color='b', label="data")
+            plt.plot(xdata, res.best_fit, color='r', label="fit")
+            results_list.append(res)
+        return results_list
+
+    t_start = time.monotonic()
+    results_list = yield from fly_dips()
+
+    elapsed = time.monotonic() - t_start
+    print("Ecal_fly took {:.1f}s".format(elapsed))
+
+    peak_left_cen = results_list[0].best_values['x0']
+    peak_right_cen = results_list[1].best_values['x0']
+    fitted_wavelength, new_theta_offset = wavelength_from_dips(
+        peak_left_cen, peak_right_cen, D=D, factor=factor)
+
+    myresult.results_list = results_list
+    myresult.wavelength = fitted_wavelength
+    myresult.theta_offset = new_theta_offset
+    myresult.report = dict(time=elapsed)
+
+    accepted = True
+    if confirm:
+        print("Are you happy with results? (y/n)")
+        prompt_result = yield from bps.input_plan(">")
+        accepted = prompt_result.strip().lower() == "y"
+        if accepted:
+            print("Great. Finalizing the Ecal...")
+        else:
+            print("ok, not finalizing. Please run this again")
+    if accepted:
+        _record_ecal(_resolve_history(history), D, fitted_wavelength,
+                     new_theta_offset, results_list, motor, motor_type,
+                     'Ecal_fly')
+    return fitted_wavelength
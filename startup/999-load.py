@@ -50,6 +50,23 @@ from xpdacq.xpdacq import *
 from xpdacq.beamtime import *
 from xpdacq.utils import import_sample_info
 
+# skip re-configuring the area detector when nothing changed since the last
+# plan, see AreaDetectorConfigCache.  Both names are rebound in the profile
+# namespace only, xpdacq itself is not patched: configure_area_det (from the
+# star import above, used by the fly scan in 81) and _configure_area_det (used
+# by 95-flash, 1001-remoteplan, 9999-acq-plans and 99999-gas-plan, which must
+# not re-import xpdacq's).  _configure_area_det finds the detector and the
+# frame time itself, so those are passed to the cache.
+import xpdacq.beamtime
+from xpdacq.xpdacq_conf import xpd_configuration
+
+configure_area_det = ad_config_cache.wrap(configure_area_det)
+_configure_area_det = ad_config_cache.wrap(
+    xpdacq.beamtime._configure_area_det,
+    det=lambda: xpd_configuration["area_det"],
+    key=lambda: (glbl["frame_acq_time"],),
+)
+
 # instantiate xrun without beamtime, like bluesky setup
 xrun = CustomizedRunEngine(None)
 xrun.md['beamline_id'] = glbl['beamline_id']
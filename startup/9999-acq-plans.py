@@ -1,7 +1,7 @@
 ### This plan is named 9999-* to have it after 999-load.py where xpdacq is configured ####
 ###  Created by Sanjit Ghose 28th Aug, 2017 during new BS/xpdAcq/an upgrades ########
 
-from xpdacq.beamtime import _configure_area_det
+# _configure_area_det is the cached one from 999-load
 import os
 import numpy as np
 import itertools
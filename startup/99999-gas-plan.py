@@ -4,7 +4,8 @@ import bluesky.plan_stubs as bps
 import bluesky.preprocessors as bpp
 
 from bluesky.callbacks import LiveTable, LivePlot
-from xpdacq.beamtime import (_configure_area_det, shutter_step,
+# _configure_area_det is the cached one from 999-load
+from xpdacq.beamtime import (shutter_step,
                              open_shutter_stub, close_shutter_stub,
                              _nstep)
 from xpdacq.xpdacq_conf import xpd_configuration
@@ -0,0 +1 @@
+"""Code the profile runs in worker processes, see the modules."""
@@ -0,0 +1,42 @@
+"""
+Energy calibration fits, importable so they can run in a spawned process.
+
+See ``fit_peak_centers`` and ``batch_chi_calibration`` in
+startup/42-energy-calib.py.
+"""
+import os
+
+from lmfit.models import LinearModel, VoigtModel
+
+_ENERGY_CALIB = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'startup', '42-energy-calib.py')
+_profile = None
+
+
+def lmfit_peak(subx, suby):
+    """Voigt + line lmfit of one window, returns (center, best_fit)."""
+    mod1 = VoigtModel()
+    mod2 = LinearModel()
+    pars1 = mod1.guess(suby, x=subx)
+    pars2 = mod2.make_params(slope=0, intercept=0)
+    mod = mod1+mod2
+    pars = pars1+pars2
+    out = mod.fit(suby, pars, x=subx)
+    return out.values['center'], out.best_fit
+
+
+def _energy_calib():
+    """The namespace of startup/42-energy-calib.py, run once per process."""
+    global _profile
+    if _profile is None:
+        ns = {'__name__': __name__ + '._profile'}
+        with open(_ENERGY_CALIB) as f:
+            exec(compile(f.read(), _ENERGY_CALIB, 'exec'), ns)
+        _profile = ns
+    return _profile
+
+
+def run_chi_offset_sweep(path, **kwargs):
+    """chi_offset_sweep of one .chi file, in a worker process."""
+    return _energy_calib()['chi_offset_sweep'](path, **kwargs)
@@ -0,0 +1,243 @@
+"""
+Recommendation engines, importable so they can run in a spawned process.
+
+The startup files must not fork the live session (the RunEngine, the
+Channel Access client threads and their locks go with it), so code that
+runs in a worker process lives here, see ``RecommenderProcess`` in
+startup/04-recommender.py.
+"""
+import time
+import traceback
+
+import numpy as np
+import scipy.linalg
+
+
+class IncrementalGP:
+    """
+    Gaussian process regression with an RBF kernel.
+
+    The Cholesky factor of the kernel matrix is extended by one row per
+    observation (one triangular solve, O(n**2)) rather than being
+    re-factored from scratch (O(n**3)).
+
+    Parameters
+    ----------
+    length_scales : array
+        One per input dimension, in the units of the inputs
+
+    signal : float, optional
+        Prior standard deviation of the (normalized) function
+
+    noise : float, optional
+        Standard deviation of the (normalized) observation noise
+
+    candidates : array, optional
+        Fixed points to predict at.  ``L**-1 K(X, candidates)`` is also
+        extended one row per observation so `predict_candidates` costs
+        O(n * n_candidates) instead of a full triangular solve.
+    """
+
+    def __init__(self, length_scales, *, signal=1.0, noise=0.1, candidates=None):
+        self.length_scales = np.asarray(length_scales, dtype=float)
+        self.signal = signal
+        self.noise = noise
+        n_dim = len(self.length_scales)
+        self._capacity = 64
+        self._X = np.empty((self._capacity, n_dim))
+        self._y = np.empty(self._capacity)
+        self._L = np.zeros((self._capacity, self._capacity))
+        self.n = 0
+        self._alpha = np.empty(0)
+        self._y_mean = 0.0
+        self._y_scale = 1.0
+        self.candidates = None
+        if candidates is not None:
+            self.candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+            self._V = np.empty((self._capacity, len(self.candidates)))
+            self._var = np.full(len(self.candidates), self.signal**2)
+
+    def kernel(self, A, B):
+        A = np.atleast_2d(A) / self.length_scales
+        B = np.atleast_2d(B) / self.length_scales
+        sq = (
+            np.sum(A**2, axis=1)[:, np.newaxis]
+            + np.sum(B**2, axis=1)[np.newaxis, :]
+            - 2 * A @ B.T
+        )
+        return self.signal**2 * np.exp(-0.5 * np.clip(sq, 0, None))
+
+    def _grow(self):
+        self._capacity *= 2
+        X = np.empty((self._capacity, self._X.shape[1]))
+        y = np.empty(self._capacity)
+        L = np.zeros((self._capacity, self._capacity))
+        X[: self.n], y[: self.n], L[: self.n, : self.n] = (
+            self._X[: self.n],
+            self._y[: self.n],
+            self._L[: self.n, : self.n],
+        )
+        self._X, self._y, self._L = X, y, L
+        if self.candidates is not None:
+            V = np.empty((self._capacity, len(self.candidates)))
+            V[: self.n] = self._V[: self.n]
+            self._V = V
+
+    def add(self, x, y):
+        """Add one observation."""
+        if self.n == self._capacity:
+            self._grow()
+        n = self.n
+        x = np.asarray(x, dtype=float)
+        k_new = self.kernel(self._X[:n], x)[:, 0]
+        k_self = self.signal**2 + self.noise**2
+        row = scipy.linalg.solve_triangular(self._L[:n, :n], k_new, lower=True)
+        self._L[n, :n] = row
+        self._L[n, n] = np.sqrt(max(k_self - row @ row, 1e-12))
+        if self.candidates is not None:
+            v = (
+                self.kernel(x, self.candidates)[0] - row @ self._V[:n]
+            ) / self._L[n, n]
+            self._V[n] = v
+            self._var -= v**2
+        self._X[n] = x
+        self._y[n] = y
+        self.n += 1
+        self._update_alpha()
+
+    def _update_alpha(self):
+        n = self.n
+        y = self._y[:n]
+        self._y_mean = y.mean()
+        self._y_scale = y.std() or 1.0
+        L = self._L[:n, :n]
+        # beta = L**-1 y, alpha = L**-T beta
+        self._beta = scipy.linalg.solve_triangular(
+            L, (y - self._y_mean) / self._y_scale, lower=True
+        )
+        self._alpha = scipy.linalg.solve_triangular(L.T, self._beta, lower=False)
+
+    def predict_candidates(self):
+        """
+        Posterior mean and standard deviation at the fixed candidates.
+
+        Returns
+        -------
+        mean, std : array
+        """
+        if self.n == 0:
+            return (
+                np.full(len(self.candidates), self._y_mean),
+                np.full(len(self.candidates), self.signal),
+            )
+        mean = self._V[: self.n].T @ self._beta
+        return (
+            mean * self._y_scale + self._y_mean,
+            np.sqrt(np.clip(self._var, 0, None)) * self._y_scale,
+        )
+
+    def predict(self, X):
+        """
+        Posterior mean and standard deviation at X.
+
+        Returns
+        -------
+        mean, std : array
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if self.n == 0:
+            return np.zeros(len(X)), np.full(len(X), self.signal)
+        K_s = self.kernel(self._X[: self.n], X)
+        mean = K_s.T @ self._alpha
+        v = scipy.linalg.solve_triangular(self._L[: self.n, : self.n], K_s, lower=True)
+        var = np.clip(self.signal**2 - np.sum(v**2, axis=0), 0, None)
+        return (
+            mean * self._y_scale + self._y_mean,
+            np.sqrt(var) * self._y_scale,
+        )
+
+
+class GPRecommender:
+    """
+    Reference recommendation engine: upper confidence bound on a GP.
+
+    Parameters
+    ----------
+    candidates : array, shape (N, n_dim)
+        The points the engine may recommend, see `layout_candidates`
+
+    keys : List[str]
+        The names of the independent variables (the recommendation keys)
+
+    length_scales : array, optional
+        Defaults to a quarter of the extent of the candidates
+
+    kappa : float, optional
+        Exploration weight, recommend the max of mean + kappa * std
+    """
+
+    def __init__(self, candidates, keys, *, length_scales=None, kappa=2.0, **kwargs):
+        self.candidates = np.asarray(candidates, dtype=float)
+        self.keys = list(keys)
+        if length_scales is None:
+            extent = np.ptp(self.candidates, axis=0)
+            length_scales = np.where(extent > 0, extent / 4, 1.0)
+        self.gp = IncrementalGP(length_scales, candidates=self.candidates, **kwargs)
+        self.kappa = kappa
+
+    def tell(self, x, y):
+        self.gp.add(x, y)
+
+    def ask(self):
+        mean, std = self.gp.predict_candidates()
+        best = self.candidates[np.argmax(mean + self.kappa * std)]
+        return dict(zip(self.keys, best.tolist()))
+
+
+def run_recommender(make_engine, inbox, outbox, stats, max_points, keys):
+    """
+    The worker process of ``RecommenderProcess``.
+
+    Tells *make_engine()* every observation from *inbox* and posts one
+    recommendation on *outbox* per message, None to stop.  The time
+    spent on each message goes on *stats*.
+    """
+    independent_keys, dependent_key = keys
+    try:
+        engine = make_engine()
+    except Exception:
+        print("ERROR: could not make the recommendation engine")
+        traceback.print_exc()
+        outbox.put(None)
+        return
+    n = 0
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            return
+        t_received = time.time()
+        try:
+            if isinstance(msg, np.ndarray):
+                # records from ReducedDataBridge, one per observation
+                for record in msg:
+                    engine.tell(
+                        tuple(float(record[k]) for k in independent_keys),
+                        float(record[dependent_key]),
+                    )
+                    n += 1
+            else:
+                engine.tell(*msg)
+                n += 1
+            if max_points is None or n < max_points:
+                recommendation = engine.ask()
+            else:
+                recommendation = None
+        except Exception:
+            # tell adaptive_plan to stop rather than let it wait for a
+            # recommendation that will never come
+            print("ERROR: recommendation engine failed after {} observations".format(n))
+            traceback.print_exc()
+            outbox.put(None)
+            return
+        outbox.put(recommendation)
+        stats.put(time.time() - t_received)